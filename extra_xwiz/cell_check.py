@@ -3,9 +3,10 @@ from extra_xwiz.utilities import (get_crystal_frames, fit_unit_cell,
                                   replace_cell) 
 
 
-def check_cells(stream_file, cell_file, out_cell=False):
+def check_cells(stream_file, cell_file, tolerance=0.1, out_cell=False):
     print(f'Checking {stream_file} against {cell_file}')
-    hit_list, cell_ensemble = get_crystal_frames(stream_file, cell_file)
+    hit_list, cell_ensemble = get_crystal_frames(
+        stream_file, cell_file, tolerance)
     with open('xtal_checker_hits.lst', 'w') as f:
         for hit_event in hit_list:
             f.write(f'vds.cxi {hit_event}\n')
@@ -18,7 +19,10 @@ def main(argv=None):
     ap = ArgumentParser(prog="xwiz-cell-checker")
     ap.add_argument('stream_file', help='stream file to parse')
     ap.add_argument('cell_file', help='reference cell file for filtering')
+    ap.add_argument('-t', '--tolerance', type=float, default=0.1,
+                    help='relative tolerance of the cell constants')
     ap.add_argument('-o', '--out_cell', help='optional cell file to write',
                     action='store_true')
     args = ap.parse_args(argv)
-    check_cells(args.stream_file, args.cell_file, out_cell=args.out_cell)
+    check_cells(args.stream_file, args.cell_file, tolerance=args.tolerance,
+                out_cell=args.out_cell)
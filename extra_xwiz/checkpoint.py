@@ -0,0 +1,243 @@
+"""Track the completion of the indexamajig task chunks in a job folder
+and resubmit the missing or incomplete ones."""
+
+from glob import glob
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+from . import scheduler as sched
+from . import stage_cache as scache
+from . import utilities as utl
+from .crystfel_tools import stream_index as sidx
+
+MANIFEST_FILE = 'chunks_manifest.json'
+STEP_RECORD_SUFFIX = '.done.json'
+
+
+class ChunkManifest:
+    """Completion state of the chunks of an indexamajig step.
+
+    Every task processes the frames of its list file '<prefix>_<task>.lst'
+    into the stream chunk '<prefix>_<task>.stream' (or one stream per
+    instance '<prefix>_<task>_<instance>.stream'). A chunk is complete
+    when the log of its task reports all frames of the list processed.
+    The frames of incomplete chunks without a complete chunk in their
+    streams are resubmitted as new tasks, after trimming the chunk
+    streams to their last complete chunk.
+    The manifest is stored as JSON in the job folder, so an interrupted
+    step can be resumed later.
+    """
+
+    def __init__(
+        self, job_dir: str, prefix: str, script: str, duration: str
+    ):
+        self.job_dir = job_dir
+        self.prefix = prefix
+        self.script = script
+        self.duration = duration
+        self.job_ids = []
+        # Number of frames, number of processed frames, number of frames
+        # kept from a resumed or re-split chunk and the task resuming it
+        self.tasks = {}
+        self.scan_lists()
+
+    def _list_file(self, task: int) -> str:
+        return f'{self.job_dir}/{self.prefix}_{task}.lst'
+
+    def _chunk_streams(self, task: int) -> List[str]:
+        return sorted(
+            glob(f'{self.job_dir}/{self.prefix}_{task}.stream')
+            + glob(f'{self.job_dir}/{self.prefix}_{task}_*.stream')
+        )
+
+    def scan_lists(self) -> None:
+        """Add the tasks of new list files in the job folder."""
+        list_re = re.compile(re.escape(self.prefix) + r'_(\d+)\.lst$')
+        for list_file in glob(f'{self.job_dir}/{self.prefix}_*.lst'):
+            match = list_re.match(os.path.basename(list_file))
+            if match is None or int(match.group(1)) in self.tasks:
+                continue
+            with open(list_file, 'r') as f_lst:
+                n_frames = sum(1 for _ in f_lst)
+            self.tasks[int(match.group(1))] = {
+                'n_frames': n_frames,
+                'n_processed': 0,
+                'n_kept': None,
+                'resumed_by': None,
+            }
+
+    def n_expected(self, task: int) -> int:
+        """Number of frames the task has to process itself."""
+        n_kept = self.tasks[task]['n_kept']
+        return self.tasks[task]['n_frames'] if n_kept is None else n_kept
+
+    def is_complete(self, task: int) -> bool:
+        return self.tasks[task]['n_processed'] >= self.n_expected(task)
+
+    def incomplete_tasks(self) -> List[int]:
+        """Sorted indices of the tasks with unprocessed frames."""
+        return sorted(
+            task for task in self.tasks if not self.is_complete(task))
+
+    def n_processed(self) -> int:
+        """Total number of processed frames without the frames repeated
+        by the resumed and re-split chunks."""
+        return sum(
+            min(info['n_processed'], self.n_expected(task))
+            for task, info in self.tasks.items()
+        )
+
+    def update(
+        self, scheduler: 'sched.Scheduler', crystfel_version: str,
+        split_tasks: Optional[Dict[int, int]] = None
+    ) -> None:
+        """Update the numbers of processed frames from the logs of all
+        jobs of the step.
+
+        Parameters
+        ----------
+        scheduler : sched.Scheduler
+            Backend the jobs have been submitted to.
+        crystfel_version : str
+            Version of CrystFEL in use.
+        split_tasks : Dict[int, int], optional
+            Number of frames kept from each task re-split as a straggler,
+            by default None.
+        """
+        self.scan_lists()
+        for task, n_kept in (split_tasks or {}).items():
+            self.tasks[task]['n_kept'] = n_kept
+        log_progress = utl.LogProgress(crystfel_version)
+        log_progress.update([
+            log for job_id in self.job_ids
+            for log in scheduler.log_files(job_id, self.job_dir)
+        ])
+        for log, counts in log_progress.counts.items():
+            task = scheduler.log_task(log)
+            if task in self.tasks:
+                self.tasks[task]['n_processed'] = counts[0]
+
+    def resubmit(
+        self, scheduler: 'sched.Scheduler', n_slack: int
+    ) -> Optional[str]:
+        """Trim the streams of the incomplete chunks and resubmit their
+        unwritten frames, one new task per chunk.
+
+        Parameters
+        ----------
+        scheduler : sched.Scheduler
+            Backend to submit the new tasks to.
+        n_slack : int
+            Number of frames before the processed count to be processed
+            again if the streams omit the non-hits, as they may still
+            have been in flight.
+
+        Returns
+        -------
+        str
+            Id of the submitted job, None if all chunks are complete.
+        """
+        incomplete = self.incomplete_tasks()
+        if not incomplete:
+            return None
+        first_task = max(self.tasks) + 1
+        n_new = 0
+        for task in incomplete:
+            for stream_file in self._chunk_streams(task):
+                sidx.trim_stream(stream_file)
+            with open(self._list_file(task), 'r') as f_lst:
+                frames = f_lst.read().splitlines()
+            n_processed = self.tasks[task]['n_processed']
+            unwritten = sidx.unwritten_frames(
+                frames, self._chunk_streams(task),
+                max(0, min(n_processed, self.n_expected(task)) - n_slack))
+            self.tasks[task]['n_kept'] = min(
+                len(frames) - unwritten.shape[0], n_processed)
+            if unwritten.shape[0] == 0:
+                continue
+            new_task = first_task + n_new
+            with open(self._list_file(new_task), 'w') as f_lst:
+                f_lst.write(''.join(
+                    f'{frames[i_frame]}\n' for i_frame in unwritten.tolist()))
+            self.tasks[task]['resumed_by'] = new_task
+            n_new += 1
+        self.scan_lists()
+        if n_new == 0:
+            self.save()
+            return None
+        job_id = scheduler.submit(
+            self.script, self.job_dir, n_new, self.duration,
+            first_task=first_task)
+        self.job_ids.append(job_id)
+        self.save()
+        return job_id
+
+    def save(self) -> None:
+        """Store the manifest in the job folder."""
+        with open(f'{self.job_dir}/{MANIFEST_FILE}', 'w') as f_man:
+            json.dump({
+                'prefix': self.prefix,
+                'script': self.script,
+                'duration': self.duration,
+                'job_ids': self.job_ids,
+                'tasks': {str(task): info
+                          for task, info in sorted(self.tasks.items())},
+            }, f_man, indent=4)
+
+    @classmethod
+    def load(cls, job_dir: str) -> Optional['ChunkManifest']:
+        """Load the manifest from the job folder, None if missing."""
+        manifest_file = f'{job_dir}/{MANIFEST_FILE}'
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, 'r') as f_man:
+            data = json.load(f_man)
+        manifest = cls.__new__(cls)
+        manifest.job_dir = job_dir
+        manifest.prefix = data['prefix']
+        manifest.script = data['script']
+        manifest.duration = data['duration']
+        manifest.job_ids = data['job_ids']
+        manifest.tasks = {
+            int(task): info for task, info in data['tasks'].items()}
+        manifest.scan_lists()
+        return manifest
+
+
+def save_step_record(
+    stream_file: str, n_frames: int, harvest: Optional[dict]
+) -> None:
+    """Mark the concatenated stream of a step as complete, once its job
+    folder with the manifest is removed, with the results to report the
+    step again when the workflow is resumed.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the concatenated stream of the step.
+    n_frames : int
+        Number of processed frames of the step.
+    harvest : dict, optional
+        Harvested indexamajig parameters of the step.
+    """
+    with open(stream_file + STEP_RECORD_SUFFIX, 'w') as f_rec:
+        json.dump({
+            'stream': scache.file_identity(stream_file),
+            'n_frames': n_frames,
+            'harvest': harvest,
+        }, f_rec, indent=4)
+
+
+def load_step_record(stream_file: str) -> Optional[dict]:
+    """Results of the step whose concatenated stream is complete, None if
+    the record is missing or the stream has changed since."""
+    record_file = stream_file + STEP_RECORD_SUFFIX
+    if not os.path.exists(record_file):
+        return None
+    with open(record_file, 'r') as f_rec:
+        record = json.load(f_rec)
+    if record['stream'] != scache.file_identity(stream_file):
+        return None
+    return record
@@ -3,12 +3,12 @@
 from argparse import ArgumentParser
 import numpy as np
 import re
-from subprocess import check_output
 import sys
 
 from extra_xwiz.templates import (PROC_VDS_BASH_SLURM)
 
-from extra_xwiz.utilities import wait_or_cancel
+from extra_xwiz.scheduler import SlurmScheduler
+from extra_xwiz.monitor import wait_or_cancel
 
 from extra_xwiz import config
 from extra_xwiz import crystfel_info as cri
@@ -86,15 +86,12 @@ def average_cell(run_nums, cell_file):
     write_cell(ac, cell_file)
 
 
-def process_frames(conf, n_frames, n_chunks=10):
+def write_process_script(conf, fn='process.sh'):
     crystfel_version = conf['crystfel']['version']
     crystfel_import = cri.crystfel_info[crystfel_version]['import']
     cell_file = conf['proc_coarse']['unit_cell']
-    partition = conf['slurm']['partition']
-    n_nodes = conf['slurm']['n_nodes_all']
-    duration = conf['slurm']['duration_all']
 
-    with open(f'process.sh', 'w') as f:
+    with open(fn, 'w') as f:
         f.write(PROC_VDS_BASH_SLURM % {
                 'IMPORT_CRYSTFEL': crystfel_import,
                 'PREFIX': 'frames',
@@ -112,16 +109,29 @@ def process_frames(conf, n_frames, n_chunks=10):
                 'LOCAL_BG_RADIUS': conf['proc_coarse']['local_bg_radius'],
                 'MAX_RES': conf['proc_coarse']['max_res'],
                 'MIN_PEAKS': conf['proc_coarse']['min_peaks'],
-                'EXTRA_OPTIONS': conf['proc_coarse']['extra_options']
+                'EXTRA_OPTIONS': conf['proc_coarse']['extra_options'],
+                'COPY_FIELDS': '',
+                'HARVEST_OPTION': '',
+                'QUEUE_LOOP_BEGIN': '',
+                'QUEUE_LOOP_END': '',
+                # Single indexamajig instance per node
+                'INSTANCES_BEGIN': '',
+                'INSTANCES_END': '',
+                'INSTANCE_PIN': ''
         })
-    slurm_args = ['sbatch',
-                  f'--partition={partition}',
-                  f'--time={duration}',
-                  f'--array=0-{n_nodes-1}',
-                  f'./process.sh']
-    proc_out = check_output(slurm_args)
-    job_id = proc_out.decode('utf-8').split()[-1]    # job id
-    wait_or_cancel(job_id, '.', n_frames, crystfel_version)
+
+
+def process_frames(conf, n_frames, n_chunks=10):
+    crystfel_version = conf['crystfel']['version']
+    partition = conf['slurm']['partition']
+    n_nodes = conf['slurm']['n_nodes_all']
+    duration = conf['slurm']['duration_all']
+
+    write_process_script(conf)
+    scheduler = SlurmScheduler(partition)
+    job_id = scheduler.submit('process.sh', '.', n_nodes, duration)
+    wait_or_cancel(job_id, '.', n_frames, crystfel_version, silent=False,
+                   scheduler=scheduler)
 
 
 def main(argv=None):
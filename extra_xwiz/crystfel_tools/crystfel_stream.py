@@ -1,6 +1,14 @@
 """Module for reading CrystFEL stream file."""
 
-from typing import TextIO
+from array import array
+import mmap
+import multiprocessing as mproc
+from typing import Iterable, Iterator, List, Sequence, TextIO, Tuple, Union
+
+import numpy as np
+
+from .. import frame_selection as fsel
+from . import stream_index as sidx
 
 chunk_tmp_dict = {
     'file_name': "",
@@ -81,7 +89,36 @@ crystal_pars_type = {
 }
 
 
-def read_crystfel_stream(stream: TextIO) -> dict:
+# Selection of the stream content to be parsed:
+#   'chunks' - chunk-level values and number of crystals only,
+#   'crystals' - in addition crystal parameters, without reflections,
+#   'all' - everything including peaks and reflections.
+FIELDS_CHUNKS = 'chunks'
+FIELDS_CRYSTALS = 'crystals'
+FIELDS_ALL = 'all'
+STREAM_FIELDS = (FIELDS_CHUNKS, FIELDS_CRYSTALS, FIELDS_ALL)
+
+
+def _field_flags(fields: str) -> Tuple[bool, bool, bool]:
+    """Whether to parse peaks, crystals and reflections for the selected
+    stream fields."""
+    if fields not in STREAM_FIELDS:
+        raise ValueError(
+            f"Unknown stream fields selection '{fields}', expected one of "
+            f"{STREAM_FIELDS}.")
+    read_all = fields == FIELDS_ALL
+    return read_all, fields != FIELDS_CHUNKS, read_all
+
+
+def skip_block(lines: Iterator[str], end_marker: str) -> None:
+    """Consume lines up to and including the end marker of a block,
+    without parsing them."""
+    for line in lines:
+        if line.startswith(end_marker):
+            return
+
+
+def read_crystfel_stream(stream: TextIO, fields: str = FIELDS_ALL) -> dict:
     """Read CrystFEL stream file into a dictionary with values for each
     frame.
 
@@ -89,6 +126,9 @@ def read_crystfel_stream(stream: TextIO) -> dict:
     ----------
     stream : TextIO
         Content of the CrystFEL stream file.
+    fields : str, optional
+        Selection of the parsed content, one of STREAM_FIELDS, by
+        default 'all'. Skipped crystals are kept as empty templates.
 
     Returns
     -------
@@ -97,6 +137,7 @@ def read_crystfel_stream(stream: TextIO) -> dict:
         matched to the dictionaries with peakfinder and indexer results.
     """
     fr_data = {}
+    read_peaks, read_crystals, read_reflections = _field_flags(fields)
 
     in_chunk = False
     in_peaks = False
@@ -104,7 +145,8 @@ def read_crystfel_stream(stream: TextIO) -> dict:
     cr_id = 0
     in_reflections = False
 
-    for line in stream:
+    lines = iter(stream)
+    for line in lines:
         if in_chunk:
             if line.startswith('----- End chunk -----'):
                 fr_key = (curr_fr_data['file_name'], curr_fr_data['event'])
@@ -123,8 +165,11 @@ def read_crystfel_stream(stream: TextIO) -> dict:
                     peak_dict['intensity'] = float(peak_data[3])
                     peak_dict['panel'] = peak_data[4]
             elif line.startswith('Peaks from peak search'):
-                in_peaks = True
-                curr_fr_data['peaks'] = list()
+                if read_peaks:
+                    in_peaks = True
+                    curr_fr_data['peaks'] = list()
+                else:
+                    skip_block(lines, 'End of peak list')
             elif in_crystal:
                 if line.startswith('--- End crystal'):
                     in_crystal = False
@@ -147,8 +192,11 @@ def read_crystfel_stream(stream: TextIO) -> dict:
                         refl_dict['ss'] = float(refl_data[8])
                         refl_dict['panel'] = refl_data[9]
                 elif line.startswith('Reflections measured after indexing'):
-                    in_reflections = True
-                    crystal_dict['reflections'] = list()
+                    if read_reflections:
+                        in_reflections = True
+                        crystal_dict['reflections'] = list()
+                    else:
+                        skip_block(lines, 'End of reflections')
                 else:
                     for par_name, par_type in crystal_pars_type.items():
                         if line.startswith(par_name):
@@ -180,7 +228,6 @@ def read_crystfel_stream(stream: TextIO) -> dict:
                                     crystal_dict[par_name] = par_val
                                     break
             elif line.startswith('--- Begin crystal'):
-                in_crystal = True
                 if curr_fr_data['crystals'] is None:
                     curr_fr_data['crystals'] = list()
                     cr_id = 0
@@ -188,6 +235,10 @@ def read_crystfel_stream(stream: TextIO) -> dict:
                     cr_id += 1
                 curr_fr_data['crystals'].append(crystal_tmp_dict.copy())
                 crystal_dict = curr_fr_data['crystals'][cr_id]
+                if read_crystals:
+                    in_crystal = True
+                else:
+                    skip_block(lines, '--- End crystal')
             else:
                 for par_name, par_type in chunk_pars_type.items():
                     if line.startswith(par_name):
@@ -203,3 +254,683 @@ def read_crystfel_stream(stream: TextIO) -> dict:
             curr_fr_data = chunk_tmp_dict.copy()
 
     return fr_data
+
+
+CHUNK_DTYPE = np.dtype([
+    ('file_id', np.int32),
+    ('event', np.int64),
+    ('hit', np.int8),
+    ('indexed_by', 'U32'),
+    ('n_indexing_tries', np.int32),
+    ('photon_energy_eV', np.float64),
+    ('beam_divergence', np.float64),
+    ('beam_bandwidth', np.float64),
+    ('average_camera_length', np.float64),
+    ('num_peaks', np.int32),
+    ('peak_resolution', np.float64),
+    ('n_crystals', np.int16),
+])
+
+PEAK_DTYPE = np.dtype([
+    ('fs', np.float32),
+    ('ss', np.float32),
+    ('1/d', np.float32),
+    ('intensity', np.float32),
+    ('panel_id', np.int16),
+])
+
+CRYSTAL_DTYPE = np.dtype([
+    ('chunk', np.int64),
+    ('cell_parameters', np.float64, (6,)),
+    ('astar', np.float64, (3,)),
+    ('bstar', np.float64, (3,)),
+    ('cstar', np.float64, (3,)),
+    ('lattice_type', 'U16'),
+    ('centering', 'U1'),
+    ('unique_axis', 'U1'),
+    ('profile_radius', np.float64),
+    ('final_residual', np.float64),
+    ('det_shift', np.float64, (2,)),
+    ('diffraction_resolution_limit', np.float64),
+    ('num_reflections', np.int32),
+    ('num_saturated_reflections', np.int32),
+    ('num_implausible_reflections', np.int32),
+])
+
+REFLECTION_DTYPE = np.dtype([
+    ('h', np.int32),
+    ('k', np.int32),
+    ('l', np.int32),
+    ('I', np.float32),
+    ('sigma_I', np.float32),
+    ('peak', np.float32),
+    ('background', np.float32),
+    ('fs', np.float32),
+    ('ss', np.float32),
+    ('panel_id', np.int16),
+])
+
+# Typecodes of the 'array' module buffers used to collect the columns
+_ARRAY_TYPECODES = {
+    np.dtype(np.int8): 'b',
+    np.dtype(np.int16): 'h',
+    np.dtype(np.int32): 'i',
+    np.dtype(np.int64): 'q',
+    np.dtype(np.float32): 'f',
+    np.dtype(np.float64): 'd',
+}
+
+
+class _ColumnBuffer:
+    """Collect rows of a structured array column by column in compact
+    'array' buffers (or lists for string fields)."""
+
+    def __init__(self, dtype: np.dtype):
+        self.dtype = dtype
+        self.n_rows = 0
+        self.columns = {}
+        for name in dtype.names:
+            base = dtype[name].base
+            if base.kind == 'U':
+                self.columns[name] = []
+            else:
+                self.columns[name] = array(_ARRAY_TYPECODES[base])
+
+    def append(self, row: dict) -> None:
+        for name, column in self.columns.items():
+            value = row[name]
+            if self.dtype[name].shape:
+                column.extend(value)
+            else:
+                column.append(value)
+        self.n_rows += 1
+
+    def to_array(self) -> np.ndarray:
+        table = np.zeros(self.n_rows, dtype=self.dtype)
+        for name, column in self.columns.items():
+            if self.n_rows == 0:
+                continue
+            if isinstance(column, list):
+                table[name] = column
+            else:
+                table[name] = np.frombuffer(
+                    column, dtype=self.dtype[name].base
+                ).reshape((self.n_rows,) + self.dtype[name].shape)
+        return table
+
+
+class StreamColumns:
+    """Columnar representation of a CrystFEL stream file.
+
+    Attributes
+    ----------
+    file_names : np.ndarray
+        Image file names referred to by chunks['file_id'].
+    panel_names : np.ndarray
+        Detector panel names referred to by the 'panel_id' fields.
+    chunks : np.ndarray
+        Structured array (CHUNK_DTYPE) with one row per chunk.
+    peaks : np.ndarray
+        Structured array (PEAK_DTYPE) with peaks of all chunks.
+    crystals : np.ndarray
+        Structured array (CRYSTAL_DTYPE) with crystals of all chunks.
+    reflections : np.ndarray
+        Structured array (REFLECTION_DTYPE) with reflections of all
+        crystals.
+    peak_offsets : np.ndarray
+        Peaks of chunk i are peaks[peak_offsets[i]:peak_offsets[i+1]].
+    crystal_offsets : np.ndarray
+        Crystals of chunk i are
+        crystals[crystal_offsets[i]:crystal_offsets[i+1]].
+    reflection_offsets : np.ndarray
+        Reflections of crystal j are
+        reflections[reflection_offsets[j]:reflection_offsets[j+1]].
+    """
+
+    def __init__(
+        self, file_names: np.ndarray, panel_names: np.ndarray,
+        chunks: np.ndarray, peaks: np.ndarray, crystals: np.ndarray,
+        reflections: np.ndarray, peak_offsets: np.ndarray,
+        crystal_offsets: np.ndarray, reflection_offsets: np.ndarray
+    ):
+        self.file_names = file_names
+        self.panel_names = panel_names
+        self.chunks = chunks
+        self.peaks = peaks
+        self.crystals = crystals
+        self.reflections = reflections
+        self.peak_offsets = peak_offsets
+        self.crystal_offsets = crystal_offsets
+        self.reflection_offsets = reflection_offsets
+
+    @property
+    def n_chunks(self) -> int:
+        return self.chunks.shape[0]
+
+    def chunk_peaks(self, i_chunk: int) -> np.ndarray:
+        """Peaks of the specified chunk."""
+        return self.peaks[
+            self.peak_offsets[i_chunk]:self.peak_offsets[i_chunk+1]]
+
+    def chunk_crystals(self, i_chunk: int) -> np.ndarray:
+        """Crystals of the specified chunk."""
+        return self.crystals[
+            self.crystal_offsets[i_chunk]:self.crystal_offsets[i_chunk+1]]
+
+    def crystal_reflections(self, i_crystal: int) -> np.ndarray:
+        """Reflections of the specified crystal."""
+        return self.reflections[
+            self.reflection_offsets[i_crystal]:
+            self.reflection_offsets[i_crystal+1]
+        ]
+
+    def peak_chunk_ids(self) -> np.ndarray:
+        """Chunk index for each of the peaks."""
+        return np.repeat(
+            np.arange(self.n_chunks), np.diff(self.peak_offsets))
+
+    def reflection_crystal_ids(self) -> np.ndarray:
+        """Crystal index for each of the reflections."""
+        return np.repeat(
+            np.arange(self.crystals.shape[0]),
+            np.diff(self.reflection_offsets)
+        )
+
+    def find_chunks(
+        self, file_names: Iterable[str], events: Iterable[int]
+    ) -> np.ndarray:
+        """Find chunk indices for the frames specified by image file
+        names and events.
+
+        Parameters
+        ----------
+        file_names : Iterable[str]
+            Image file name for each frame.
+        events : Iterable[int]
+            Event number for each frame.
+
+        Returns
+        -------
+        np.ndarray
+            Index of the chunk for each frame, -1 for the frames missing
+            in the stream.
+        """
+        return sidx.lookup_frames(
+            self.file_names, self.chunks['file_id'], self.chunks['event'],
+            file_names, events
+        )
+
+    def find_frames(self, frames: 'fsel.FrameSelection') -> np.ndarray:
+        """Find chunk indices for the frames of a frame selection, given
+        by integer data set and frame indices.
+
+        Parameters
+        ----------
+        frames : FrameSelection
+            Frames to look up.
+
+        Returns
+        -------
+        np.ndarray
+            Index of the chunk for each frame, -1 for the frames missing
+            in the stream.
+        """
+        return sidx.lookup_frame_ids(
+            self.file_names, self.chunks['file_id'], self.chunks['event'],
+            frames.ds_names, frames.ds_index, frames.frame_index
+        )
+
+
+def read_crystfel_stream_columnar(
+    stream: TextIO, fields: str = FIELDS_ALL
+) -> StreamColumns:
+    """Read CrystFEL stream file into flat structured arrays of chunks,
+    peaks, crystals and reflections.
+
+    Parameters
+    ----------
+    stream : TextIO
+        Content of the CrystFEL stream file.
+    fields : str, optional
+        Selection of the parsed content, one of STREAM_FIELDS, by
+        default 'all'. Arrays of the skipped content stay empty, while
+        chunks['n_crystals'] is always filled.
+
+    Returns
+    -------
+    StreamColumns
+        Chunk table plus peaks, crystals and reflections arrays linked
+        to the chunks and crystals by offset arrays.
+    """
+    file_ids = {}
+    panel_ids = {}
+    chunks = _ColumnBuffer(CHUNK_DTYPE)
+    peaks = _ColumnBuffer(PEAK_DTYPE)
+    crystals = _ColumnBuffer(CRYSTAL_DTYPE)
+    reflections = _ColumnBuffer(REFLECTION_DTYPE)
+    peak_offsets = array('q', [0])
+    crystal_offsets = array('q', [0])
+    reflection_offsets = array('q', [0])
+
+    chunk_default = {
+        name: chunk_tmp_dict.get(name, -1) for name in CHUNK_DTYPE.names}
+    chunk_default['n_crystals'] = 0
+    crystal_default = {
+        name: crystal_tmp_dict.get(name, -1) for name in CRYSTAL_DTYPE.names}
+    for name in ['cell_parameters', 'astar', 'bstar', 'cstar', 'det_shift']:
+        crystal_default[name] = [np.nan] * CRYSTAL_DTYPE[name].shape[0]
+
+    def panel_id(name):
+        if name not in panel_ids:
+            panel_ids[name] = len(panel_ids)
+        return panel_ids[name]
+
+    read_peaks, read_crystals, read_reflections = _field_flags(fields)
+
+    in_chunk = False
+    in_peaks = False
+    in_crystal = False
+    in_reflections = False
+
+    lines = iter(stream)
+    for line in lines:
+        if in_chunk:
+            if line.startswith('----- End chunk -----'):
+                chunks.append(curr_chunk)
+                peak_offsets.append(peaks.n_rows)
+                crystal_offsets.append(crystals.n_rows)
+                in_chunk = False
+            elif in_peaks:
+                if line.startswith('End of peak list'):
+                    in_peaks = False
+                elif not line.startswith('  fs/px'):
+                    peak_data = line.split()
+                    columns = peaks.columns
+                    columns['fs'].append(float(peak_data[0]))
+                    columns['ss'].append(float(peak_data[1]))
+                    columns['1/d'].append(float(peak_data[2]))
+                    columns['intensity'].append(float(peak_data[3]))
+                    columns['panel_id'].append(panel_id(peak_data[4]))
+                    peaks.n_rows += 1
+            elif line.startswith('Peaks from peak search'):
+                if read_peaks:
+                    in_peaks = True
+                else:
+                    skip_block(lines, 'End of peak list')
+            elif in_crystal:
+                if line.startswith('--- End crystal'):
+                    crystals.append(curr_crystal)
+                    reflection_offsets.append(reflections.n_rows)
+                    in_crystal = False
+                elif in_reflections:
+                    if line.startswith('End of reflections'):
+                        in_reflections = False
+                    elif not line.startswith('   h    k    l'):
+                        refl_data = line.split()
+                        columns = reflections.columns
+                        columns['h'].append(int(refl_data[0]))
+                        columns['k'].append(int(refl_data[1]))
+                        columns['l'].append(int(refl_data[2]))
+                        columns['I'].append(float(refl_data[3]))
+                        columns['sigma_I'].append(float(refl_data[4]))
+                        columns['peak'].append(float(refl_data[5]))
+                        columns['background'].append(float(refl_data[6]))
+                        columns['fs'].append(float(refl_data[7]))
+                        columns['ss'].append(float(refl_data[8]))
+                        columns['panel_id'].append(panel_id(refl_data[9]))
+                        reflections.n_rows += 1
+                elif line.startswith('Reflections measured after indexing'):
+                    if read_reflections:
+                        in_reflections = True
+                    else:
+                        skip_block(lines, 'End of reflections')
+                else:
+                    _parse_crystal_line(line, curr_crystal)
+            elif line.startswith('--- Begin crystal'):
+                curr_chunk['n_crystals'] += 1
+                if read_crystals:
+                    in_crystal = True
+                    curr_crystal = crystal_default.copy()
+                    curr_crystal['chunk'] = chunks.n_rows
+                else:
+                    skip_block(lines, '--- End crystal')
+            else:
+                # Chunk-level 'name = value' lines by a single lookup
+                par_name, _, par_value = line.partition(' = ')
+                par_type = chunk_pars_type.get(par_name)
+                if par_type is not None:
+                    curr_chunk[par_name] = par_type(par_value.split()[0])
+                elif line.startswith("Image filename:"):
+                    file_name = line.split()[2]
+                    if file_name not in file_ids:
+                        file_ids[file_name] = len(file_ids)
+                    curr_chunk['file_id'] = file_ids[file_name]
+                elif line.startswith("Event:"):
+                    curr_chunk['event'] = int(line.split('//')[1].strip())
+        elif line.startswith('----- Begin chunk -----'):
+            in_chunk = True
+            curr_chunk = chunk_default.copy()
+
+    return StreamColumns(
+        file_names=np.array(list(file_ids), dtype=str),
+        panel_names=np.array(list(panel_ids), dtype=str),
+        chunks=chunks.to_array(),
+        peaks=peaks.to_array(),
+        crystals=crystals.to_array(),
+        reflections=reflections.to_array(),
+        peak_offsets=np.frombuffer(peak_offsets, dtype=np.int64),
+        crystal_offsets=np.frombuffer(crystal_offsets, dtype=np.int64),
+        reflection_offsets=np.frombuffer(reflection_offsets, dtype=np.int64)
+    )
+
+
+def _parse_crystal_line(line: str, crystal_dict: dict) -> None:
+    """Parse a line from the crystal block (except reflections) into
+    the crystal dictionary."""
+    for par_name, par_type in crystal_pars_type.items():
+        if line.startswith(par_name):
+            crystal_dict[par_name] = par_type(line.split()[2])
+            return
+    if line.startswith("Cell parameters"):
+        crystal_dict['cell_parameters'] = [
+            float(line.split()[i]) for i in [2, 3, 4, 6, 7, 8]
+        ]
+    elif line.startswith("predict_refine/final_residual"):
+        crystal_dict['final_residual'] = float(line.split()[2])
+    elif line.startswith("predict_refine/det_shift"):
+        crystal_dict['det_shift'] = [float(line.split()[i]) for i in [3, 6]]
+    else:
+        for par_name in ['astar', 'bstar', 'cstar']:
+            if line.startswith(par_name):
+                crystal_dict[par_name] = [
+                    float(line.split()[i]) for i in [2, 3, 4]
+                ]
+                return
+
+
+def merge_stream_columns(parts: List[StreamColumns]) -> StreamColumns:
+    """Merge columnar stream data from consecutive parts of a stream
+    into a single StreamColumns object.
+
+    Parameters
+    ----------
+    parts : List[StreamColumns]
+        Columnar data of the stream parts, in the stream order.
+
+    Returns
+    -------
+    StreamColumns
+        Columnar data of the whole stream.
+    """
+    file_ids = {}
+    panel_ids = {}
+    chunks = []
+    peaks = []
+    crystals = []
+    reflections = []
+    peak_offsets = [np.zeros(1, dtype=np.int64)]
+    crystal_offsets = [np.zeros(1, dtype=np.int64)]
+    reflection_offsets = [np.zeros(1, dtype=np.int64)]
+    n_chunks = n_peaks = n_crystals = n_reflections = 0
+
+    for part in parts:
+        file_map = np.array([
+            file_ids.setdefault(name, len(file_ids))
+            for name in part.file_names
+        ], dtype=np.int32)
+        panel_map = np.array([
+            panel_ids.setdefault(name, len(panel_ids))
+            for name in part.panel_names
+        ], dtype=np.int16)
+
+        part_chunks = part.chunks.copy()
+        if file_map.size > 0:
+            known_file = part_chunks['file_id'] >= 0
+            part_chunks['file_id'][known_file] = file_map[
+                part_chunks['file_id'][known_file]]
+        chunks.append(part_chunks)
+
+        part_peaks = part.peaks.copy()
+        part_reflections = part.reflections.copy()
+        if panel_map.size > 0:
+            part_peaks['panel_id'] = panel_map[part_peaks['panel_id']]
+            part_reflections['panel_id'] = panel_map[
+                part_reflections['panel_id']]
+        peaks.append(part_peaks)
+        reflections.append(part_reflections)
+
+        part_crystals = part.crystals.copy()
+        part_crystals['chunk'] += n_chunks
+        crystals.append(part_crystals)
+
+        peak_offsets.append(part.peak_offsets[1:] + n_peaks)
+        crystal_offsets.append(part.crystal_offsets[1:] + n_crystals)
+        reflection_offsets.append(
+            part.reflection_offsets[1:] + n_reflections)
+
+        n_chunks += part.n_chunks
+        n_peaks += part.peaks.shape[0]
+        n_crystals += part.crystals.shape[0]
+        n_reflections += part.reflections.shape[0]
+
+    return StreamColumns(
+        file_names=np.array(list(file_ids), dtype=str),
+        panel_names=np.array(list(panel_ids), dtype=str),
+        chunks=np.concatenate([np.zeros(0, CHUNK_DTYPE)] + chunks),
+        peaks=np.concatenate([np.zeros(0, PEAK_DTYPE)] + peaks),
+        crystals=np.concatenate([np.zeros(0, CRYSTAL_DTYPE)] + crystals),
+        reflections=np.concatenate(
+            [np.zeros(0, REFLECTION_DTYPE)] + reflections),
+        peak_offsets=np.concatenate(peak_offsets),
+        crystal_offsets=np.concatenate(crystal_offsets),
+        reflection_offsets=np.concatenate(reflection_offsets)
+    )
+
+
+def _read_stream_range(
+    stream_file: str, start: int, end: int, columnar: bool, fields: str
+) -> Union[StreamColumns, dict]:
+    """Parse a range of chunks from the stream file specified by the
+    byte offsets."""
+    with open(stream_file, 'rb') as f_st:
+        f_st.seek(start)
+        lines = f_st.read(end - start).decode(
+            'utf-8', errors='replace').splitlines(keepends=True)
+    if columnar:
+        return read_crystfel_stream_columnar(lines, fields)
+    else:
+        return read_crystfel_stream(lines, fields)
+
+
+def read_crystfel_stream_parallel(
+    stream_file: str, n_processes: int = None, columnar: bool = True,
+    fields: str = FIELDS_ALL
+) -> Union[StreamColumns, dict]:
+    """Read CrystFEL stream file splitting it on the chunk boundaries
+    and parsing the pieces in a pool of processes.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the CrystFEL stream file.
+    n_processes : int, optional
+        Number of parsing processes, by default the number of CPUs.
+    columnar : bool, optional
+        Whether to return columnar data (as read_crystfel_stream_columnar)
+        or a dictionary of frames (as read_crystfel_stream), by default
+        True.
+    fields : str, optional
+        Selection of the parsed content, one of STREAM_FIELDS, by
+        default 'all'.
+
+    Returns
+    -------
+    Union[StreamColumns, dict]
+        Merged results of the parsed stream pieces.
+    """
+    if n_processes is None:
+        n_processes = mproc.cpu_count()
+    chunk_index = sidx.get_chunk_index(stream_file)
+    # Several pieces per process to balance uneven chunk sizes
+    byte_ranges = chunk_index.split_ranges(4 * n_processes)
+    range_args = [
+        (stream_file, start, end, columnar, fields)
+        for start, end in byte_ranges
+    ]
+
+    if n_processes > 1 and len(range_args) > 1:
+        with mproc.Pool(n_processes) as pool:
+            parts = pool.starmap(_read_stream_range, range_args)
+    else:
+        parts = [_read_stream_range(*args) for args in range_args]
+
+    if columnar:
+        return merge_stream_columns(parts)
+    fr_data = {}
+    for part in parts:
+        fr_data.update(part)
+    return fr_data
+
+
+def read_stream_frames(
+    stream_file: str, frames: Iterable[Tuple[str, int]],
+    columnar: bool = True, fields: str = FIELDS_ALL
+) -> Union[StreamColumns, dict]:
+    """Read only the chunks of the specified frames from the stream file,
+    using the persistent chunk index for random access.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the CrystFEL stream file.
+    frames : Iterable[Tuple[str, int]]
+        Frames to read as (image file name, event) tuples.
+    columnar : bool, optional
+        Whether to return columnar data (as read_crystfel_stream_columnar)
+        or a dictionary of frames (as read_crystfel_stream), by default
+        True.
+    fields : str, optional
+        Selection of the parsed content, one of STREAM_FIELDS, by
+        default 'all'.
+
+    Returns
+    -------
+    Union[StreamColumns, dict]
+        Parsed chunks of the frames found in the stream, in the order of
+        the request.
+    """
+    lines = []
+    for chunk_bytes in _iter_frame_chunks(stream_file, frames):
+        lines.extend(chunk_bytes.decode(
+            'utf-8', errors='replace').splitlines(keepends=True))
+    if columnar:
+        return read_crystfel_stream_columnar(lines, fields)
+    else:
+        return read_crystfel_stream(lines, fields)
+
+
+def write_sub_stream(
+    stream_file: str, frames: Iterable[Tuple[str, int]], out_file: str
+) -> int:
+    """Write a new stream file with the header of the original stream
+    and the chunks of the specified frames only.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the original CrystFEL stream file.
+    frames : Iterable[Tuple[str, int]]
+        Frames to copy as (image file name, event) tuples.
+    out_file : str
+        Path to the output stream file.
+
+    Returns
+    -------
+    int
+        Number of chunks written to the output stream.
+    """
+    chunk_index = sidx.get_chunk_index(stream_file)
+    n_chunks = 0
+    with open(stream_file, 'rb') as f_st, open(out_file, 'wb') as f_out:
+        f_out.write(f_st.read(chunk_index.header_end))
+        for chunk_bytes in _iter_frame_chunks(stream_file, frames):
+            f_out.write(chunk_bytes)
+            n_chunks += 1
+    return n_chunks
+
+
+def _iter_frame_chunks(
+    stream_file: str, frames: Iterable[Tuple[str, int]]
+) -> Iterable[bytes]:
+    """Yield raw bytes of the chunks of the specified frames found in
+    the stream file."""
+    chunk_index = sidx.get_chunk_index(stream_file)
+    frames = list(frames)
+    if not frames or chunk_index.n_chunks == 0:
+        return
+    file_names, events = zip(*frames)
+    chunk_ids = chunk_index.find_chunks(file_names, events)
+    with open(stream_file, 'rb') as f_st, \
+            mmap.mmap(f_st.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for chunk_id in chunk_ids[chunk_ids >= 0]:
+            yield mm[chunk_index.begin[chunk_id]:chunk_index.end[chunk_id]]
+
+
+def concat_streams(stream_files: Sequence[str], out_file: str) -> int:
+    """Concatenate stream files into one with the header of the first
+    non-empty stream. Chunks missing the end marker (e.g. from cancelled
+    jobs) are dropped and only the first chunk of every frame is kept.
+
+    Parameters
+    ----------
+    stream_files : Sequence[str]
+        Paths to the CrystFEL stream files to concatenate.
+    out_file : str
+        Path to the output stream file.
+
+    Returns
+    -------
+    int
+        Number of chunks written to the output stream.
+    """
+    file_ids = {}
+    written_keys = set()
+    n_chunks = 0
+    header_written = False
+    with open(out_file, 'wb') as f_out:
+        for stream_file in stream_files:
+            chunk_index = sidx.build_chunk_index(stream_file)
+            if chunk_index.stream_size == 0:
+                continue
+            global_ids = np.array([
+                file_ids.setdefault(name, len(file_ids))
+                for name in chunk_index.file_names.tolist()
+            ], dtype=np.int64)
+            keys = sidx.frame_keys(
+                global_ids[chunk_index.file_id], chunk_index.event)
+            with open(stream_file, 'rb') as f_st, \
+                    mmap.mmap(f_st.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if not header_written:
+                    header_written = True
+                    header_end = chunk_index.header_end
+                    if chunk_index.n_chunks == 0:
+                        header_end = mm.find(sidx.CHUNK_BEGIN)
+                        if header_end < 0:
+                            header_end = chunk_index.stream_size
+                    f_out.write(mm[:header_end])
+                # Copy runs of consecutive chunks at once
+                run_begin = run_end = -1
+                for begin, end, key in zip(
+                    chunk_index.begin.tolist(), chunk_index.end.tolist(),
+                    keys.tolist()
+                ):
+                    if key in written_keys:
+                        continue
+                    written_keys.add(key)
+                    n_chunks += 1
+                    if begin != run_end:
+                        f_out.write(mm[run_begin:run_end])
+                        run_begin = begin
+                    run_end = end
+                f_out.write(mm[run_begin:run_end])
+    return n_chunks
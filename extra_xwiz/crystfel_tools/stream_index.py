@@ -0,0 +1,412 @@
+"""Module for indexing chunks of CrystFEL stream files by their byte
+offsets."""
+
+import mmap
+import os
+import warnings
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+CHUNK_BEGIN = b'----- Begin chunk -----'
+CHUNK_END = b'----- End chunk -----'
+FILE_NAME_LINE = b'\nImage filename:'
+EVENT_LINE = b'\nEvent:'
+INDEX_SUFFIX = '.idx'
+NO_NON_HITS_OPTION = b'--no-non-hits-in-stream'
+
+
+class ChunkIndex:
+    """Byte ranges and event keys of the complete chunks in a CrystFEL
+    stream file.
+
+    Attributes
+    ----------
+    begin : np.ndarray
+        Byte offsets of the '----- Begin chunk -----' lines.
+    end : np.ndarray
+        Byte offsets right after the '----- End chunk -----' lines.
+    file_names : np.ndarray
+        Image file names referred to by file_id.
+    file_id : np.ndarray
+        Index of the image file name for each chunk.
+    event : np.ndarray
+        Event number for each chunk, -1 if not specified.
+    stream_size : int
+        Size of the indexed stream file in bytes.
+    stream_mtime : int
+        Modification time of the indexed stream file in nanoseconds.
+    """
+
+    def __init__(
+        self, begin: np.ndarray, end: np.ndarray, file_names: np.ndarray,
+        file_id: np.ndarray, event: np.ndarray, stream_size: int,
+        stream_mtime: int
+    ):
+        self.begin = begin
+        self.end = end
+        self.file_names = file_names
+        self.file_id = file_id
+        self.event = event
+        self.stream_size = stream_size
+        self.stream_mtime = stream_mtime
+
+    @property
+    def n_chunks(self) -> int:
+        return self.begin.shape[0]
+
+    @property
+    def header_end(self) -> int:
+        """Byte offset of the end of the stream header."""
+        if self.n_chunks > 0:
+            return int(self.begin[0])
+        return self.stream_size
+
+    def matches(self, stream_file: str) -> bool:
+        """Whether the index is up to date with the stream file."""
+        stat = os.stat(stream_file)
+        return (stat.st_size == self.stream_size
+                and stat.st_mtime_ns == self.stream_mtime)
+
+    def find_chunks(
+        self, file_names: Iterable[str], events: Iterable[int]
+    ) -> np.ndarray:
+        """Find chunk indices for the frames specified by image file
+        names and events, -1 for the frames missing in the stream."""
+        return lookup_frames(
+            self.file_names, self.file_id, self.event, file_names, events)
+
+    def split_ranges(self, n_parts: int) -> List[Tuple[int, int]]:
+        """Split the stream into up to n_parts byte ranges of similar
+        size aligned to the chunk boundaries.
+
+        Parameters
+        ----------
+        n_parts : int
+            Requested number of byte ranges.
+
+        Returns
+        -------
+        List[Tuple[int, int]]
+            List of (start, end) byte offsets, each range contains
+            a sequence of complete chunks.
+        """
+        if self.n_chunks == 0:
+            return []
+        targets = np.linspace(
+            self.begin[0], self.end[-1], n_parts + 1)[1:-1]
+        split_ids = np.unique(np.searchsorted(self.begin, targets))
+        split_ids = split_ids[(split_ids > 0) & (split_ids < self.n_chunks)]
+        first_ids = np.concatenate([[0], split_ids])
+        last_ids = np.concatenate([split_ids, [self.n_chunks]]) - 1
+        return [
+            (int(self.begin[first]), int(self.end[last]))
+            for first, last in zip(first_ids, last_ids)
+        ]
+
+    def save(self, index_file: str) -> None:
+        with open(index_file, 'wb') as f_idx:
+            np.savez(
+                f_idx, begin=self.begin, end=self.end,
+                file_names=self.file_names, file_id=self.file_id,
+                event=self.event, stream_size=self.stream_size,
+                stream_mtime=self.stream_mtime
+            )
+
+    @classmethod
+    def load(cls, index_file: str) -> 'ChunkIndex':
+        with np.load(index_file) as idx_data:
+            return cls(
+                begin=idx_data['begin'],
+                end=idx_data['end'],
+                file_names=idx_data['file_names'],
+                file_id=idx_data['file_id'],
+                event=idx_data['event'],
+                stream_size=int(idx_data['stream_size']),
+                stream_mtime=int(idx_data['stream_mtime'])
+            )
+
+
+def lookup_frames(
+    chunk_file_names: np.ndarray, chunk_file_ids: np.ndarray,
+    chunk_events: np.ndarray, file_names: Iterable[str],
+    events: Iterable[int]
+) -> np.ndarray:
+    """Find indices of the chunks matching the specified frames.
+
+    Parameters
+    ----------
+    chunk_file_names : np.ndarray
+        Image file names referred to by chunk_file_ids.
+    chunk_file_ids : np.ndarray
+        Index of the image file name for each chunk.
+    chunk_events : np.ndarray
+        Event number for each chunk.
+    file_names : Iterable[str]
+        Image file name for each frame to look up.
+    events : Iterable[int]
+        Event number for each frame to look up.
+
+    Returns
+    -------
+    np.ndarray
+        Index of the first matching chunk for each frame, -1 for the
+        frames missing in the stream.
+    """
+    file_table = {}
+    file_ids = np.array(
+        [file_table.setdefault(name, len(file_table)) for name in file_names],
+        dtype=np.int64
+    )
+    return lookup_frame_ids(
+        chunk_file_names, chunk_file_ids, chunk_events, list(file_table),
+        file_ids, events
+    )
+
+
+def lookup_frame_ids(
+    chunk_file_names: np.ndarray, chunk_file_ids: np.ndarray,
+    chunk_events: np.ndarray, file_names: Iterable[str],
+    file_ids: np.ndarray, events: np.ndarray
+) -> np.ndarray:
+    """Find indices of the chunks matching the frames specified by
+    indices into a table of image file names.
+
+    Parameters
+    ----------
+    chunk_file_names : np.ndarray
+        Image file names referred to by chunk_file_ids.
+    chunk_file_ids : np.ndarray
+        Index of the image file name for each chunk.
+    chunk_events : np.ndarray
+        Event number for each chunk.
+    file_names : Iterable[str]
+        Image file names referred to by file_ids.
+    file_ids : np.ndarray
+        Index of the image file name for each frame to look up.
+    events : np.ndarray
+        Event number for each frame to look up.
+
+    Returns
+    -------
+    np.ndarray
+        Index of the first matching chunk for each frame, -1 for the
+        frames missing in the stream.
+    """
+    chunk_file_table = {name: i for i, name in enumerate(chunk_file_names)}
+    file_map = np.array(
+        [chunk_file_table.get(name, -1) for name in file_names] + [-1],
+        dtype=np.int64
+    )
+    probe_files = file_map[np.asarray(file_ids, dtype=np.int64)]
+    probe_keys = frame_keys(
+        probe_files, np.asarray(events, dtype=np.int64))
+
+    chunk_keys = frame_keys(
+        chunk_file_ids.astype(np.int64), chunk_events)
+    order = np.argsort(chunk_keys, kind='stable')
+    sorted_keys = chunk_keys[order]
+    chunk_ids = np.full(probe_keys.shape, -1, dtype=np.int64)
+    if sorted_keys.shape[0] == 0:
+        return chunk_ids
+    pos = np.minimum(
+        np.searchsorted(sorted_keys, probe_keys), sorted_keys.shape[0] - 1)
+    found = (sorted_keys[pos] == probe_keys) & (probe_files >= 0)
+    chunk_ids[found] = order[pos[found]]
+    return chunk_ids
+
+
+def frame_keys(file_ids: np.ndarray, events: np.ndarray) -> np.ndarray:
+    """Combine file ids and events into single int64 keys."""
+    return (file_ids << 40) | (events.astype(np.int64) + 1)
+
+
+def build_chunk_index(stream_file: str) -> ChunkIndex:
+    """Scan the stream file once for the byte offsets and event keys of
+    all complete chunks. Chunks missing the end marker (e.g. from
+    interrupted jobs) are skipped.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the CrystFEL stream file.
+
+    Returns
+    -------
+    ChunkIndex
+        Byte ranges and event keys of the chunks in the stream file.
+    """
+    stat = os.stat(stream_file)
+    begin = []
+    end = []
+    file_ids = {}
+    file_id = []
+    event = []
+    if stat.st_size > 0:
+        with open(stream_file, 'rb') as f_st, \
+                mmap.mmap(f_st.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = _find_line(mm, CHUNK_BEGIN, 0)
+            while pos >= 0:
+                next_begin = _find_line(mm, CHUNK_BEGIN, pos + 1)
+                pos_end = _find_line(mm, CHUNK_END, pos + 1)
+                if pos_end < 0:
+                    break
+                if 0 <= next_begin < pos_end:
+                    # Chunk without end marker
+                    pos = next_begin
+                    continue
+                line_end = mm.find(b'\n', pos_end)
+                line_end = stat.st_size if line_end < 0 else line_end + 1
+                begin.append(pos)
+                end.append(line_end)
+                file_name = _line_value(mm, FILE_NAME_LINE, pos, line_end)
+                file_id.append(file_ids.setdefault(file_name, len(file_ids)))
+                event_str = _line_value(mm, EVENT_LINE, pos, line_end)
+                if '//' in event_str:
+                    event.append(int(event_str.split('//')[1]))
+                else:
+                    event.append(-1)
+                pos = next_begin
+    return ChunkIndex(
+        begin=np.array(begin, dtype=np.int64),
+        end=np.array(end, dtype=np.int64),
+        file_names=np.array(list(file_ids), dtype=str),
+        file_id=np.array(file_id, dtype=np.int32),
+        event=np.array(event, dtype=np.int64),
+        stream_size=stat.st_size,
+        stream_mtime=stat.st_mtime_ns
+    )
+
+
+def unwritten_frames(
+    frames: List[str], stream_files: Iterable[str], min_start: int = 0
+) -> np.ndarray:
+    """Find the frames of a task list without a complete chunk in the
+    streams of the task, i.e. the frames still to be processed.
+
+    If the streams omit the non-hit frames ('--no-non-hits-in-stream' in
+    the indexamajig command line of the stream header), a frame missing
+    in the streams may as well be a processed non-hit. Only the missing
+    frames from position 'min_start' on are reported then.
+
+    Parameters
+    ----------
+    frames : List[str]
+        Frames of the task list, as '<image file> //<event>' lines.
+    stream_files : Iterable[str]
+        Paths to the stream files written by the task.
+    min_start : int, optional
+        Position of the first frame which may be unwritten if the
+        non-hits are omitted, by default 0.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted positions of the unwritten frames in the task list.
+    """
+    file_names = []
+    events = []
+    for frame in frames:
+        file_name, _, event = frame.strip().partition(' //')
+        file_names.append(file_name)
+        events.append(int(event) if event else -1)
+    written = np.zeros(len(frames), dtype=bool)
+    omit_non_hits = False
+    for stream_file in stream_files:
+        chunk_index = build_chunk_index(stream_file)
+        if chunk_index.stream_size == 0:
+            continue
+        with open(stream_file, 'rb') as f_st:
+            header = f_st.read(chunk_index.header_end)
+        omit_non_hits |= NO_NON_HITS_OPTION in header
+        written |= lookup_frames(
+            chunk_index.file_names, chunk_index.file_id, chunk_index.event,
+            file_names, events) >= 0
+    if omit_non_hits:
+        written[:min_start] = True
+    return np.flatnonzero(~written)
+
+
+def trim_stream(stream_file: str) -> int:
+    """Truncate a stream file after its last complete chunk, dropping
+    the partially written chunk of an interrupted job.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the CrystFEL stream file.
+
+    Returns
+    -------
+    int
+        Number of bytes removed from the end of the stream.
+    """
+    size = os.path.getsize(stream_file)
+    if size == 0:
+        return 0
+    with open(stream_file, 'rb') as f_st, \
+            mmap.mmap(f_st.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = mm.rfind(b'\n' + CHUNK_END)
+        if pos >= 0:
+            line_end = mm.find(b'\n', pos + 1)
+            keep = size if line_end < 0 else line_end + 1
+        else:
+            # No complete chunk, keep the header only
+            keep = _find_line(mm, CHUNK_BEGIN, 0)
+            if keep < 0:
+                keep = size
+    if keep < size:
+        os.truncate(stream_file, keep)
+    return size - keep
+
+
+def _find_line(mm: mmap.mmap, marker: bytes, start: int) -> int:
+    """Find the next line starting with the marker."""
+    while True:
+        pos = mm.find(marker, start)
+        if pos <= 0 or mm[pos-1:pos] == b'\n':
+            return pos
+        start = pos + 1
+
+
+def _line_value(mm: mmap.mmap, prefix: bytes, start: int, end: int) -> str:
+    """Value following the prefix of the first line in the byte range
+    which starts with it, empty string if there is no such line."""
+    pos = mm.find(prefix, start, end)
+    if pos < 0:
+        return ''
+    line_end = mm.find(b'\n', pos + 1, end)
+    return mm[pos+len(prefix):line_end].decode(
+        'utf-8', errors='replace').strip()
+
+
+def get_chunk_index(stream_file: str) -> ChunkIndex:
+    """Load the chunk index from the sidecar file next to the stream,
+    (re)build and store it if missing or outdated.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the CrystFEL stream file.
+
+    Returns
+    -------
+    ChunkIndex
+        Byte ranges of the chunks in the stream file.
+    """
+    index_file = stream_file + INDEX_SUFFIX
+    if os.path.exists(index_file):
+        try:
+            chunk_index = ChunkIndex.load(index_file)
+        except (OSError, KeyError, ValueError):
+            warnings.warn(f"Could not read stream index {index_file}.")
+        else:
+            if chunk_index.matches(stream_file):
+                return chunk_index
+
+    chunk_index = build_chunk_index(stream_file)
+    try:
+        chunk_index.save(index_file)
+    except OSError:
+        warnings.warn(f"Could not store stream index {index_file}.")
+    return chunk_index
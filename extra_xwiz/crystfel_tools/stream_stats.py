@@ -0,0 +1,111 @@
+"""Module for collecting statistics of a CrystFEL stream file in a single
+streaming pass."""
+
+from array import array
+from typing import List
+
+import numpy as np
+
+from .crystfel_stream import skip_block
+
+
+class StreamStatistics:
+    """Statistics of a CrystFEL stream file needed by the workflow.
+
+    Attributes
+    ----------
+    n_chunks : int
+        Number of chunks (frames) in the stream.
+    num_peaks_hist : np.ndarray
+        Number of chunks for each value of 'num_peaks'.
+    cell_constants : np.ndarray
+        (N, 6) array with cell constants of all crystals: a, b, c in Å
+        and alpha, beta, gamma in degrees.
+    crystal_events : List[str]
+        Event of each crystal as '<image file> //<event>'.
+    crystal_num_peaks : np.ndarray
+        Number of peaks in the frame of each crystal.
+    """
+
+    def __init__(
+        self, n_chunks: int, num_peaks_hist: np.ndarray,
+        cell_constants: np.ndarray, crystal_events: List[str],
+        crystal_num_peaks: np.ndarray
+    ):
+        self.n_chunks = n_chunks
+        self.num_peaks_hist = num_peaks_hist
+        self.cell_constants = cell_constants
+        self.crystal_events = crystal_events
+        self.crystal_num_peaks = crystal_num_peaks
+
+    @property
+    def n_crystals(self) -> int:
+        return self.cell_constants.shape[0]
+
+    def n_hits(self, min_peaks: int) -> int:
+        """Number of frames with at least 'min_peaks' peaks."""
+        return int(np.sum(self.num_peaks_hist[max(min_peaks, 0):]))
+
+
+def collect_stream_stats(stream_file: str) -> StreamStatistics:
+    """Read the stream file line by line, skipping peak lists and
+    reflections, and collect all statistics at once. Memory use does not
+    depend on the size of the stream, only on the number of crystals.
+
+    Parameters
+    ----------
+    stream_file : str
+        Path to the CrystFEL stream file.
+
+    Returns
+    -------
+    StreamStatistics
+        Statistics of the stream file.
+    """
+    n_chunks = 0
+    num_peaks_hist = array('q')
+    cell_constants = array('d')
+    crystal_events = []
+    crystal_num_peaks = array('q')
+    num_peaks = 0
+    event_fn = ''
+    event_id = ''
+
+    with open(stream_file, 'r') as f_st:
+        lines = iter(f_st)
+        for line in lines:
+            if line.startswith('Peaks from peak search'):
+                skip_block(lines, 'End of peak list')
+            elif line.startswith('Reflections measured after indexing'):
+                skip_block(lines, 'End of reflections')
+            elif line.startswith('Cell parameters'):
+                cell_items = line.split()
+                cell_constants.extend(
+                    [10 * float(val) for val in cell_items[2:5]])
+                cell_constants.extend(
+                    [float(val) for val in cell_items[6:9]])
+                crystal_events.append(f'{event_fn} {event_id}'.strip())
+                crystal_num_peaks.append(num_peaks)
+            elif line.startswith('num_peaks = '):
+                num_peaks = int(line.split()[2])
+                if num_peaks >= len(num_peaks_hist):
+                    num_peaks_hist.extend(
+                        [0] * (num_peaks + 1 - len(num_peaks_hist)))
+                num_peaks_hist[num_peaks] += 1
+            elif line.startswith('Image filename:'):
+                event_fn = line.split()[-1]
+                event_id = ''
+                num_peaks = 0
+            elif line.startswith('Event:'):
+                event_id = line.split()[-1]
+            elif line.startswith('----- Begin chunk -----'):
+                n_chunks += 1
+
+    return StreamStatistics(
+        n_chunks=n_chunks,
+        num_peaks_hist=np.frombuffer(num_peaks_hist, dtype=np.int64),
+        cell_constants=np.frombuffer(
+            cell_constants, dtype=np.float64).reshape(-1, 6),
+        crystal_events=crystal_events,
+        crystal_num_peaks=np.frombuffer(crystal_num_peaks, dtype=np.int64)
+    )
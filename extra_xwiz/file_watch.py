@@ -0,0 +1,155 @@
+"""Watch a job folder for changed files, with inotify where available
+and adaptive polling otherwise."""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from typing import Dict, Tuple
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class PollingWatcher:
+    """Detect changes in a folder by comparing sizes and modification
+    times of its files. The interval between the checks is doubled after
+    every check without changes, from 'min_interval' up to
+    'max_interval', and is reset once a change has been found.
+    """
+
+    def __init__(
+        self, path: str, min_interval: float = 1.0,
+        max_interval: float = 30.0
+    ):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def _check(self) -> bool:
+        snapshot = self._scan()
+        changed = snapshot != self._snapshot
+        self._snapshot = snapshot
+        return changed
+
+    def _wait_event(self, timeout: float) -> bool:
+        time.sleep(timeout)
+        return False
+
+    def wait(self, timeout: float) -> bool:
+        """Wait until files in the folder change or the timeout expires.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum waiting time in seconds.
+
+        Returns
+        -------
+        bool
+            Whether any change has been detected.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            event = self._wait_event(min(self.interval, remaining))
+            if self._check() or event:
+                self.interval = self.min_interval
+                return True
+            self.interval = min(2 * self.interval, self.max_interval)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    """Wake up on inotify events in the folder. Changes made on other
+    machines (e.g. by the tasks on cluster nodes writing to a network file
+    system) are not reported by inotify and are still found by the
+    adaptive polling.
+    """
+
+    def __init__(
+        self, path: str, min_interval: float = 1.0,
+        max_interval: float = 30.0
+    ):
+        super().__init__(path, min_interval, max_interval)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(
+            self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def _wait_event(self, timeout: float) -> bool:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        # Let the writers settle, then drain all queued events
+        time.sleep(self.min_interval)
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def get_watcher(
+    path: str, min_interval: float = 1.0, max_interval: float = 30.0
+) -> PollingWatcher:
+    """Create an inotify-based watcher of the folder, fall back to
+    the polling one if inotify is not available.
+
+    Parameters
+    ----------
+    path : str
+        Folder to watch.
+    min_interval : float, optional
+        Shortest interval between checks in seconds, by default 1.0.
+    max_interval : float, optional
+        Longest interval between checks in seconds, by default 30.0.
+
+    Returns
+    -------
+    PollingWatcher
+        Folder watcher.
+    """
+    try:
+        return InotifyWatcher(path, min_interval, max_interval)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(path, min_interval, max_interval)
@@ -0,0 +1,141 @@
+"""Compact representation of the frames selected for processing."""
+
+import hashlib
+from typing import List, Sequence
+
+import numpy as np
+
+
+class FrameSelection:
+    """Frames as integer arrays of data set and frame indices. Strings of
+    the CrystFEL list files ('<data set> //<frame>') are only rendered
+    when writing the files.
+
+    Attributes
+    ----------
+    ds_names : List[str]
+        Names of the data set files referred to by ds_index.
+    ds_index : np.ndarray
+        Index of the data set file for each frame.
+    frame_index : np.ndarray
+        Frame (event) index in the data set for each frame, -1 for
+        the list entries without an event.
+    """
+
+    def __init__(
+        self, ds_names: Sequence[str], ds_index: np.ndarray,
+        frame_index: np.ndarray
+    ):
+        self.ds_names = list(ds_names)
+        self.ds_index = np.asarray(ds_index, dtype=np.int32)
+        self.frame_index = np.asarray(frame_index, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.frame_index.shape[0]
+
+    @classmethod
+    def from_ranges(
+        cls, ds_names: Sequence[str], ranges: Sequence[range]
+    ) -> 'FrameSelection':
+        """Select a range of frames in each data set.
+
+        Parameters
+        ----------
+        ds_names : Sequence[str]
+            Names of the data set files.
+        ranges : Sequence[range]
+            Range of the frame indices for each data set.
+
+        Returns
+        -------
+        FrameSelection
+            Selected frames.
+        """
+        frame_index = [
+            np.arange(rng.start, rng.stop, rng.step, dtype=np.int64)
+            for rng in ranges
+        ]
+        ds_index = [
+            np.full(frames.shape[0], ids, dtype=np.int32)
+            for ids, frames in enumerate(frame_index)
+        ]
+        return cls(
+            ds_names,
+            np.concatenate(ds_index) if ds_index else [],
+            np.concatenate(frame_index) if frame_index else []
+        )
+
+    @classmethod
+    def from_list_file(cls, list_file: str) -> 'FrameSelection':
+        """Read frames from a CrystFEL list file.
+
+        Parameters
+        ----------
+        list_file : str
+            Path to the list file with '<data set> //<frame>' lines.
+
+        Returns
+        -------
+        FrameSelection
+            Frames in the list file.
+        """
+        ds_ids = {}
+        ds_index = []
+        frame_index = []
+        with open(list_file, 'r') as f_lst:
+            for line in f_lst:
+                line = line.strip()
+                if not line:
+                    continue
+                ds_name, _, frame = line.partition(' //')
+                ds_index.append(ds_ids.setdefault(ds_name, len(ds_ids)))
+                frame_index.append(int(frame) if frame else -1)
+        return cls(list(ds_ids), ds_index, frame_index)
+
+    def digest(self) -> str:
+        """SHA-256 digest of the selected frames."""
+        sha = hashlib.sha256()
+        sha.update('\n'.join(self.ds_names).encode())
+        sha.update(self.ds_index.astype('<i4').tobytes())
+        sha.update(self.frame_index.astype('<i8').tobytes())
+        return sha.hexdigest()
+
+    def select(self, keep: np.ndarray) -> 'FrameSelection':
+        """Frames for which 'keep' (boolean array) is true, in the same
+        order."""
+        return FrameSelection(
+            self.ds_names, self.ds_index[keep], self.frame_index[keep])
+
+    def split(self, n_parts: int) -> List['FrameSelection']:
+        """Split the frames into n_parts consecutive parts of similar
+        size."""
+        return [
+            FrameSelection(self.ds_names, ds_index, frame_index)
+            for ds_index, frame_index in zip(
+                np.array_split(self.ds_index, n_parts),
+                np.array_split(self.frame_index, n_parts)
+            )
+        ]
+
+    def write_list(self, list_file: str) -> None:
+        """Write the frames to a CrystFEL list file, rendering the lines
+        in bulk for each run of frames from the same data set."""
+        run_starts = np.flatnonzero(np.diff(self.ds_index)) + 1
+        run_bounds = np.concatenate([[0], run_starts, [len(self)]])
+        with open(list_file, 'w') as f_lst:
+            for start, end in zip(run_bounds[:-1], run_bounds[1:]):
+                if start == end:
+                    continue
+                ds_name = self.ds_names[self.ds_index[start]]
+                frames = self.frame_index[start:end]
+                with_event = frames >= 0
+                if np.all(with_event):
+                    prefix = f'{ds_name} //'
+                    f_lst.write(
+                        prefix + f'\n{prefix}'.join(map(str, frames.tolist()))
+                        + '\n')
+                else:
+                    f_lst.write(''.join(
+                        f'{ds_name} //{frame}\n' if frame >= 0
+                        else f'{ds_name}\n' for frame in frames.tolist()
+                    ))
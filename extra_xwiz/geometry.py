@@ -7,6 +7,7 @@ import os
 import warnings
 
 from . import utilities as utl
+from .mask_converter import mask_converter as mc
 
 def check_geom_format(geometry, use_peaks):
     """ Verify that the provided geometry file is compatible to respective
@@ -146,6 +147,16 @@ def get_panel_offsets(fn):
     return off_dict
 
 
+def get_bad_regions_mask(fn):
+    """ Boolean mask of the 'bad_*' regions in a VDS-format geometry file,
+        shaped like a VDS frame (modules, ss, fs), True for masked pixels
+    """
+    det_name = {'agipd': 'AGIPD1M', 'jungfrau': 'JF4M'}[get_detector_type(fn)]
+    converter = mc.MaskConverter(
+        None, fn, 'geom2hd5', 'replace', None, 0, det_name, 'VDS', False)
+    return converter.rect_mask
+
+
 def geom_add_hd5mask(geometry, mask_dict):
     """
     Copy geometry file to mask_dict['output'] and replace all geometry
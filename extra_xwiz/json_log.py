@@ -2,6 +2,7 @@
 import json
 import math
 import os.path as osp
+from typing import Optional
 import xarray as xr
 
 from . import crystfel_info as cri
@@ -20,6 +21,19 @@ def save_slurm_info(
         json.dump(job_dict, j_out)
 
 
+def save_task_attempts(attempts: dict, folder: str) -> None:
+    """Add the attempts of the retried tasks to the SLURM job information
+    in the job folder."""
+    info_file = f"{folder}/slurm_info.json"
+    job_dict = {}
+    if osp.exists(info_file):
+        with open(info_file, 'r') as j_in:
+            job_dict = json.load(j_in)
+    job_dict['task_attempts'] = attempts
+    with open(info_file, 'w') as j_out:
+        json.dump(job_dict, j_out)
+
+
 class WorkflowJsonLog:
 
     def __init__(self, xwiz_workflow: 'wf.Workflow'):
@@ -36,12 +50,17 @@ class WorkflowJsonLog:
         self.log['crystfel'] = {}
         self.log['crystfel']['version'] = self.xwiz.crystfel_version
 
-    def save_crystfel_job(self, job_name: str, folder: str, results: dict):
+    def save_crystfel_job(
+        self, job_name: str, folder: str, results: dict,
+        harvest: Optional[dict] = None
+    ):
         crystfel_version = self.log['crystfel']['version']
         self.log['crystfel'][job_name] = job_log = {}
         job_log['geometry_file'] = osp.abspath(self.xwiz.geometry)
         job_log['cell_file'] = osp.abspath(self.xwiz.cell_file)
-        if cri.crystfel_info[crystfel_version]['contain_harvest']:
+        if harvest is not None:
+            job_log['parameters'] = harvest
+        elif cri.crystfel_info[crystfel_version]['contain_harvest']:
             with open(f"{folder}/crystfel_harvest.json", 'r') as j_harv:
                 job_log['parameters'] = json.load(j_harv)
         else:
@@ -84,6 +103,13 @@ class WorkflowJsonLog:
                     count_value = None 
                 frame_counts_dict[dataset][count] = count_value
 
+    def load_json(self):
+        """Restore the log written by the earlier steps of a detached
+        workflow."""
+        if osp.exists("output_xwiz.json"):
+            with open("output_xwiz.json", 'r') as j_in:
+                self.log = json.load(j_in)
+
     def write_json(self):
         with open(f"output_xwiz.json", 'w') as j_out:
             json.dump(self.log, j_out)
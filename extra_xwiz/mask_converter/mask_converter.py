@@ -86,6 +86,17 @@ class MaskConverter:
         """
         return np.copy(self.__mask)
 
+    @property
+    def rect_mask(self):
+        """
+        Provides the mask of the rectangles read from the geometry file
+        in the 'geom2hd5' mode.
+
+        Returns:
+            np.array: Detector mask as a boolean numpy array.
+        """
+        return self._convert_rectd2nparr()
+
     def convert(self):
         """
         Convert detector mask and write to the output file.
@@ -0,0 +1,116 @@
+"""Monitor the indexamajig jobs until all their tasks have finished,
+with a progress bar from their logs."""
+
+import warnings
+
+from . import file_watch as fwt
+from . import pipelined as ppl
+from . import retry as rtr
+from . import scheduler as sched
+from . import straggler as stg
+from . import utilities as utl
+
+
+def wait_or_cancel(
+    job_id: str, job_dir: str, n_total: int, crystfel_version: str,
+    silent: bool, scheduler: 'sched.Scheduler' = None,
+    stragglers: 'stg.StragglerSplitter' = None,
+    pipeline: 'ppl.PipelinedFilter' = None,
+    retrier: 'rtr.TaskRetrier' = None
+) -> int:
+    """Monitor slurm jobs and prepare progress bar.
+
+    Parameters
+    ----------
+    job_id : str
+        Id of the slurm job-array / local process.
+    job_dir : str
+        Slurm processing folder.
+    n_total : int
+        Total number of frames to be processed.
+    crystfel_version : str
+        Version of CrystFEL in use.
+    silent : bool
+        Whether to skip updating the progress bar.
+    scheduler : sched.Scheduler, optional
+        Backend the job has been submitted to, by default Slurm.
+    stragglers : stg.StragglerSplitter, optional
+        Re-split the remaining frames of slow tasks into additional jobs,
+        by default None.
+    pipeline : ppl.PipelinedFilter, optional
+        Filter the chunks of the completed tasks for the pipelined second
+        pass, by default None.
+    retrier : rtr.TaskRetrier, optional
+        Resubmit the failed tasks into additional jobs, by default None.
+
+    Returns
+    -------
+    int
+        Total number of processed frames.
+    """
+    if scheduler is None:
+        scheduler = sched.SlurmScheduler()
+    print(f' Waiting for the job-array {job_id}')
+    job_ids = [job_id]
+    log_progress = utl.LogProgress(crystfel_version)
+
+    def job_logs():
+        return [log for j_id in job_ids
+                for log in scheduler.log_files(j_id, job_dir)]
+
+    # Logs are parsed only on changes in the job folder and the scheduler
+    # is queried at most at its capped interval otherwise
+    watcher = fwt.get_watcher(
+        job_dir, max_interval=scheduler.max_query_interval)
+    changed = True
+    try:
+        while True:
+            if retrier is not None:
+                # Also after the last task, which may have failed
+                split_tasks = {} if stragglers is None \
+                    else stragglers.split_tasks
+                retry_jobs = retrier.check(job_ids, set(split_tasks))
+                for log in retrier.failed_logs:
+                    log_progress.forget(log)
+                if retry_jobs:
+                    job_ids += retry_jobs
+                    continue
+            if not (any(scheduler.is_active(j_id) for j_id in job_ids)
+                    or (retrier is not None and retrier.scheduled)):
+                break
+            if changed and not silent:
+                n_proc = utl.calc_progress(
+                    job_logs(), n_total, crystfel_version, log_progress)
+                if stragglers is not None:
+                    n_proc = stragglers.n_processed(log_progress.counts)
+                if n_proc == n_total:
+                    break
+            elif changed and stragglers is not None:
+                log_progress.update(job_logs())
+            if changed and stragglers is not None:
+                job_ids += stragglers.check(job_ids, log_progress.counts)
+            if changed and pipeline is not None:
+                pipeline.check(job_ids)
+            changed = watcher.wait(scheduler.max_query_interval)
+    finally:
+        watcher.close()
+    # To ensure all frames have been processed
+    n_proc = utl.calc_progress(
+        job_logs(), n_total, crystfel_version, log_progress)
+    print()
+    split_tasks = {} if stragglers is None else stragglers.split_tasks
+    if stragglers is not None:
+        n_proc = stragglers.n_processed(log_progress.counts)
+    for j_id in job_ids:
+        failed_tasks = sorted(
+            task for task, state in scheduler.task_states(j_id).items()
+            if state == sched.TASK_FAILED and task not in split_tasks
+            and not (retrier is not None
+                     and retrier.is_superseded(j_id, task))
+        )
+        if failed_tasks:
+            warnings.warn(f"Tasks {failed_tasks} of job {j_id} have failed.")
+    if n_proc < n_total:
+        warnings.warn(
+            f"Not all frames were processed by slurm: {n_proc}/{n_total}.")
+    return n_proc
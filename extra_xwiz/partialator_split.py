@@ -3,7 +3,6 @@ datasets depending on the laser state."""
 
 import json
 import os
-import h5py
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 import multiprocessing as mproc
@@ -14,6 +13,7 @@ import xarray as xr
 from extra_data import open_run
 
 from extra_xwiz import utilities as utl
+from extra_xwiz import vds
 
 ALL_DATASET = "all_data"
 IGNORE_DATASETS = {'unknown', 'ignore'}
@@ -329,13 +329,10 @@ class DatasetSplitter:
             Dictionary with the partialator split parameters.
         """
         self.vds_file = vds_file
-        with h5py.File(self.vds_file, 'r') as vds_f:
-            self.frame_trains = np.array(vds_f['/entry_1/trainId'])
-            if '/entry_1/pulseId' in vds_f:
-                self.frame_pulses = np.array(vds_f['/entry_1/pulseId'])
-            else:
-                self.frame_pulses = np.array(vds_f['/entry_1/memoryCell'])
-            self.n_frames = self.frame_trains.shape[0]
+        metadata = vds.load_metadata(self.vds_file)
+        self.frame_trains = metadata.train_ids
+        self.frame_pulses = metadata.frame_pulses
+        self.n_frames = metadata.n_frames
         self.trains_array = self.get_trains_array()
         self.pulses_array = self.get_pulses_array()
 
@@ -0,0 +1,189 @@
+"""Filter the stream chunks of the first indexamajig pass as soon as their
+tasks complete and feed the matching frames to the second pass."""
+
+from collections import Counter
+from glob import glob
+from typing import Callable, List, Optional
+import warnings
+
+import numpy as np
+
+from . import retry as rtr
+from . import scheduler as sched
+from . import utilities as utl
+from .crystfel_tools import stream_index as sidx
+from .crystfel_tools import stream_stats as sst
+
+
+class PipelinedFilter:
+    """Run the second indexamajig pass in waves on the chunks of the first
+    pass that have completed.
+
+    The streams of every completed task of the first pass are filtered
+    against the reference cell with the match tolerance right away. With
+    the cell refinement, the cell is fitted to the crystals of the first
+    'quorum' of the chunks and fixed for the rest of the pass, otherwise
+    the reference cell is used from the start. Once the cell is fixed, the
+    matching frames are submitted to the second pass by 'submit_wave' as
+    soon as at least 'wave_frames' of them are pending, split into at most
+    'n_tasks' tasks of similar estimated cost.
+    """
+
+    def __init__(
+        self, scheduler: 'sched.Scheduler', job_dir: str, prefix: str,
+        n_chunks: int, cell_file: str, tolerance: float, refine: bool,
+        hits_dir: str, hits_prefix: str, n_tasks: int,
+        submit_wave: Callable[[int, int], str], wave_frames: int = 1000,
+        quorum: float = 0.25
+    ):
+        self.scheduler = scheduler
+        self.job_dir = job_dir
+        self.prefix = prefix
+        self.n_chunks = n_chunks
+        self.cell_file = cell_file
+        self.reference_value = utl.read_reference_cell(cell_file)
+        self.tolerance = tolerance
+        self.refine = refine
+        self.hits_dir = hits_dir
+        self.hits_prefix = hits_prefix
+        self.n_tasks = n_tasks
+        self.submit_wave = submit_wave
+        self.wave_frames = wave_frames
+        self.quorum = quorum
+        self.cell_fixed = not refine
+        self.filtered_chunks = set()
+        self.cell_ensemble = []
+        # Matching frames of all filtered chunks, the ones not submitted
+        # yet and their estimated processing costs
+        self.hits_list = []
+        self.pending_hits = []
+        self.pending_costs = []
+        self.next_task = 0
+        # Ids of the second-pass jobs and their numbers of frames
+        self.job_ids = []
+        self.job_frames = []
+
+    def _chunk_streams(self, task: int) -> List[str]:
+        return sorted(
+            glob(f'{self.job_dir}/{self.prefix}_{task}.stream')
+            + glob(f'{self.job_dir}/{self.prefix}_{task}_*.stream')
+        )
+
+    def _task_finished(self, job_id: str, task: int) -> bool:
+        """Whether the log of the task has the completion marker of the
+        job script, a task completed without it is retried."""
+        log_file = f'{self.job_dir}/{self.scheduler.log_name(job_id, task)}'
+        try:
+            with open(log_file, 'r') as f_log:
+                return rtr.FINISHED_MARKER in f_log.read()
+        except OSError:
+            # Log of a failed attempt renamed by the retrier
+            return False
+
+    def filter_chunk(self, task: int) -> None:
+        """Select the frames with crystals matching the reference cell
+        from the streams of a task."""
+        for stream_file in self._chunk_streams(task):
+            stream_stats = sst.collect_stream_stats(stream_file)
+            in_tolerance = utl.cells_in_tolerance(
+                stream_stats.cell_constants, self.reference_value,
+                self.tolerance)
+            hits = np.array(
+                stream_stats.crystal_events, dtype=str)[in_tolerance]
+            self.cell_ensemble.append(
+                stream_stats.cell_constants[in_tolerance])
+            frame_peaks = dict(zip(
+                stream_stats.crystal_events,
+                stream_stats.crystal_num_peaks.tolist()))
+            frame_crystals = Counter(stream_stats.crystal_events)
+            self.pending_costs.extend(utl.estimate_frame_costs(
+                [frame_peaks[hit] for hit in hits],
+                [frame_crystals[hit] for hit in hits]).tolist())
+            self.hits_list.extend(hits.tolist())
+            self.pending_hits.extend(hits.tolist())
+        self.filtered_chunks.add(task)
+
+    def fix_cell(self) -> None:
+        """Refine the unit cell from the crystals of the filtered chunks."""
+        self.cell_fixed = True
+        ensemble = np.concatenate(self.cell_ensemble or [np.empty((0, 6))])
+        if ensemble.shape[0] == 0:
+            warnings.warn(
+                "No matching crystals to refine the unit cell, keeping the"
+                " reference cell.")
+            return
+        print(f'\n Refining the unit cell from {len(self.filtered_chunks)}'
+              f' of {self.n_chunks} chunks')
+        refined_cell = utl.fit_unit_cell(ensemble)
+        self.cell_file = utl.replace_cell(self.cell_file, refined_cell)
+
+    def submit_pending(self, force: bool = False) -> Optional[str]:
+        """Submit the pending frames as a new wave of the second pass.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Submit the pending frames even if there are less than
+            'wave_frames' of them, by default False.
+
+        Returns
+        -------
+        str
+            Id of the submitted job, None if nothing has been submitted.
+        """
+        n_pending = len(self.pending_hits)
+        if (not self.cell_fixed or n_pending == 0
+                or (n_pending < self.wave_frames and not force)):
+            return None
+        n_tasks = min(self.n_tasks, -(-n_pending // self.wave_frames))
+        split_indices = utl.partition_by_cost(
+            np.array(self.pending_costs), n_tasks)
+        for i_task, sub_indices in enumerate(split_indices):
+            list_file = (f'{self.hits_dir}/{self.hits_prefix}_'
+                         f'{self.next_task + i_task}.lst')
+            with open(list_file, 'w') as f_lst:
+                f_lst.write(''.join(
+                    f'{self.pending_hits[index]}\n' for index in sub_indices))
+        job_id = self.submit_wave(self.next_task, n_tasks)
+        print(f'\n Submitted {n_pending} filtered frames to the second pass'
+              f' as job {job_id}')
+        self.next_task += n_tasks
+        self.job_ids.append(job_id)
+        self.job_frames.append(n_pending)
+        self.pending_hits = []
+        self.pending_costs = []
+        return job_id
+
+    def check(self, job_ids: List[str]) -> None:
+        """Filter the chunks of the first-pass tasks completed with the
+        finished marker in their logs and submit the matching frames.
+
+        Parameters
+        ----------
+        job_ids : List[str]
+            Ids of the first-pass jobs.
+        """
+        for job_id in job_ids:
+            for task, state in self.scheduler.task_states(job_id).items():
+                if (state == sched.TASK_COMPLETED
+                        and task not in self.filtered_chunks
+                        and self._task_finished(job_id, task)):
+                    self.filter_chunk(task)
+        if (not self.cell_fixed
+                and len(self.filtered_chunks) >= self.quorum * self.n_chunks):
+            self.fix_cell()
+        self.submit_pending()
+
+    def finish(self) -> None:
+        """Filter the remaining chunks after the first pass has ended and
+        submit all pending frames."""
+        for task in range(self.n_chunks):
+            if task in self.filtered_chunks:
+                continue
+            # Drop the partial chunks of the interrupted tasks
+            for stream_file in self._chunk_streams(task):
+                sidx.trim_stream(stream_file)
+            self.filter_chunk(task)
+        if not self.cell_fixed:
+            self.fix_cell()
+        self.submit_pending(force=True)
@@ -0,0 +1,155 @@
+"""Find candidate hits in the VDS frames by counting lit pixels, to skip
+the blank frames in the indexamajig runs."""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+import h5py
+import numpy as np
+
+from .frame_selection import FrameSelection
+
+DATA_PATH = '/entry_1/data_1/data'
+
+
+def count_lit_pixels(
+    frames: np.ndarray, good_pixels: Optional[np.ndarray],
+    adu_threshold: float
+) -> np.ndarray:
+    """Count the pixels above the threshold in each frame.
+
+    Parameters
+    ----------
+    frames : np.ndarray
+        Stack of frames, the first axis running over the frames.
+    good_pixels : np.ndarray
+        Boolean mask of the pixels to count, shaped like a frame, None to
+        count all pixels.
+    adu_threshold : float
+        Pixel value threshold of the lit pixels.
+
+    Returns
+    -------
+    np.ndarray
+        Number of lit pixels in each frame.
+    """
+    # NaN (missing data) compares false, so is never lit
+    lit = frames > adu_threshold
+    if good_pixels is not None:
+        lit &= good_pixels
+    return np.count_nonzero(lit.reshape(lit.shape[0], -1), axis=1)
+
+
+def scan_frames(
+    data_file: str, frames: np.ndarray, good_pixels: Optional[np.ndarray],
+    adu_threshold: float, batch_frames: int
+) -> np.ndarray:
+    """Count the lit pixels in the selected frames of a data file, reading
+    the frames batch by batch. The batches are aligned to multiples of
+    'batch_frames', so every batch is one contiguous read.
+
+    Parameters
+    ----------
+    data_file : str
+        Path to the VDS file.
+    frames : np.ndarray
+        Sorted indices of the frames in the file.
+    good_pixels : np.ndarray
+        Boolean mask of the pixels to count, None to count all pixels.
+    adu_threshold : float
+        Pixel value threshold of the lit pixels.
+    batch_frames : int
+        Number of frames in a batch.
+
+    Returns
+    -------
+    np.ndarray
+        Number of lit pixels in each selected frame.
+    """
+    counts = np.zeros(frames.shape[0], dtype=np.int64)
+    batch_bounds = np.flatnonzero(np.diff(frames // batch_frames)) + 1
+    batch_bounds = np.concatenate([[0], batch_bounds, [frames.shape[0]]])
+    with h5py.File(data_file, 'r') as h5file:
+        data = h5file[DATA_PATH]
+        if good_pixels is not None and good_pixels.shape != data.shape[1:]:
+            raise ValueError(
+                f"Pixel mask shape {good_pixels.shape} does not match the "
+                f"frame shape {data.shape[1:]} in {data_file}.")
+        for start, end in zip(batch_bounds[:-1], batch_bounds[1:]):
+            batch = frames[start:end]
+            block = data[batch[0]:batch[-1] + 1]
+            counts[start:end] = count_lit_pixels(
+                block[batch - batch[0]], good_pixels, adu_threshold)
+    return counts
+
+
+def _scan_task(args: Tuple) -> np.ndarray:
+    return scan_frames(*args)
+
+
+def find_hits(
+    frames: FrameSelection, good_pixels: Optional[np.ndarray],
+    adu_threshold: float, min_pixels: int, batch_frames: int = 32,
+    task_frames: int = 2048, n_workers: int = 8
+) -> Tuple[FrameSelection, np.ndarray]:
+    """Select the frames with at least 'min_pixels' lit pixels.
+
+    The frames of every data set are split into tasks of about
+    'task_frames' frames on batch boundaries, which are scanned by a pool
+    of 'n_workers' processes.
+
+    Parameters
+    ----------
+    frames : FrameSelection
+        Frames to scan.
+    good_pixels : np.ndarray
+        Boolean mask of the pixels to count, None to count all pixels.
+    adu_threshold : float
+        Pixel value threshold of the lit pixels.
+    min_pixels : int
+        Minimum number of lit pixels in a candidate hit.
+    batch_frames : int, optional
+        Number of frames read at once, by default 32.
+    task_frames : int, optional
+        Number of frames scanned by a task, by default 2048.
+    n_workers : int, optional
+        Number of worker processes, by default 8.
+
+    Returns
+    -------
+    Tuple[FrameSelection, np.ndarray]
+        Candidate hits, in the order of the input frames, and the number
+        of lit pixels in each input frame (-1 for the entries without an
+        event index).
+    """
+    counts = np.full(len(frames), -1, dtype=np.int64)
+    tasks = []
+    # Positions of the scanned frames of each data set in the selection
+    ds_tasks = []
+    for ids, ds_name in enumerate(frames.ds_names):
+        index = np.flatnonzero(
+            (frames.ds_index == ids) & (frames.frame_index >= 0))
+        if index.shape[0] == 0:
+            continue
+        ds_frames, inverse = np.unique(
+            frames.frame_index[index], return_inverse=True)
+        task_batches = max(task_frames // batch_frames, 1)
+        task_ids = ds_frames // batch_frames // task_batches
+        bounds = np.flatnonzero(np.diff(task_ids)) + 1
+        ds_tasks.append((index, inverse, bounds.shape[0] + 1))
+        for sub_frames in np.split(ds_frames, bounds):
+            tasks.append((
+                ds_name, sub_frames, good_pixels, adu_threshold,
+                batch_frames))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        task_counts = list(executor.map(_scan_task, tasks))
+    i_task = 0
+    for index, inverse, n_tasks in ds_tasks:
+        counts[index] = np.concatenate(
+            task_counts[i_task:i_task + n_tasks])[inverse]
+        i_task += n_tasks
+
+    # Frames without an event index are kept
+    is_hit = (counts >= min_pixels) | (frames.frame_index < 0)
+    return frames.select(is_hit), counts
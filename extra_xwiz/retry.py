@@ -0,0 +1,157 @@
+"""Detect failed tasks of the indexamajig job arrays and resubmit them
+with exponential backoff."""
+
+import os
+import re
+import time
+from typing import Dict, List, Optional, Set
+
+from . import scheduler as sched
+
+FINISHED_MARKER = 'LOG: finished'
+NODE_RE = re.compile(r'LOG: Job started at (\S+)')
+
+
+class TaskRetrier:
+    """Resubmit the failed tasks of a job array.
+
+    A task has failed if the scheduler reports it as failed (e.g. after a
+    node failure, an out-of-memory kill or the time limit), or if it has
+    completed without the 'LOG: finished' marker of the job script in its
+    log. Every failed task is resubmitted alone with the same task index,
+    so it rewrites its stream, at most 'max_retries' times. The n-th retry
+    is submitted 'backoff' * 2**(n-1) seconds after the failure. With
+    'exclude_nodes' the Slurm nodes the task has failed on are excluded
+    from its retries. The log of a failed attempt is renamed with the
+    '.failed' suffix, so its frames are not counted any more.
+    """
+
+    def __init__(
+        self, scheduler: 'sched.Scheduler', job_dir: str, script: str,
+        duration: str, max_retries: int = 3, backoff: float = 60.0,
+        exclude_nodes: bool = False
+    ):
+        self.scheduler = scheduler
+        self.job_dir = job_dir
+        self.script = script
+        self.duration = duration
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.exclude_nodes = exclude_nodes
+        # History of the attempts by the task index
+        self.attempts = {}
+        # Failed tasks waiting for their retry and its due time
+        self.scheduled = {}
+        self.job_ids = []
+        # Original paths of the renamed logs of the failed attempts
+        self.failed_logs = []
+
+    def _log_file(self, job_id: str, task: int) -> str:
+        return f'{self.job_dir}/{self.scheduler.log_name(job_id, task)}'
+
+    def _read_log(self, job_id: str, task: int) -> str:
+        try:
+            with open(self._log_file(job_id, task), 'r') as f_log:
+                return f_log.read()
+        except OSError:
+            return ''
+
+    def _attempt(self, job_id: str, task: int) -> dict:
+        attempts = self.attempts.setdefault(task, [])
+        for attempt in attempts:
+            if attempt['job_id'] == job_id:
+                return attempt
+        attempt = {'job_id': job_id, 'state': None, 'node': None,
+                   'ended': None}
+        attempts.append(attempt)
+        return attempt
+
+    def is_superseded(self, job_id: str, task: int) -> bool:
+        """Whether the task of the job has failed and has been (or will
+        be) retried."""
+        attempts = self.attempts.get(task, [])
+        return any(
+            att['job_id'] == job_id and att['state'] == 'retried'
+            for att in attempts
+        )
+
+    def check(
+        self, job_ids: List[str], skip_tasks: Optional[Set[int]] = None
+    ) -> List[str]:
+        """Record the failed tasks and submit the retries that are due.
+
+        Parameters
+        ----------
+        job_ids : List[str]
+            Ids of all jobs running the tasks.
+        skip_tasks : Set[int], optional
+            Tasks cancelled on purpose, e.g. re-split stragglers, by
+            default None.
+
+        Returns
+        -------
+        List[str]
+            Ids of the newly submitted jobs.
+        """
+        skip_tasks = skip_tasks or set()
+        for job_id in job_ids:
+            for task, state in self.scheduler.task_states(job_id).items():
+                if state in sched.ACTIVE_STATES or task in skip_tasks:
+                    continue
+                attempt = self._attempt(job_id, task)
+                if attempt['state'] is not None:
+                    continue
+                attempt['ended'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                log_text = self._read_log(job_id, task)
+                node = NODE_RE.search(log_text)
+                attempt['node'] = node.group(1) if node else None
+                if (state == sched.TASK_COMPLETED
+                        and FINISHED_MARKER in log_text):
+                    attempt['state'] = state
+                    continue
+                n_failed = sum(
+                    att['state'] == 'retried'
+                    for att in self.attempts[task])
+                if n_failed >= self.max_retries:
+                    attempt['state'] = sched.TASK_FAILED
+                    continue
+                attempt['state'] = 'retried'
+                self.scheduled[task] = (
+                    time.monotonic() + self.backoff * 2 ** n_failed)
+                log_file = self._log_file(job_id, task)
+                if os.path.exists(log_file):
+                    os.rename(log_file, f'{log_file}.failed')
+                    self.failed_logs.append(log_file)
+                print(f'\n Task {task} of job {job_id} has failed, retry '
+                      f'{n_failed + 1}/{self.max_retries} in '
+                      f'{self.backoff * 2 ** n_failed:.0f} s.')
+
+        new_jobs = []
+        now = time.monotonic()
+        for task, due in sorted(self.scheduled.items()):
+            if due > now:
+                continue
+            del self.scheduled[task]
+            extra = {}
+            nodes = sorted({
+                att['node'] for att in self.attempts[task]
+                if att['node'] and att['state'] == 'retried'
+            })
+            if self.exclude_nodes and nodes and self.scheduler.is_slurm:
+                extra['extra_args'] = [f"--exclude={','.join(nodes)}"]
+            job_id = self.scheduler.submit(
+                self.script, self.job_dir, 1, self.duration,
+                first_task=task, **extra)
+            self._attempt(job_id, task)
+            self.job_ids.append(job_id)
+            new_jobs.append(job_id)
+        return new_jobs
+
+    def attempt_history(self) -> Dict[str, List[dict]]:
+        """Attempts of the tasks which have been retried, for the job
+        information in the job folder."""
+        return {
+            str(task): attempts
+            for task, attempts in sorted(self.attempts.items())
+            if len(attempts) > 1
+        }
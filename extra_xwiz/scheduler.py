@@ -0,0 +1,563 @@
+"""Backends to submit and monitor the array jobs of the workflow."""
+
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import partial
+from glob import glob
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, Iterator, List, Sequence
+import warnings
+
+TASK_PENDING = 'PENDING'
+TASK_RUNNING = 'RUNNING'
+TASK_COMPLETED = 'COMPLETED'
+TASK_FAILED = 'FAILED'
+ACTIVE_STATES = {TASK_PENDING, TASK_RUNNING}
+
+# Slurm job states by the respective task states
+SLURM_STATES = {
+    TASK_PENDING: {'PENDING', 'CONFIGURING', 'REQUEUED', 'REQUEUE_HOLD',
+                   'REQUEUE_FED', 'RESV_DEL_HOLD', 'SUSPENDED'},
+    TASK_RUNNING: {'RUNNING', 'COMPLETING', 'STAGE_OUT', 'RESIZING',
+                   'SIGNALING', 'STOPPED'},
+    TASK_COMPLETED: {'COMPLETED'},
+}
+
+
+class Scheduler(ABC):
+    """Interface of the job scheduler backends.
+
+    A job is an array of tasks, each task runs the job script with its
+    index in the 'SLURM_ARRAY_TASK_ID' environment variable and writes
+    its output to a separate log file.
+    """
+
+    # Whether job scripts run under Slurm (and can call 'srun' etc.)
+    is_slurm = False
+    # Longest interval in seconds between job state queries while
+    # nothing changes in the job folder
+    max_query_interval = 5.0
+
+    @abstractmethod
+    def submit(
+        self, script: str, job_dir: str, n_tasks: int, duration: str,
+        first_task: int = 0, after: Sequence[str] = ()
+    ) -> str:
+        """Submit a job array.
+
+        Parameters
+        ----------
+        script : str
+            Name of the job script in the job folder.
+        job_dir : str
+            Job folder, working directory of the tasks.
+        n_tasks : int
+            Number of tasks in the job array.
+        duration : str
+            Time limit of each task, as 'HH:MM:SS'.
+        first_task : int, optional
+            Index of the first task, by default 0.
+        after : Sequence[str], optional
+            Ids of the jobs to complete successfully before the tasks
+            start, the tasks fail if any of them fails, by default none.
+
+        Returns
+        -------
+        str
+            Id of the submitted job.
+        """
+
+    @abstractmethod
+    def task_states(self, job_id: str) -> Dict[int, str]:
+        """Get the states of all tasks of a job.
+
+        Parameters
+        ----------
+        job_id : str
+            Id of the job.
+
+        Returns
+        -------
+        Dict[int, str]
+            Task state ('PENDING', 'RUNNING', 'COMPLETED' or 'FAILED')
+            by the task index.
+        """
+
+    @abstractmethod
+    def cancel(self, job_id: str) -> None:
+        """Cancel all tasks of a job."""
+
+    @abstractmethod
+    def cancel_task(self, job_id: str, task: int) -> None:
+        """Cancel one task of a job."""
+
+    def task_cores(self, n_cores: int) -> int:
+        """Number of cores for the indexamajig instance of each task,
+        given the configured number (negative for all available)."""
+        return n_cores
+
+    def max_task_cores(self, n_cores: int) -> int:
+        """Number of cores the indexamajig instance of each task may use at
+        most, given the configured number (negative for all available)."""
+        n_cores = self.task_cores(n_cores)
+        return n_cores if n_cores > 0 else os.cpu_count()
+
+    @abstractmethod
+    def log_name(self, job_id: str, task: str = '*') -> str:
+        """Name pattern of the task log files."""
+
+    @staticmethod
+    def log_task(log_file: str) -> int:
+        """Task index from the name of a task log file."""
+        return int(os.path.basename(log_file).rsplit('_', 1)[1].split('.')[0])
+
+    def log_files(self, job_id: str, job_dir: str) -> List[str]:
+        """Get paths to the existing log files of a job."""
+        return sorted(glob(f'{job_dir}/{self.log_name(job_id)}'))
+
+    def is_active(self, job_id: str) -> bool:
+        """Whether any task of the job is pending or running."""
+        return any(
+            state in ACTIVE_STATES
+            for state in self.task_states(job_id).values()
+        )
+
+    @contextmanager
+    def detach(self) -> Iterator[None]:
+        """Context to submit jobs which keep running, and start after
+        their dependencies, when the workflow has exited. Backends with
+        their own job queue need nothing else."""
+        yield
+
+
+class SlurmScheduler(Scheduler):
+    """Submit job arrays with 'sbatch' and monitor them with one 'squeue'
+    call per query interval, or 'sacct' once the job has left the queue.
+    """
+
+    is_slurm = True
+    max_query_interval = 120.0
+
+    def __init__(
+        self, partition: str = 'none', reservation: str = 'none',
+        query_interval: float = 30.0
+    ):
+        self.partition = partition
+        self.reservation = reservation
+        self.query_interval = query_interval
+        self._last_query = {}
+        self._last_states = {}
+
+    def submit(
+        self, script: str, job_dir: str, n_tasks: int, duration: str,
+        first_task: int = 0, after: Sequence[str] = (),
+        extra_args: Sequence[str] = ()
+    ) -> str:
+        if self.reservation != "none":
+            partition_string = f"--reservation={self.reservation}"
+        else:
+            partition_string = f"--partition={self.partition}"
+        if after:
+            # Dependent tasks are cancelled by Slurm when a job fails
+            extra_args = [f"--dependency=afterok:{':'.join(after)}",
+                          '--kill-on-invalid-dep=yes', *extra_args]
+        slurm_args = ['sbatch',
+                      f'{partition_string}',
+                      f'--time={duration}',
+                      f'--array={first_task}-{first_task+n_tasks-1}',
+                      *extra_args,
+                      f'./{script}']
+        proc_obj = subprocess.check_output(slurm_args, cwd=job_dir)
+        return proc_obj.decode('utf-8').split()[-1]    # job id
+
+    def task_states(self, job_id: str) -> Dict[int, str]:
+        now = time.monotonic()
+        if now - self._last_query.get(job_id, -self.query_interval) \
+                < self.query_interval:
+            return self._last_states[job_id]
+        self._last_query[job_id] = now
+
+        states = self._query_squeue(job_id)
+        if not states or all(
+            state not in ACTIVE_STATES for state in states.values()
+        ):
+            # Job has left the queue, get the final states from accounting
+            states.update(self._query_sacct(job_id))
+        self._last_states[job_id] = states
+        return states
+
+    def _query_squeue(self, job_id: str) -> Dict[int, str]:
+        try:
+            queue = subprocess.check_output(
+                ['squeue', '--jobs', job_id, '--array', '--noheader',
+                 '--format=%i %T'],
+                stderr=subprocess.DEVNULL
+            )
+        except subprocess.CalledProcessError:
+            # Slurm forgets finished jobs after a while
+            return {}
+        return _parse_slurm_states(queue.decode('utf-8'), ' ')
+
+    def _query_sacct(self, job_id: str) -> Dict[int, str]:
+        try:
+            acct = subprocess.check_output(
+                ['sacct', '--jobs', job_id, '--allocations', '--noheader',
+                 '--parsable2', '--format=JobID,State'],
+                stderr=subprocess.DEVNULL
+            )
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            warnings.warn(f"Could not get accounting data of job {job_id}.")
+            return {}
+        return _parse_slurm_states(acct.decode('utf-8'), '|')
+
+    def cancel(self, job_id: str) -> None:
+        subprocess.call(['scancel', job_id])
+
+    def cancel_task(self, job_id: str, task: int) -> None:
+        subprocess.call(['scancel', f'{job_id}_{task}'])
+
+    def max_task_cores(self, n_cores: int) -> int:
+        if n_cores > 0:
+            return n_cores
+        # All cores of the allocated node, not of the submitting machine
+        if self.reservation != "none":
+            sinfo_args = []
+        else:
+            sinfo_args = [f'--partition={self.partition}']
+        try:
+            node_cpus = subprocess.check_output(
+                ['sinfo', *sinfo_args, '--noheader', '--format=%c'],
+                stderr=subprocess.DEVNULL
+            )
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            node_cpus = b''
+        n_cpus = [
+            int(cpus.rstrip('+')) for cpus in node_cpus.decode('utf-8').split()
+            if cpus.rstrip('+').isdigit()
+        ]
+        if not n_cpus:
+            warnings.warn(
+                f"Could not get the CPUs per node of partition "
+                f"{self.partition}, assuming those of this machine.")
+            return os.cpu_count()
+        return max(n_cpus)
+
+    def log_name(self, job_id: str, task: str = '*') -> str:
+        return f'slurm-{job_id}_{task}.out'
+
+
+def _parse_slurm_states(output: str, separator: str) -> Dict[int, str]:
+    """Parse '<job id>_<task> <state>' lines of squeue or sacct output."""
+    states = {}
+    for line in output.splitlines():
+        items = line.strip().split(separator)
+        if len(items) < 2 or '_' not in items[0]:
+            continue
+        task_str = items[0].split('_', 1)[1]
+        if not task_str.isdigit():
+            # Pending tasks which are not split yet, e.g. '123_[5-9]'
+            task_range = task_str.strip('[]').split('%')[0]
+            first, _, last = task_range.partition('-')
+            if not first.isdigit():
+                continue
+            tasks = range(int(first), int(last or first) + 1)
+        else:
+            tasks = [int(task_str)]
+        slurm_state = items[1].split()[0] if items[1].strip() else ''
+        for state, slurm_states in SLURM_STATES.items():
+            if slurm_state in slurm_states:
+                break
+        else:
+            state = TASK_FAILED
+        for task in tasks:
+            states[task] = state
+    return states
+
+
+class LocalScheduler(Scheduler):
+    """Run the tasks as processes on the local machine, at most
+    'n_workers' of them at the same time. Pending tasks are started on
+    the state queries, or by a runner process for the jobs submitted in
+    the 'detach' context. With 'pin_cpus' the available CPUs are divided
+    into 'n_workers' sets and each running task is pinned to one of them.
+    """
+
+    # Interval in seconds between the state queries of the runner process
+    runner_interval = 1.0
+
+    def __init__(self, n_workers: int = 1, pin_cpus: bool = False):
+        self.n_workers = n_workers
+        self.cpu_sets = None
+        if pin_cpus:
+            cpus = sorted(os.sched_getaffinity(0))
+            n_sets = min(n_workers, len(cpus))
+            self.cpu_sets = [
+                set(cpus[i_set * len(cpus) // n_sets:
+                         (i_set + 1) * len(cpus) // n_sets])
+                for i_set in range(n_sets)
+            ]
+        self._jobs = {}
+        # Ids of the jobs submitted in the 'detach' context
+        self._held = None
+
+    def submit(
+        self, script: str, job_dir: str, n_tasks: int, duration: str,
+        first_task: int = 0, after: Sequence[str] = ()
+    ) -> str:
+        job_id = str(os.getpid() * 1000 + len(self._jobs))
+        self._jobs[job_id] = {
+            'script': script,
+            'job_dir': job_dir,
+            'after': list(after),
+            'pending': list(range(first_task, first_task + n_tasks)),
+            'running': {},
+            'slots': {},
+            'finished': {},
+        }
+        if self._held is None:
+            self._start_tasks(job_id)
+        else:
+            self._held.append(job_id)
+        return job_id
+
+    @contextmanager
+    def detach(self) -> Iterator[None]:
+        """Hold the tasks of the jobs submitted in the context, then hand
+        the jobs over to a runner process in a new session. The runner is
+        the parent of all their tasks, starts them once the jobs they
+        depend on have completed and exits after the last one.
+        """
+        self._held = []
+        try:
+            yield
+            held = {job_id: self._jobs.pop(job_id) for job_id in self._held}
+        finally:
+            self._held = None
+        if not held:
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            # The intermediate process exits right away, the runner is
+            # not left as a zombie of the workflow
+            os.waitpid(pid, 0)
+            return
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                self._jobs = held
+                while any(self.is_active(job_id) for job_id in held):
+                    time.sleep(self.runner_interval)
+        finally:
+            os._exit(0)
+
+    def _start_tasks(self, job_id: str) -> None:
+        job = self._jobs[job_id]
+        for task, proc in list(job['running'].items()):
+            return_code = proc.poll()
+            if return_code is not None:
+                del job['running'][task]
+                del job['slots'][task]
+                job['finished'][task] = TASK_COMPLETED if return_code == 0 \
+                    else TASK_FAILED
+        if job['pending'] and job['after']:
+            after_states = [
+                state for after_id in job['after']
+                for state in self.task_states(after_id).values()
+            ]
+            if TASK_FAILED in after_states:
+                job['finished'].update(
+                    {task: TASK_FAILED for task in job['pending']})
+                job['pending'] = []
+            if not all(state == TASK_COMPLETED for state in after_states):
+                return
+        used_slots = {slot for jb in self._jobs.values()
+                      for slot in jb['slots'].values()}
+        free_slots = [slot for slot in range(self.n_workers)
+                      if slot not in used_slots]
+        while job['pending'] and free_slots:
+            task = job['pending'].pop(0)
+            slot = free_slots.pop(0)
+            env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task))
+            preexec_fn = None
+            if self.cpu_sets is not None:
+                cpu_set = self.cpu_sets[slot % len(self.cpu_sets)]
+                preexec_fn = partial(os.sched_setaffinity, 0, cpu_set)
+            log_file = f"{job['job_dir']}/{self.log_name(job_id, task)}"
+            with open(log_file, 'w') as flog:
+                job['running'][task] = subprocess.Popen(
+                    ['sh', job['script']],
+                    stdin=subprocess.DEVNULL,
+                    stdout=flog, stderr=flog,
+                    cwd=job['job_dir'], env=env, start_new_session=True,
+                    preexec_fn=preexec_fn
+                )
+            job['slots'][task] = slot
+
+    def task_cores(self, n_cores: int) -> int:
+        if n_cores >= 0 or self.cpu_sets is not None:
+            # 'nproc' in the job script respects the CPU pinning
+            return n_cores
+        return max(1, os.cpu_count() // self.n_workers)
+
+    def max_task_cores(self, n_cores: int) -> int:
+        if n_cores <= 0 and self.cpu_sets is not None:
+            return max(len(cpu_set) for cpu_set in self.cpu_sets)
+        return super().max_task_cores(n_cores)
+
+    def task_states(self, job_id: str) -> Dict[int, str]:
+        if job_id not in self._jobs:
+            # Job of an earlier session, its processes are gone
+            return {}
+        self._start_tasks(job_id)
+        job = self._jobs[job_id]
+        states = dict(job['finished'])
+        states.update({task: TASK_RUNNING for task in job['running']})
+        states.update({task: TASK_PENDING for task in job['pending']})
+        return states
+
+    def cancel(self, job_id: str) -> None:
+        job = self._jobs[job_id]
+        job['finished'].update({task: TASK_FAILED for task in job['pending']})
+        job['pending'] = []
+        for proc in job['running'].values():
+            proc.terminate()
+
+    def cancel_task(self, job_id: str, task: int) -> None:
+        job = self._jobs[job_id]
+        if task in job['pending']:
+            job['pending'].remove(task)
+            job['finished'][task] = TASK_FAILED
+        elif task in job['running']:
+            job['running'][task].terminate()
+
+    def log_name(self, job_id: str, task: str = '*') -> str:
+        return f'local-{job_id}_{task}.out'
+
+
+class FakeScheduler(Scheduler):
+    """File-based scheduler for tests and benchmarks without Slurm.
+
+    The task states are stored as files '<job id>_<task>.state' in the
+    state folder and can be set from outside with 'set_task_state'.
+    With 'run_tasks' enabled the job script of every task is executed
+    right at the submission, one task after another, unless the jobs it
+    depends on have not completed yet.
+    """
+
+    def __init__(self, state_dir: str, run_tasks: bool = True):
+        self.state_dir = state_dir
+        self.run_tasks = run_tasks
+        os.makedirs(state_dir, exist_ok=True)
+
+    def submit(
+        self, script: str, job_dir: str, n_tasks: int, duration: str,
+        first_task: int = 0, after: Sequence[str] = ()
+    ) -> str:
+        job_file = f'{self.state_dir}/jobs.json'
+        if os.path.exists(job_file):
+            with open(job_file, 'r') as f_job:
+                jobs = json.load(f_job)
+        else:
+            jobs = {}
+        job_id = str(len(jobs) + 1)
+        jobs[job_id] = {
+            'script': script,
+            'job_dir': os.path.abspath(job_dir),
+            'tasks': [first_task, first_task + n_tasks - 1],
+            'duration': duration,
+            'after': list(after),
+        }
+        with open(job_file, 'w') as f_job:
+            json.dump(jobs, f_job, indent=4)
+
+        tasks = range(first_task, first_task + n_tasks)
+        after_states = [
+            state for after_id in after
+            for state in self.task_states(after_id).values()
+        ]
+        for task in tasks:
+            self.set_task_state(
+                job_id, task,
+                TASK_FAILED if TASK_FAILED in after_states else TASK_PENDING)
+        if TASK_FAILED in after_states or not all(
+                state == TASK_COMPLETED for state in after_states):
+            return job_id
+        if self.run_tasks:
+            for task in tasks:
+                self._run_task(job_id, script, job_dir, task)
+        return job_id
+
+    def _run_task(
+        self, job_id: str, script: str, job_dir: str, task: int
+    ) -> None:
+        self.set_task_state(job_id, task, TASK_RUNNING)
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task))
+        with open(f'{job_dir}/{self.log_name(job_id, task)}', 'w') as flog:
+            return_code = subprocess.call(
+                ['sh', script], stdin=subprocess.DEVNULL,
+                stdout=flog, stderr=flog, cwd=job_dir, env=env
+            )
+        self.set_task_state(
+            job_id, task, TASK_COMPLETED if return_code == 0 else TASK_FAILED)
+
+    def set_task_state(self, job_id: str, task: int, state: str) -> None:
+        """Store a new state of the job task."""
+        with open(f'{self.state_dir}/{job_id}_{task}.state', 'w') as f_st:
+            f_st.write(state)
+
+    def task_states(self, job_id: str) -> Dict[int, str]:
+        states = {}
+        for state_file in glob(f'{self.state_dir}/{job_id}_*.state'):
+            task = os.path.basename(state_file)[:-6].split('_', 1)[1]
+            with open(state_file, 'r') as f_st:
+                states[int(task)] = f_st.read().strip()
+        return states
+
+    def cancel(self, job_id: str) -> None:
+        for task, state in self.task_states(job_id).items():
+            if state in ACTIVE_STATES:
+                self.cancel_task(job_id, task)
+
+    def cancel_task(self, job_id: str, task: int) -> None:
+        self.set_task_state(job_id, task, TASK_FAILED)
+
+    def log_name(self, job_id: str, task: str = '*') -> str:
+        return f'fake-{job_id}_{task}.out'
+
+
+def get_scheduler(
+    partition: str, reservation: str = 'none', n_local_workers: int = 1,
+    pin_cpus: bool = False
+) -> Scheduler:
+    """Choose the scheduler backend for the configured slurm partition:
+    'local' runs the jobs on the local machine and 'fake' with the
+    file-based fake scheduler, any other partition uses Slurm.
+
+    Parameters
+    ----------
+    partition : str
+        Slurm partition from the configuration.
+    reservation : str, optional
+        Slurm reservation from the configuration, by default 'none'.
+    n_local_workers : int, optional
+        Number of concurrent local tasks, by default 1.
+    pin_cpus : bool, optional
+        Whether to pin the local tasks to separate CPU sets, by default
+        False.
+
+    Returns
+    -------
+    Scheduler
+        Scheduler backend.
+    """
+    if partition == 'local':
+        return LocalScheduler(n_local_workers, pin_cpus)
+    elif partition == 'fake':
+        return FakeScheduler('./fake_scheduler')
+    return SlurmScheduler(partition, reservation)
@@ -0,0 +1,200 @@
+"""Content-addressed cache of the workflow stage outputs."""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterable, Optional, Sequence
+import warnings
+
+ENTRY_META = 'entry.json'
+
+
+def file_digest(path: str, block_size: int = 1 << 20) -> str:
+    """SHA-256 digest of the file content, empty string if the file
+    does not exist."""
+    if not os.path.isfile(path):
+        return ''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f_in:
+        for block in iter(lambda: f_in.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def lines_digest(lines: Iterable[str]) -> str:
+    """SHA-256 digest of text lines, e.g. of a frame list."""
+    sha = hashlib.sha256()
+    for line in lines:
+        sha.update(line.encode())
+        sha.update(b'\n')
+    return sha.hexdigest()
+
+
+def file_identity(path: str) -> list:
+    """Path, size and modification time of a (large) data file, standing
+    in for its content."""
+    if not os.path.exists(path):
+        return [path, None, None]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def _path_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(dp, f))
+            for dp, dn, fn in os.walk(path) for f in fn
+        )
+    return os.path.getsize(path)
+
+
+def _copy_path(src: str, dst: str) -> None:
+    if os.path.isdir(src):
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst, symlinks=True)
+    else:
+        if os.path.dirname(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copy2(src, dst)
+
+
+class StageCache:
+    """Outputs of the workflow stages stored in a cache folder under a
+    hash of the stage inputs.
+
+    Every entry is a folder named by the key with copies of the output
+    files or folders and a JSON file with their original paths and
+    additional results of the stage. The least recently used entries are
+    evicted when the cache exceeds 'max_size' bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(
+        stage: str, inputs: Dict[str, Any], files: Iterable[str] = ()
+    ) -> str:
+        """Hash of the stage inputs.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        inputs : Dict[str, Any]
+            JSON-serializable input values, e.g. configuration options,
+            digests of frame lists or keys of the preceding stages.
+        files : Iterable[str], optional
+            Paths to the (small) input files hashed by content, e.g. the
+            geometry and cell files.
+
+        Returns
+        -------
+        str
+            Hexadecimal SHA-256 digest of the inputs.
+        """
+        key_data = {
+            'stage': stage,
+            'inputs': inputs,
+            'files': [[path, file_digest(path)] for path in files],
+        }
+        return hashlib.sha256(json.dumps(
+            key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return f'{self.cache_dir}/{key}'
+
+    def fetch(
+        self, key: str, outputs: Sequence[str]
+    ) -> Optional[Dict[str, Any]]:
+        """Restore the stage outputs from the cache.
+
+        Parameters
+        ----------
+        key : str
+            Hash of the stage inputs.
+        outputs : Sequence[str]
+            Paths to the output files or folders of the stage.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Additional results stored with the outputs, None if there is
+            no complete entry for the key.
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(f'{entry_dir}/{ENTRY_META}', 'r') as f_meta:
+                entry = json.load(f_meta)
+        except (OSError, ValueError):
+            return None
+        if sorted(entry['outputs']) != sorted(outputs):
+            return None
+        for i_out, output in enumerate(entry['outputs']):
+            _copy_path(f'{entry_dir}/{i_out}', output)
+        # Most recently used entries are evicted last
+        os.utime(entry_dir)
+        return entry['results']
+
+    def store(
+        self, key: str, outputs: Sequence[str],
+        results: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Store copies of the stage outputs in the cache and evict the
+        least recently used entries above the size limit.
+
+        Parameters
+        ----------
+        key : str
+            Hash of the stage inputs.
+        outputs : Sequence[str]
+            Paths to the output files or folders of the stage.
+        results : Dict[str, Any], optional
+            Additional JSON-serializable results of the stage, by default
+            None.
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f'{entry_dir}.tmp{os.getpid()}'
+        try:
+            os.makedirs(tmp_dir)
+            for i_out, output in enumerate(outputs):
+                _copy_path(output, f'{tmp_dir}/{i_out}')
+            with open(f'{tmp_dir}/{ENTRY_META}', 'w') as f_meta:
+                json.dump({
+                    'outputs': list(outputs),
+                    'results': results or {},
+                    'size': _path_size(tmp_dir),
+                    'created': time.time(),
+                }, f_meta, indent=4)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as err:
+            warnings.warn(f"Could not store stage outputs in cache: {err}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache size is
+        within the limit."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(name)
+            try:
+                with open(f'{entry_dir}/{ENTRY_META}', 'r') as f_meta:
+                    size = json.load(f_meta)['size']
+                entries.append((os.stat(entry_dir).st_mtime, size, entry_dir))
+            except (OSError, ValueError, KeyError):
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,158 @@
+"""Detect slow tasks of the indexamajig job arrays and re-split their
+remaining frames into new tasks."""
+
+from glob import glob
+from typing import Dict, List
+
+import numpy as np
+
+from . import scheduler as sched
+from .crystfel_tools import stream_index as sidx
+
+
+class StragglerSplitter:
+    """Resubmit the unprocessed frames of straggler tasks.
+
+    Once 'min_done' of the tasks have completed, a running or pending task
+    whose processed fraction of frames is below the mean fraction of all
+    tasks divided by 'factor' is a straggler. Its task is cancelled and
+    the frames of its list file without a chunk in its streams are split
+    into new tasks of the same job script. If the streams omit the
+    non-hits, only the missing frames from 'n_slack' frames (frames in
+    flight in the parallel indexamajig workers) before the processed
+    count on are re-split. Frames still written by the cancelled task are
+    processed twice, so they have to be de-duplicated when the streams
+    are concatenated.
+    """
+
+    def __init__(
+        self, scheduler: 'sched.Scheduler', job_dir: str, script: str,
+        prefix: str, n_tasks: int, duration: str, n_slack: int,
+        factor: float = 2.0, min_done: float = 0.5
+    ):
+        self.scheduler = scheduler
+        self.job_dir = job_dir
+        self.script = script
+        self.prefix = prefix
+        self.duration = duration
+        self.n_slack = n_slack
+        self.factor = factor
+        self.min_done = min_done
+        self.n_tasks = n_tasks
+        self.task_frames = {
+            task: self._count_frames(task) for task in range(n_tasks)}
+        # Number of frames kept from each re-split task
+        self.split_tasks = {}
+        self.next_task = n_tasks
+        # Ids of the jobs running the re-split tasks
+        self.job_ids = []
+
+    def _list_file(self, task: int) -> str:
+        return f'{self.job_dir}/{self.prefix}_{task}.lst'
+
+    def _task_streams(self, task: int) -> List[str]:
+        return sorted(
+            glob(f'{self.job_dir}/{self.prefix}_{task}.stream')
+            + glob(f'{self.job_dir}/{self.prefix}_{task}_*.stream')
+        )
+
+    def _count_frames(self, task: int) -> int:
+        with open(self._list_file(task), 'r') as f_lst:
+            return sum(1 for _ in f_lst)
+
+    def task_progress(
+        self, log_counts: Dict[str, tuple]
+    ) -> Dict[int, int]:
+        """Numbers of processed frames by the task index."""
+        return {
+            self.scheduler.log_task(log): counts[0]
+            for log, counts in log_counts.items()
+        }
+
+    def n_processed(self, log_counts: Dict[str, tuple]) -> int:
+        """Total number of processed frames without the frames repeated
+        by the re-split tasks."""
+        return sum(
+            min(n_proc, self.split_tasks.get(task, n_proc))
+            for task, n_proc in self.task_progress(log_counts).items()
+        )
+
+    def check(
+        self, job_ids: List[str], log_counts: Dict[str, tuple]
+    ) -> List[str]:
+        """Re-split the frames of the straggler tasks.
+
+        Parameters
+        ----------
+        job_ids : List[str]
+            Ids of all jobs running the tasks.
+        log_counts : Dict[str, tuple]
+            Numbers of processed frames and crystals by the log file,
+            as in 'LogProgress.counts'.
+
+        Returns
+        -------
+        List[str]
+            Ids of the newly submitted jobs.
+        """
+        task_jobs = {}
+        task_states = {}
+        for job_id in job_ids:
+            for task, state in self.scheduler.task_states(job_id).items():
+                task_jobs[task] = job_id
+                task_states[task] = state
+        n_done = sum(
+            state == sched.TASK_COMPLETED for state in task_states.values())
+        if n_done == 0 or n_done < self.min_done * len(task_states):
+            return []
+
+        progress = self.task_progress(log_counts)
+        # Only the tasks of the original job are re-split
+        fractions = {
+            task: min(progress.get(task, 0) / max(n_frames, 1), 1.0)
+            for task, n_frames in self.task_frames.items()
+            if task < self.n_tasks and task not in self.split_tasks
+        }
+        mean_fraction = np.mean(list(fractions.values()))
+        new_jobs = []
+        for task, fraction in fractions.items():
+            if task_states.get(task) not in sched.ACTIVE_STATES:
+                continue
+            if fraction * self.factor >= mean_fraction:
+                continue
+            new_job = self._split_task(
+                task_jobs[task], task, progress.get(task, 0), n_done)
+            if new_job is not None:
+                new_jobs.append(new_job)
+        return new_jobs
+
+    def _split_task(
+        self, job_id: str, task: int, n_proc: int, n_parts: int
+    ) -> str:
+        with open(self._list_file(task), 'r') as f_lst:
+            frames = f_lst.read().splitlines()
+        unwritten = sidx.unwritten_frames(
+            frames, self._task_streams(task), max(0, n_proc - self.n_slack))
+        tail = [frames[i_frame] for i_frame in unwritten.tolist()]
+        n_parts = min(n_parts, len(tail) // max(self.n_slack, 1))
+        if n_parts < 1:
+            return None
+
+        self.scheduler.cancel_task(job_id, task)
+        # Frames the cancelled task is accounted for, at most the number
+        # of frames it has processed
+        self.split_tasks[task] = min(len(frames) - len(tail), n_proc)
+        first_task = self.next_task
+        for i_part, part in enumerate(np.array_split(tail, n_parts)):
+            with open(self._list_file(first_task + i_part), 'w') as f_lst:
+                f_lst.write(''.join(f'{frame}\n' for frame in part))
+            self.task_frames[first_task + i_part] = len(part)
+        self.next_task += n_parts
+        print(f'\n Task {task} of job {job_id} is slow: remaining '
+              f'{len(tail)} frames re-split into tasks '
+              f'{first_task}-{first_task + n_parts - 1}.')
+        job_id = self.scheduler.submit(
+            self.script, self.job_dir, n_parts, self.duration,
+            first_task=first_task)
+        self.job_ids.append(job_id)
+        return job_id
@@ -4,6 +4,8 @@ import re
 from typing import TextIO, Any
 import xarray as xr
 
+from .crystfel_tools import stream_stats as sst
+
 
 def config_to_summary(
     sum_file: TextIO, conf: Any, param_key: str=None, indent: int=0
@@ -85,14 +87,13 @@ def report_cell_check(prefix, n_crystals, n_frames):
         )
 
 
-def report_total_rate(prefix, n_frames):
+def report_total_rate(prefix, n_frames, n_cryst=None):
     """Report overall hit rate as ratio between crystals in last stream file
        and total number of frames, as per initial setting.
     """
-    stream_file = f'{prefix}_hits.stream'
-    n_cryst = len(
-        re.findall('Cell parameters', open(stream_file).read(), re.DOTALL)
-    )
+    if n_cryst is None:
+        stream_file = f'{prefix}_hits.stream'
+        n_cryst = sst.collect_stream_stats(stream_file).n_crystals
     indexing_rate = 100.0 * n_cryst / n_frames
     with open(f'{prefix}.summary', 'a') as f:
         f.write(
@@ -59,6 +59,8 @@ proposal = 700000
 runs = [30]
 frames_range = {start = 0, end = -1, step = 1}
 vds_names = ["p700000_r0030_vds.h5"]
+# Number of VDS files of the runs created concurrently
+#vds_workers = 4
 cxi_names = ["p2304_r0108.cxi"]
 list_prefix = "xmpl_30"
 frames_list_file = "none"
@@ -87,6 +89,23 @@ duration_all = "1:00:00"
 n_nodes_all = 10
 #duration_hits = "0:30:00"
 #n_nodes_hits = 4
+# Re-split remaining frames of the tasks slower than the mean by a factor
+#straggler_factor = 2.0
+# Resubmit failed tasks up to max_retries times after retry_backoff seconds,
+# doubled on every retry, optionally excluding the nodes they failed on
+#max_retries = 2
+#retry_backoff = 60
+#retry_exclude_node = true
+# Tasks claim batches of this many frames from a shared queue
+#work_queue_batch = 500
+# Pin the concurrent local tasks (n_nodes_all) to separate CPU sets
+#local_pin_cpus = false
+# Pack several indexamajig instances per Slurm node, pinned with
+# 'taskset' to core ranges or with 'numactl' to NUMA nodes
+#instances_per_node = 2
+#instance_pinning = "numactl"
+# Time limit of the filter and merging jobs of the detached mode
+#duration_stage = "1:00:00"
 
 [indexamajig_run]
 resolution = 4.0
@@ -110,6 +129,11 @@ run_refine = false
 
 [frame_filter]
 match_tolerance = 0.1
+# Filter the chunks of the first run as they complete and start the second
+# run on their frames, with the cell refined from a quorum of the chunks
+#pipelined = true
+#quorum = 0.25
+#wave_frames = 1000
 
 [proc_fine]
 execute = false
@@ -138,16 +162,20 @@ point_group = "422"
 scaling_model = "unity"
 scaling_iterations = 1
 max_adu = 100000
-"""
-
-MAKE_VDS = """\
-#!/bin/sh
 
-extra-data-make-virtual-cxi \\
-  %(DATA_PATH)s \\
-  -o %(VDS_NAME)s \\
-  --fill-value data 0.0 \\
-  --fill-value mask %(MASK_BAD)s
+# Send only the frames with at least min_pixels pixels above adu_threshold
+# (outside the bad regions of the geometry) to indexamajig, VDS data only
+#[prehit]
+#execute = true
+#adu_threshold = 100.0
+#min_pixels = 20
+#batch_frames = 32
+#n_workers = 8
+
+# Reuse the outputs of the workflow stages for the same inputs
+#[cache]
+#dir = "/gpfs/exfel/exp/XMPL/201750/p700000/scratch/xwiz_cache"
+#max_size_gb = 100
 """
 
 PROC_VDS_BASH_SLURM = """\
@@ -176,9 +204,11 @@ fi
 echo "LOG: Using $N_CORES_USE out of $N_CORES_AVAL available cores."
 echo ""
 
-indexamajig \\
-  -i %(PREFIX)s_${SLURM_ARRAY_TASK_ID}.lst \\
-  -o %(PREFIX)s_${SLURM_ARRAY_TASK_ID}.stream \\
+INPUT_LIST=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.lst
+OUTPUT_STREAM=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.stream
+%(INSTANCES_BEGIN)s%(QUEUE_LOOP_BEGIN)s%(INSTANCE_PIN)sindexamajig \\
+  -i $INPUT_LIST \\
+  -o $OUTPUT_STREAM \\
   -g %(GEOM)s %(CRYSTAL)s \\
   -j $N_CORES_USE \\
   --highres=%(RESOLUTION)s \\
@@ -193,7 +223,7 @@ indexamajig \\
   --max-res=%(MAX_RES)s \\
   --min-peaks=%(MIN_PEAKS)s \\
 %(COPY_FIELDS)s  %(EXTRA_OPTIONS)s %(HARVEST_OPTION)s
-
+%(QUEUE_LOOP_END)s%(INSTANCES_END)s
 echo ""
 echo "LOG: finished on $(date +'%%m/%%d/%%Y') at $(date +'%%H:%%M:%%S')."
 """
@@ -217,9 +247,11 @@ fi
 echo "LOG: Using $N_CORES_USE out of $N_CORES_AVAL available cores."
 echo ""
 
-indexamajig \\
-  -i %(PREFIX)s_0.lst \\
-  -o %(PREFIX)s_0.stream \\
+INPUT_LIST=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.lst
+OUTPUT_STREAM=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.stream
+%(QUEUE_LOOP_BEGIN)sindexamajig \\
+  -i $INPUT_LIST \\
+  -o $OUTPUT_STREAM \\
   -g %(GEOM)s %(CRYSTAL)s \\
   -j $N_CORES_USE \\
   --highres=%(RESOLUTION)s \\
@@ -234,12 +266,78 @@ indexamajig \\
   --max-res=%(MAX_RES)s \\
   --min-peaks=%(MIN_PEAKS)s \\
 %(COPY_FIELDS)s  %(EXTRA_OPTIONS)s %(HARVEST_OPTION)s
-
+%(QUEUE_LOOP_END)s
 echo ""
 echo "LOG: finished on $(date +'%%m/%%d/%%Y') at $(date +'%%H:%%M:%%S')."
 """
 
 
+WORK_QUEUE_LOOP_BEGIN = """\
+# Claim batches of frames from the shared work queue until it is empty
+for BATCH in queue/todo/*.lst
+do
+INPUT_LIST="queue/claimed/$(basename $BATCH)"
+mv "$BATCH" "$INPUT_LIST" 2>/dev/null || continue
+OUTPUT_STREAM="%(PREFIX)s_$(basename $BATCH .lst).stream"
+"""
+
+WORK_QUEUE_LOOP_END = """\
+mv "$INPUT_LIST" queue/done/
+done
+"""
+
+INSTANCES_BEGIN = """\
+# Run %(N_INSTANCES)s indexamajig instances, each on its own part of the node
+N_INSTANCES=%(N_INSTANCES)s
+CORE_STRIDE=$((N_CORES_AVAL / N_INSTANCES))
+if [ $CORE_STRIDE -lt 1 ]
+then
+  CORE_STRIDE=1
+fi
+if [ %(CORES)s -lt 0 ]
+then
+  N_CORES_USE=$CORE_STRIDE
+fi
+N_NUMA=$(ls -d /sys/devices/system/node/node[0-9]* 2>/dev/null | wc -l)
+if [ $N_NUMA -lt 1 ]
+then
+  N_NUMA=1
+fi
+echo "LOG: $N_INSTANCES instances with $N_CORES_USE cores each."
+%(SPLIT_LIST)sfor INST in $(seq 0 $((N_INSTANCES - 1)))
+do
+(
+%(INSTANCE_FILES)s"""
+
+INSTANCE_SPLIT_LIST = """\
+mkdir -p instances
+awk -v n=$N_INSTANCES -v t="$(wc -l < $INPUT_LIST)" \\
+  -v base="instances/$(basename $INPUT_LIST .lst)" \\
+  '{print > (base "_" int((NR-1)*n/t) ".lst")}' $INPUT_LIST
+"""
+
+INSTANCE_FILES = """\
+INPUT_LIST="instances/$(basename $INPUT_LIST .lst)_$INST.lst"
+OUTPUT_STREAM=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}_$INST.stream
+[ -s "$INPUT_LIST" ] || exit 0
+"""
+
+# Log lines of every instance are tagged with '[<instance>] '
+INSTANCES_END = """\
+) 2>&1 | sed -u "s/^/[$INST] /" &
+done
+wait
+"""
+
+# Commands pinning an instance to its core range or NUMA node
+INSTANCE_PIN = {
+    'taskset': 'taskset -c $((INST * CORE_STRIDE))-'
+               '$((INST * CORE_STRIDE + CORE_STRIDE - 1)) ',
+    'numactl': 'numactl --cpunodebind=$((INST % N_NUMA)) '
+               '--membind=$((INST % N_NUMA)) ',
+    'none': '',
+}
+
 PROC_CXI_BASH_SLURM = """\
 #!/bin/sh
 unset LD_PRELOAD
@@ -266,9 +364,11 @@ fi
 echo "LOG: Using $N_CORES_USE out of $N_CORES_AVAL available cores."
 echo ""
 
-indexamajig \\
-  -i %(PREFIX)s_${SLURM_ARRAY_TASK_ID}.lst \\
-  -o %(PREFIX)s_${SLURM_ARRAY_TASK_ID}.stream \\
+INPUT_LIST=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.lst
+OUTPUT_STREAM=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.stream
+%(INSTANCES_BEGIN)s%(QUEUE_LOOP_BEGIN)s%(INSTANCE_PIN)sindexamajig \\
+  -i $INPUT_LIST \\
+  -o $OUTPUT_STREAM \\
   -g %(GEOM)s %(CRYSTAL)s \\
   -j $N_CORES_USE \\
   --highres=%(RESOLUTION)s \\
@@ -276,11 +376,53 @@ indexamajig \\
   --hdf5-peaks=%(PEAKS_HDF5_PATH)s \\
   --indexing=%(INDEX_METHOD)s \\
 %(COPY_FIELDS)s  %(EXTRA_OPTIONS)s %(HARVEST_OPTION)s
+%(QUEUE_LOOP_END)s%(INSTANCES_END)s
+echo ""
+echo "LOG: finished on $(date +'%%m/%%d/%%Y') at $(date +'%%H:%%M:%%S')."
+"""
+
+PROC_CXI_BASH_LOCAL = """\
+#!/bin/sh
 
+%(IMPORT_CRYSTFEL)s
+
+echo "LOG: start on $(date +'%%m/%%d/%%Y') at $(date +'%%H:%%M:%%S')."
+echo ""
+indexamajig --version
+echo ""
+N_CORES_USE=%(CORES)s
+N_CORES_AVAL="$(nproc)"
+if [ $N_CORES_USE -lt 0 ]
+then
+  N_CORES_USE=$N_CORES_AVAL
+fi
+echo "LOG: Using $N_CORES_USE out of $N_CORES_AVAL available cores."
+echo ""
+
+INPUT_LIST=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.lst
+OUTPUT_STREAM=%(PREFIX)s_${SLURM_ARRAY_TASK_ID}.stream
+%(QUEUE_LOOP_BEGIN)sindexamajig \\
+  -i $INPUT_LIST \\
+  -o $OUTPUT_STREAM \\
+  -g %(GEOM)s %(CRYSTAL)s \\
+  -j $N_CORES_USE \\
+  --highres=%(RESOLUTION)s \\
+  --peaks=cxi \\
+  --hdf5-peaks=%(PEAKS_HDF5_PATH)s \\
+  --indexing=%(INDEX_METHOD)s \\
+%(COPY_FIELDS)s  %(EXTRA_OPTIONS)s %(HARVEST_OPTION)s
+%(QUEUE_LOOP_END)s
 echo ""
 echo "LOG: finished on $(date +'%%m/%%d/%%Y') at $(date +'%%H:%%M:%%S')."
 """
 
+DETACHED_STAGE_BASH = """\
+#!/bin/sh
+
+echo "LOG: stage '%(STAGE)s' started on $(date +'%%m/%%d/%%Y') at $(date +'%%H:%%M:%%S')."
+%(PYTHON)s -m extra_xwiz.workflow --automatic --stage %(STAGE)s %(OPTIONS)s
+"""
+
 PARTIALATOR_WRAP = """\
 #!/bin/sh
 
@@ -0,0 +1,28 @@
+""" To be used with pytest
+"""
+
+from extra_xwiz import collector
+
+
+def test_write_process_script(tmp_path):
+    conf = {
+        'crystfel': {'version': '0.10.2'},
+        'geom': {'file_path': 'agipd.geom'},
+        'proc_coarse': {
+            'unit_cell': 'hewl.cell_refined', 'peak_method': 'peakfinder8',
+            'peak_threshold': 800, 'peak_min_px': 1, 'peak_max_px': 2,
+            'peak_snr': 5, 'index_method': 'mosflm', 'local_bg_radius': 3,
+            'max_res': 1200, 'min_peaks': 0,
+            'extra_options': '--no-non-hits-in-stream'
+        },
+        'proc_fine': {'resolution': 2.0, 'integration_radii': '2,3,5'},
+    }
+    script = str(tmp_path / "process.sh")
+    collector.write_process_script(conf, script)
+    with open(script, 'r') as f_sh:
+        content = f_sh.read()
+    assert "INPUT_LIST=frames_${SLURM_ARRAY_TASK_ID}.lst\n" in content
+    # Single instance: indexamajig is called directly
+    assert "\nindexamajig \\\n" in content
+    assert "-p hewl.cell_refined" in content
+    assert "%(" not in content
@@ -0,0 +1,394 @@
+""" To be used with pytest
+"""
+
+import io
+import os
+
+import numpy as np
+
+from extra_xwiz.crystfel_tools import crystfel_stream as cstr
+from extra_xwiz.crystfel_tools import stream_index as sidx
+from extra_xwiz.crystfel_tools import stream_stats as sst
+from extra_xwiz import frame_selection as fsel
+from extra_xwiz import pipelined as ppl
+from extra_xwiz import scheduler as sched
+from extra_xwiz import utilities as utl
+
+STREAM_HEADER = """\
+CrystFEL stream format 2.3
+Generated by CrystFEL 0.10.2
+----- Begin geometry file -----
+clen = 0.1200
+----- End geometry file -----
+"""
+
+CHUNK_HIT = """\
+----- Begin chunk -----
+Image filename: p700000_r0030_vds.h5
+Event: //%(EVENT)d
+Image serial number: 1
+hit = 1
+indexed_by = mosflm-latt-nocell
+n_indexing_tries = 1
+photon_energy_eV = 9300.000000
+beam_divergence = 0.00e+00 rad
+beam_bandwidth = 1.00e-08 (fraction)
+average_camera_length = 0.120000 m
+num_peaks = 2
+peak_resolution = 2.500000 nm^-1 or 4.000000 A
+Peaks from peak search
+  fs/px   ss/px (1/d)/nm^-1   Intensity  Panel
+ 100.50  200.25       1.23      1500.00   p0a0
+  10.00   20.00       0.50       800.00   p1a3
+End of peak list
+--- Begin crystal
+Cell parameters 7.90000 7.90000 3.80000 nm, 90.00000 90.00000 90.00000 deg
+astar = +0.1266 +0.0000 +0.0000 nm^-1
+bstar = +0.0000 +0.1266 +0.0000 nm^-1
+cstar = +0.0000 +0.0000 +0.2632 nm^-1
+lattice_type = tetragonal
+centering = P
+unique_axis = c
+profile_radius = 0.00100 nm^-1
+predict_refine/final_residual = 0.123000
+predict_refine/det_shift x = 0.001 y = -0.002 mm
+diffraction_resolution_limit = 2.50 nm^-1 or 4.00 A
+num_reflections = 2
+num_saturated_reflections = 0
+num_implausible_reflections = 0
+Reflections measured after indexing
+   h    k    l          I   sigma(I)       peak background  fs/px  ss/px panel
+   1    0    0     100.00      10.00     150.00       5.00  101.0  201.0 p0a0
+  -1    2    3      50.00       7.00      70.00       3.00   11.0   21.0 p1a3
+End of reflections
+--- End crystal
+----- End chunk -----
+"""
+
+CHUNK_BLANK = """\
+----- Begin chunk -----
+Image filename: p700000_r0030_vds.h5
+Event: //%(EVENT)d
+Image serial number: 2
+hit = 0
+indexed_by = none
+photon_energy_eV = 9300.000000
+num_peaks = 0
+peak_resolution = 0.000000 nm^-1 or 0.000000 A
+Peaks from peak search
+  fs/px   ss/px (1/d)/nm^-1   Intensity  Panel
+End of peak list
+----- End chunk -----
+"""
+
+
+def make_stream(events_hit, events_blank):
+    stream = STREAM_HEADER
+    for event in sorted(events_hit + events_blank):
+        template = CHUNK_HIT if event in events_hit else CHUNK_BLANK
+        stream += template % {'EVENT': event}
+    return stream
+
+
+def test_columnar_reader():
+    stream = make_stream([3, 7], [1, 5])
+    columns = cstr.read_crystfel_stream_columnar(io.StringIO(stream))
+    assert columns.n_chunks == 4
+    assert list(columns.file_names) == ['p700000_r0030_vds.h5']
+    assert list(columns.chunks['event']) == [1, 3, 5, 7]
+    assert list(columns.chunks['hit']) == [0, 1, 0, 1]
+    assert list(columns.chunks['n_crystals']) == [0, 1, 0, 1]
+    assert list(columns.peak_offsets) == [0, 0, 2, 2, 4]
+    assert list(columns.crystal_offsets) == [0, 0, 1, 1, 2]
+    assert list(columns.reflection_offsets) == [0, 2, 4]
+    assert list(columns.peak_chunk_ids()) == [1, 1, 3, 3]
+
+    peaks = columns.chunk_peaks(1)
+    assert np.allclose(peaks['fs'], [100.5, 10.0])
+    assert list(columns.panel_names[peaks['panel_id']]) == ['p0a0', 'p1a3']
+
+    crystal = columns.chunk_crystals(3)[0]
+    assert crystal['chunk'] == 3
+    assert np.allclose(crystal['cell_parameters'], [7.9, 7.9, 3.8, 90, 90, 90])
+    assert np.allclose(crystal['det_shift'], [0.001, -0.002])
+    assert crystal['lattice_type'] == 'tetragonal'
+
+    reflections = columns.crystal_reflections(1)
+    assert list(reflections['h']) == [1, -1]
+    assert np.allclose(reflections['I'], [100.0, 50.0])
+
+
+def test_columnar_matches_dict_reader():
+    stream = make_stream([0, 2], [1])
+    fr_data = cstr.read_crystfel_stream(io.StringIO(stream))
+    columns = cstr.read_crystfel_stream_columnar(io.StringIO(stream))
+    for i_chunk, chunk in enumerate(columns.chunks):
+        fr_dict = fr_data[('p700000_r0030_vds.h5', int(chunk['event']))]
+        assert chunk['hit'] == fr_dict['hit']
+        assert chunk['num_peaks'] == fr_dict['num_peaks']
+        assert len(columns.chunk_peaks(i_chunk)) == len(fr_dict['peaks'])
+        n_crystals = len(fr_dict['crystals'] or [])
+        assert chunk['n_crystals'] == n_crystals
+
+
+def test_find_chunks():
+    stream = make_stream([3, 7], [1, 5])
+    columns = cstr.read_crystfel_stream_columnar(io.StringIO(stream))
+    chunk_ids = columns.find_chunks(
+        ['p700000_r0030_vds.h5'] * 3 + ['other.h5'], [7, 2, 1, 7])
+    assert list(chunk_ids) == [3, -1, 0, -1]
+
+    frames = fsel.FrameSelection(
+        ['other.h5', 'p700000_r0030_vds.h5'], [1, 1, 1, 0], [7, 2, 1, 7])
+    assert list(columns.find_frames(frames)) == [3, -1, 0, -1]
+
+
+def test_chunk_index(tmp_path):
+    stream = make_stream([3, 7], [1, 5])
+    # Interrupted chunk followed by a complete one
+    stream += (CHUNK_HIT % {'EVENT': 9})[:300]
+    stream += CHUNK_BLANK % {'EVENT': 11}
+    stream_file = str(tmp_path / "test.stream")
+    with open(stream_file, 'w') as f_st:
+        f_st.write(stream)
+
+    chunk_index = sidx.get_chunk_index(stream_file)
+    assert chunk_index.n_chunks == 5
+    assert chunk_index.header_end == len(STREAM_HEADER)
+    raw = stream.encode()
+    for begin, end in zip(chunk_index.begin, chunk_index.end):
+        assert raw[begin:end].startswith(sidx.CHUNK_BEGIN)
+        assert raw[begin:end].endswith(sidx.CHUNK_END + b'\n')
+    assert os.path.exists(stream_file + sidx.INDEX_SUFFIX)
+    assert sidx.get_chunk_index(stream_file).matches(stream_file)
+
+    byte_ranges = chunk_index.split_ranges(3)
+    assert byte_ranges[0][0] == chunk_index.begin[0]
+    assert byte_ranges[-1][1] == chunk_index.end[-1]
+
+
+def test_parallel_reader(tmp_path):
+    stream = make_stream(list(range(0, 40, 3)), list(range(1, 40, 3)))
+    stream_file = str(tmp_path / "test.stream")
+    with open(stream_file, 'w') as f_st:
+        f_st.write(stream)
+
+    columns = cstr.read_crystfel_stream_columnar(io.StringIO(stream))
+    columns_par = cstr.read_crystfel_stream_parallel(
+        stream_file, n_processes=2)
+    assert np.array_equal(columns.chunks, columns_par.chunks)
+    assert np.array_equal(columns.peaks, columns_par.peaks)
+    assert np.array_equal(columns.crystal_offsets, columns_par.crystal_offsets)
+    assert np.array_equal(
+        columns.reflection_offsets, columns_par.reflection_offsets)
+    assert np.array_equal(
+        columns.crystals['chunk'], columns_par.crystals['chunk'])
+
+    fr_data = cstr.read_crystfel_stream_parallel(
+        stream_file, n_processes=2, columnar=False)
+    assert fr_data == cstr.read_crystfel_stream(io.StringIO(stream))
+
+
+def test_random_access(tmp_path):
+    stream = make_stream([3, 7], [1, 5])
+    stream_file = str(tmp_path / "test.stream")
+    with open(stream_file, 'w') as f_st:
+        f_st.write(stream)
+
+    vds_file = 'p700000_r0030_vds.h5'
+    chunk_index = sidx.get_chunk_index(stream_file)
+    assert list(chunk_index.event) == [1, 3, 5, 7]
+    assert list(chunk_index.file_names) == [vds_file]
+
+    columns = cstr.read_stream_frames(
+        stream_file, [(vds_file, 7), (vds_file, 4), (vds_file, 1)])
+    assert list(columns.chunks['event']) == [7, 1]
+    assert list(columns.chunks['n_crystals']) == [1, 0]
+
+    sub_stream = str(tmp_path / "sub.stream")
+    n_chunks = cstr.write_sub_stream(
+        stream_file, [(vds_file, 3), (vds_file, 5)], sub_stream)
+    assert n_chunks == 2
+    with open(sub_stream) as f_st:
+        assert f_st.read() == make_stream([3], [5])
+
+    # Index is rebuilt after the stream has been modified
+    with open(stream_file, 'a') as f_st:
+        f_st.write(CHUNK_BLANK % {'EVENT': 9})
+    assert sidx.get_chunk_index(stream_file).n_chunks == 5
+
+
+def test_fields_selection():
+    stream = make_stream([3, 7], [1, 5])
+    columns = cstr.read_crystfel_stream_columnar(
+        io.StringIO(stream), fields=cstr.FIELDS_CHUNKS)
+    assert list(columns.chunks['n_crystals']) == [0, 1, 0, 1]
+    assert list(columns.chunks['num_peaks']) == [0, 2, 0, 2]
+    assert columns.peaks.shape[0] == 0
+    assert columns.crystals.shape[0] == 0
+
+    columns = cstr.read_crystfel_stream_columnar(
+        io.StringIO(stream), fields=cstr.FIELDS_CRYSTALS)
+    assert columns.peaks.shape[0] == 0
+    assert columns.reflections.shape[0] == 0
+    assert list(columns.crystals['chunk']) == [1, 3]
+    assert list(columns.crystals['num_reflections']) == [2, 2]
+
+    fr_data = cstr.read_crystfel_stream(
+        io.StringIO(stream), fields=cstr.FIELDS_CHUNKS)
+    fr_dict = fr_data[('p700000_r0030_vds.h5', 3)]
+    assert fr_dict['peaks'] is None
+    assert len(fr_dict['crystals']) == 1
+    assert fr_dict['crystals'][0]['reflections'] is None
+    assert fr_data[('p700000_r0030_vds.h5', 5)]['crystals'] is None
+
+
+def test_stream_stats(tmp_path):
+    stream = make_stream([3, 7], [1, 5, 9])
+    stream_file = str(tmp_path / "test.stream")
+    with open(stream_file, 'w') as f_st:
+        f_st.write(stream)
+
+    stats = sst.collect_stream_stats(stream_file)
+    assert stats.n_chunks == 5
+    assert stats.n_crystals == 2
+    assert stats.n_hits(0) == 5
+    assert stats.n_hits(2) == 2
+    assert stats.n_hits(3) == 0
+    assert stats.crystal_events == [
+        'p700000_r0030_vds.h5 //3', 'p700000_r0030_vds.h5 //7']
+    assert np.allclose(stats.cell_constants[0], [79, 79, 38, 90, 90, 90])
+    assert list(stats.crystal_num_peaks) == [2, 2]
+
+
+def test_crystal_frames(tmp_path):
+    stream = make_stream([3, 7], [1, 5])
+    # Crystal out of tolerance
+    stream += (CHUNK_HIT % {'EVENT': 9}).replace(
+        'Cell parameters 7.90000', 'Cell parameters 9.90000')
+    stream_file = str(tmp_path / "test.stream")
+    with open(stream_file, 'w') as f_st:
+        f_st.write(stream)
+    cell_file = str(tmp_path / "test.cell")
+    with open(cell_file, 'w') as f_cell:
+        f_cell.write("CrystFEL unit cell file version 1.0\n\n"
+                     "lattice_type = tetragonal\ncentering = P\n"
+                     "a = 80.00 A\nb = 80.00 A\nc = 38.00 A\n"
+                     "al = 90.00 deg\nbe = 90.00 deg\nga = 90.00 deg\n")
+
+    hit_list, cell_ensemble = utl.get_crystal_frames(
+        stream_file, cell_file, 0.05)
+    assert list(hit_list) == [
+        'p700000_r0030_vds.h5 //3', 'p700000_r0030_vds.h5 //7']
+    assert cell_ensemble.shape == (2, 6)
+    assert utl.cell_in_tolerance([79, 79, 38, 90, 90, 90], cell_file, 0.05)
+    assert not utl.cell_in_tolerance(
+        [99, 79, 38, 90, 90, 90], cell_file, 0.05)
+
+
+def test_pipelined_filter(tmp_path):
+    job_dir = tmp_path / "indexamajig_1"
+    hits_dir = tmp_path / "indexamajig_2"
+    job_dir.mkdir()
+    hits_dir.mkdir()
+    for task, events_hit in enumerate([[3, 7], [11], [13]]):
+        with open(job_dir / f"xmpl_{task}.stream", 'w') as f_st:
+            f_st.write(make_stream(events_hit, [task]))
+    cell_file = str(tmp_path / "test.cell")
+    with open(cell_file, 'w') as f_cell:
+        f_cell.write("CrystFEL unit cell file version 1.0\n\n"
+                     "lattice_type = tetragonal\ncentering = P\n"
+                     "a = 80.00 A\nb = 80.00 A\nc = 38.00 A\n"
+                     "al = 90.00 deg\nbe = 90.00 deg\nga = 90.00 deg\n")
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"), run_tasks=False)
+    job_id = scheduler.submit('proc.sh', str(job_dir), 3, '00:10:00')
+    waves = []
+
+    def submit_wave(first_task, n_tasks):
+        waves.append((first_task, n_tasks))
+        return str(len(waves))
+
+    pipeline = ppl.PipelinedFilter(
+        scheduler, str(job_dir), 'xmpl', 3, cell_file, 0.05, False,
+        str(hits_dir), 'xmpl_hits', 2, submit_wave, wave_frames=2)
+    pipeline.check([job_id])
+    assert waves == []
+    scheduler.set_task_state(job_id, 0, sched.TASK_COMPLETED)
+    with open(job_dir / scheduler.log_name(job_id, 0), 'w') as f_log:
+        f_log.write("LOG: finished on 01/01/2024 at 00:00:00.\n")
+    pipeline.check([job_id])
+    assert waves == [(0, 1)]
+    with open(hits_dir / "xmpl_hits_0.lst") as f_lst:
+        assert f_lst.read() == (
+            "p700000_r0030_vds.h5 //3\np700000_r0030_vds.h5 //7\n")
+
+    # A task completed without the finished marker is not filtered yet,
+    # it may still be retried
+    scheduler.set_task_state(job_id, 1, sched.TASK_COMPLETED)
+    with open(job_dir / scheduler.log_name(job_id, 1), 'w') as f_log:
+        f_log.write("LOG: start on 01/01/2024 at 00:00:00.\n")
+    pipeline.check([job_id])
+    assert pipeline.filtered_chunks == {0}
+
+    # Fewer pending frames than a wave until the first pass has ended
+    with open(job_dir / scheduler.log_name(job_id, 1), 'a') as f_log:
+        f_log.write("LOG: finished on 01/01/2024 at 00:01:00.\n")
+    pipeline.check([job_id])
+    assert pipeline.filtered_chunks == {0, 1}
+    assert waves == [(0, 1)]
+    pipeline.finish()
+    assert waves == [(0, 1), (1, 1)]
+    assert pipeline.job_frames == [2, 2]
+    assert len(pipeline.hits_list) == 4
+    with open(hits_dir / "xmpl_hits_1.lst") as f_lst:
+        assert f_lst.read().split() == [
+            "p700000_r0030_vds.h5", "//11", "p700000_r0030_vds.h5", "//13"]
+
+
+def test_concat_streams(tmp_path):
+    streams = [
+        make_stream([3], [1, 5]),
+        # Cancelled task with an incomplete last chunk
+        make_stream([7], [9]) + (CHUNK_HIT % {'EVENT': 11})[:300],
+        # Re-split task repeating some of the frames
+        make_stream([7, 11], [9, 13]),
+    ]
+    stream_files = []
+    for i_st, stream in enumerate(streams):
+        stream_files.append(str(tmp_path / f"test_{i_st}.stream"))
+        with open(stream_files[-1], 'w') as f_st:
+            f_st.write(stream)
+
+    out_file = str(tmp_path / "test.stream")
+    assert cstr.concat_streams(stream_files, out_file) == 7
+    with open(out_file) as f_st:
+        assert f_st.read() == (
+            make_stream([3], [1, 5]) + CHUNK_HIT % {'EVENT': 7}
+            + CHUNK_BLANK % {'EVENT': 9} + CHUNK_HIT % {'EVENT': 11}
+            + CHUNK_BLANK % {'EVENT': 13}
+        )
+
+    # Empty first stream of a task which has never started
+    empty_file = str(tmp_path / "test_empty.stream")
+    open(empty_file, 'w').close()
+    assert cstr.concat_streams([empty_file] + stream_files, out_file) == 7
+    with open(out_file) as f_st:
+        assert f_st.read().startswith(make_stream([3], [1, 5]))
+
+
+def test_unwritten_frames(tmp_path):
+    frames = [f'p700000_r0030_vds.h5 //{i}' for i in range(10)]
+    stream_file = str(tmp_path / "test_0.stream")
+    with open(stream_file, 'w') as f_st:
+        f_st.write(make_stream([2, 5], [0, 1, 3]))
+    np.testing.assert_array_equal(
+        sidx.unwritten_frames(frames, [stream_file], 6),
+        [4, 6, 7, 8, 9])
+
+    # Non-hits omitted: only the frames from min_start on are unwritten
+    with open(stream_file, 'w') as f_st:
+        f_st.write(make_stream([2, 5], []).replace(
+            "CrystFEL 0.10.2\n", "CrystFEL 0.10.2\nCommand line: "
+            "indexamajig --no-non-hits-in-stream\n", 1))
+    np.testing.assert_array_equal(
+        sidx.unwritten_frames(frames, [stream_file], 6), [6, 7, 8, 9])
@@ -0,0 +1,30 @@
+""" To be used with pytest
+"""
+
+import threading
+
+from extra_xwiz import file_watch as fwt
+
+
+def test_polling_watcher(tmp_path):
+    watcher = fwt.PollingWatcher(
+        str(tmp_path), min_interval=0.01, max_interval=0.04)
+    assert not watcher.wait(0.1)
+    assert watcher.interval == 0.04
+
+    (tmp_path / "slurm-1_0.out").write_text("1 images processed\n")
+    assert watcher.wait(0.1)
+    assert watcher.interval == 0.01
+
+
+def test_watcher_wakes_up(tmp_path):
+    watcher = fwt.get_watcher(
+        str(tmp_path), min_interval=0.01, max_interval=10.0)
+    timer = threading.Timer(
+        0.1, (tmp_path / "slurm-1_0.out").write_text, ["started\n"])
+    timer.start()
+    try:
+        assert watcher.wait(5.0)
+    finally:
+        timer.join()
+        watcher.close()
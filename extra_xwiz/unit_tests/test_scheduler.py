@@ -0,0 +1,478 @@
+""" To be used with pytest
+"""
+
+import json
+import os
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from extra_xwiz import checkpoint as ckpt
+from extra_xwiz import frame_selection as fsel
+from extra_xwiz import json_log as jlog
+from extra_xwiz import monitor as mon
+from extra_xwiz import retry as rtr
+from extra_xwiz import scheduler as sched
+from extra_xwiz import straggler as stg
+from extra_xwiz import templates as tmp
+from extra_xwiz import workflow as wf
+
+JOB_SCRIPT = """\
+echo "Final: $((SLURM_ARRAY_TASK_ID + 5)) images processed, 2 hits (40.0%), \
+1 indexable (20.0% of hits), 1 crystals, 2.0 images/sec."
+exit $SLURM_ARRAY_TASK_ID
+"""
+# Stage jobs of the detached workflow which only use the stored state and
+# the frames plan next to it
+DETACHED_STAGE = """\
+%(PYTHON)s -c "
+import json
+import numpy as np
+from extra_xwiz import frame_selection as fsel
+steps = json.load(open('xwiz_detached.json'))['steps']
+frames = fsel.FrameSelection.from_list_file('xmpl_30_frames.lst')
+if '%(STAGE)s' == 'filter':
+    hits = frames.select(np.arange(len(frames)) %% 2 == 0)
+    hits.write_list(steps['indexamajig_hits'][1] + '/xmpl_30_hits_0.lst')
+else:
+    stream = steps['indexamajig_hits'][1] + '/xmpl_30_hits_0.stream'
+    n_hits = open(stream).read().count('Begin chunk')
+    open('merged.hkl', 'w').write(f'{n_hits} of {len(frames)}')
+"
+"""
+# Stand-in for indexamajig writing a stream chunk for every input frame, a
+# 'stop' file in the workflow folder stops it after the first frame
+INDEXAMAJIG = """\
+#!/bin/sh
+if [ "$1" = --version ]; then echo "indexamajig (fake)"; exit 0; fi
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -i) IN=$2 ;;
+    -o) OUT=$2 ;;
+    --harvest-file=*) echo "{}" > "${1#--harvest-file=}" ;;
+  esac
+  shift
+done
+N=0
+echo "CrystFEL stream format 2.3" > "$OUT"
+while read -r FILE EVENT; do
+  printf -- "----- Begin chunk -----\nImage filename: %s\nEvent: %s\n" \
+    "$FILE" "$EVENT" >> "$OUT"
+  echo "----- End chunk -----" >> "$OUT"
+  N=$((N + 1))
+  if [ -e ../stop ]; then break; fi
+done < "$IN"
+echo "Final: $N images processed, 0 hits (0.0%), 0 indexable (0.0% of \
+hits), 0 crystals, 1.0 images/sec."
+"""
+
+
+def test_slurm_states():
+    squeue_out = "123_0 RUNNING\n123_1 COMPLETING\n123_[2-4%2] PENDING\n"
+    states = sched._parse_slurm_states(squeue_out, ' ')
+    assert states == {
+        0: sched.TASK_RUNNING, 1: sched.TASK_RUNNING,
+        2: sched.TASK_PENDING, 3: sched.TASK_PENDING, 4: sched.TASK_PENDING
+    }
+    sacct_out = "123_0|COMPLETED\n123_1|CANCELLED by 1000\n123_2|TIMEOUT\n"
+    states = sched._parse_slurm_states(sacct_out, '|')
+    assert states == {
+        0: sched.TASK_COMPLETED, 1: sched.TASK_FAILED, 2: sched.TASK_FAILED
+    }
+
+
+def test_scheduler_interface():
+    class PartialScheduler(sched.Scheduler):
+        def submit(self, script, job_dir, n_tasks, duration, first_task=0,
+                   after=()):
+            return '1'
+
+    # Backends have to implement all job operations
+    with pytest.raises(TypeError, match="cancel"):
+        PartialScheduler()
+
+
+def test_fake_scheduler(tmp_path):
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write(JOB_SCRIPT)
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"))
+    job_id = scheduler.submit('job.sh', str(tmp_path), 2, '00:10:00')
+    assert scheduler.task_states(job_id) == {
+        0: sched.TASK_COMPLETED, 1: sched.TASK_FAILED}
+    assert not scheduler.is_active(job_id)
+    assert len(scheduler.log_files(job_id, str(tmp_path))) == 2
+
+    n_proc = mon.wait_or_cancel(
+        job_id, str(tmp_path), 11, '0.10.2', silent=True, scheduler=scheduler)
+    assert n_proc == 11
+
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"), run_tasks=False)
+    job_id = scheduler.submit('job.sh', str(tmp_path), 3, '00:10:00')
+    assert job_id == '2'
+    assert scheduler.is_active(job_id)
+    scheduler.set_task_state(job_id, 1, sched.TASK_RUNNING)
+    scheduler.cancel(job_id)
+    assert set(scheduler.task_states(job_id).values()) == {sched.TASK_FAILED}
+
+
+def test_local_scheduler(tmp_path):
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write(JOB_SCRIPT)
+    scheduler = sched.LocalScheduler(n_workers=2)
+    job_id = scheduler.submit('job.sh', str(tmp_path), 3, '00:10:00')
+    while scheduler.is_active(job_id):
+        time.sleep(0.05)
+    assert scheduler.task_states(job_id) == {
+        0: sched.TASK_COMPLETED, 1: sched.TASK_FAILED, 2: sched.TASK_FAILED}
+    assert len(scheduler.log_files(job_id, str(tmp_path))) == 3
+
+
+def test_job_dependencies(tmp_path):
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write(JOB_SCRIPT)
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"))
+    ok_id = scheduler.submit('job.sh', str(tmp_path), 1, '00:10:00')
+    failed_id = scheduler.submit(
+        'job.sh', str(tmp_path), 1, '00:10:00', first_task=1)
+    next_id = scheduler.submit(
+        'job.sh', str(tmp_path), 1, '00:10:00', after=[ok_id])
+    assert scheduler.task_states(next_id) == {0: sched.TASK_COMPLETED}
+    # Tasks depending on a failed job fail without running
+    never_id = scheduler.submit(
+        'job.sh', str(tmp_path), 1, '00:10:00', after=[ok_id, failed_id])
+    assert scheduler.task_states(never_id) == {0: sched.TASK_FAILED}
+    assert scheduler.log_files(never_id, str(tmp_path)) == []
+
+    # The first job runs until it is released by the 'go' file
+    with open(tmp_path / "wait.sh", 'w') as f_job:
+        f_job.write("while [ ! -e go ]; do sleep 0.05; done\n")
+    scheduler = sched.LocalScheduler(n_workers=2)
+    first_id = scheduler.submit('wait.sh', str(tmp_path), 1, '00:10:00')
+    next_id = scheduler.submit(
+        'job.sh', str(tmp_path), 2, '00:10:00', after=[first_id])
+    assert scheduler.task_states(next_id) == {
+        0: sched.TASK_PENDING, 1: sched.TASK_PENDING}
+    (tmp_path / "go").touch()
+    while scheduler.is_active(next_id):
+        time.sleep(0.05)
+    assert scheduler.task_states(next_id) == {
+        0: sched.TASK_COMPLETED, 1: sched.TASK_FAILED}
+
+
+def test_local_scheduler_detached(tmp_path):
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write(JOB_SCRIPT)
+    scheduler = sched.LocalScheduler(n_workers=2)
+    scheduler.runner_interval = 0.05
+    with scheduler.detach():
+        first_id = scheduler.submit('job.sh', str(tmp_path), 1, '00:10:00')
+        next_id = scheduler.submit(
+            'job.sh', str(tmp_path), 2, '00:10:00', after=[first_id])
+    # The jobs are run by the runner process without any state queries
+    assert scheduler.task_states(next_id) == {}
+    log_files = [
+        f"{tmp_path}/{scheduler.log_name(job_id, task)}"
+        for job_id, task in [(first_id, 0), (next_id, 0), (next_id, 1)]
+    ]
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and not all(
+            os.path.exists(log_file) and os.path.getsize(log_file)
+            for log_file in log_files):
+        time.sleep(0.05)
+    with open(log_files[2]) as f_log:
+        assert f_log.read().startswith("Final: 6 images processed")
+
+
+def indexing_workflow(tmp_path, monkeypatch):
+    """Workflow running the real indexamajig job scripts of its steps with
+    the stand-in indexamajig in the fake scheduler."""
+    monkeypatch.chdir(tmp_path)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "indexamajig").write_text(INDEXAMAJIG)
+    (bin_dir / "indexamajig").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    (tmp_path / "hewl.cell").write_text("")
+    (tmp_path / "agipd.geom").write_text("")
+    with h5py.File(tmp_path / "r0030.cxi", 'w') as h5file:
+        h5file['entry_1/trainId'] = np.arange(4)
+
+    workflow = wf.Workflow.__new__(wf.Workflow)
+    workflow.scheduler = sched.FakeScheduler(str(tmp_path / "state"))
+    workflow.crystfel_version = '0.10.2'
+    workflow.json_log = jlog.WorkflowJsonLog(workflow)
+    workflow.json_log.save_crystfel_ver()
+    workflow.cell_file = str(tmp_path / "hewl.cell")
+    workflow.cell_run_refine = False
+    workflow.cell_tolerance = '5,5,5,1.5'
+    workflow.run_proc_fine = True
+    workflow.step = 0
+    workflow.list_prefix = 'xmpl_30'
+    workflow.geometry = 'agipd.geom'
+    workflow.vds_names = ['r0030.cxi']
+    workflow.frames_list = fsel.FrameSelection(
+        ['r0030.cxi'], np.zeros(4), np.arange(4))
+    workflow.res_lower, workflow.res_higher = 4.0, 2.0
+    workflow.n_nodes_all = workflow.n_nodes_hits = 2
+    workflow.duration_all = workflow.duration_hits = '1:00:00'
+    workflow.duration_stage = '0:10:00'
+    workflow.diagnostic = workflow.use_peaks = workflow.use_cheetah = False
+    workflow.resume = workflow.use_pipeline = False
+    workflow.silent = True
+    workflow.pipeline = workflow.stage_cache = None
+    workflow.stage_keys = {}
+    workflow.indexamajig_n_cores = 1
+    workflow.work_queue_batch = 0
+    workflow.instances_per_node = 1
+    workflow.straggler_factor = workflow.max_retries = 0
+    workflow.peak_method, workflow.peak_threshold = 'peakfinder8', 800
+    workflow.peak_min_px, workflow.peak_max_px = 1, 2
+    workflow.peak_snr, workflow.min_peaks = 5, 10
+    workflow.index_method = 'mosflm'
+    workflow.integration_radii = '2,3,5'
+    workflow.local_bg_radius = 3
+    workflow.max_res = 1200
+    workflow.indexamajig_extra_options = ''
+    return workflow
+
+
+def test_detached_workflow(tmp_path, monkeypatch):
+    workflow = indexing_workflow(tmp_path, monkeypatch)
+    monkeypatch.setattr(tmp, 'DETACHED_STAGE_BASH', DETACHED_STAGE)
+    # The stage jobs import the package from this tree
+    package_root = os.path.dirname(os.path.dirname(wf.__file__))
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(
+        filter(None, [package_root, os.environ.get('PYTHONPATH')])))
+    # Task lists of the first step, as written by the frame distribution
+    for task, task_frames in enumerate(workflow.frames_list.split(2)):
+        task_frames.write_list(f"xmpl_30_{task}.lst")
+
+    # The fake scheduler runs every job right at its submission
+    workflow.submit_detached('-p hewl.cell')
+
+    with open(tmp_path / "state" / "jobs.json") as f_jobs:
+        job_ids = list(json.load(f_jobs))
+    assert len(job_ids) == 4
+    for job_id in job_ids:
+        assert set(workflow.scheduler.task_states(job_id).values()) == {
+            sched.TASK_COMPLETED}
+    # Only the task lists moved to the job folder, the stages read the plan
+    assert sorted(
+        lst.name for lst in (tmp_path / "indexamajig_1").glob("*.lst")
+    ) == ['xmpl_30_0.lst', 'xmpl_30_1.lst']
+    assert (tmp_path / "xmpl_30_frames.lst").exists()
+    assert (tmp_path / "merged.hkl").read_text() == "2 of 4"
+    assert workflow.load_detached_state()['steps'] == {
+        'indexamajig_all': [1, './indexamajig_1'],
+        'indexamajig_hits': [2, './indexamajig_2'],
+    }
+
+
+def test_resume_failed_step(tmp_path, monkeypatch):
+    workflow = indexing_workflow(tmp_path, monkeypatch)
+    for task, task_frames in enumerate(workflow.frames_list.split(2)):
+        task_frames.write_list(f"xmpl_30_{task}.lst")
+    assert workflow.wrap_process(workflow.res_lower, '') == 4
+    assert not (tmp_path / "indexamajig_1").exists()
+
+    # The tasks of the second step stop after their first frame
+    (tmp_path / "stop").touch()
+    workflow.hits_list = [f'r0030.cxi //{frame}' for frame in range(4)]
+    for task, task_frames in enumerate(workflow.frames_list.split(2)):
+        task_frames.write_list(f"xmpl_30_hits_{task}.lst")
+    with pytest.warns(UserWarning, match="incomplete"):
+        assert workflow.wrap_process(
+            workflow.res_higher, '', filtered=True) == 2
+    (tmp_path / "stop").unlink()
+
+    workflow.resume = True
+    workflow.step = 0
+    # The complete first step is kept, no new job is submitted for it
+    assert workflow.wrap_process(workflow.res_lower, '') == 4
+    assert workflow.wrap_process(
+        workflow.res_higher, '', filtered=True) == 4
+    with open(tmp_path / "state" / "jobs.json") as f_jobs:
+        jobs = json.load(f_jobs)
+    assert [job['script'] for job in jobs.values()] == [
+        'xmpl_30_proc-1.sh', 'xmpl_30_hits_proc-2.sh',
+        'xmpl_30_hits_proc-2.sh']
+    with open(tmp_path / "xmpl_30_hits.stream") as f_st:
+        assert f_st.read().count("Begin chunk") == 4
+
+
+
+def test_task_retrier(tmp_path):
+    # Tasks fail on their first attempt, task 1 also without the marker
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write(
+            'ATTEMPT=attempt_$SLURM_ARRAY_TASK_ID\n'
+            'if [ ! -e $ATTEMPT ]; then touch $ATTEMPT; exit 1; fi\n'
+            'echo "LOG: Job started at node$SLURM_ARRAY_TASK_ID with"\n'
+            'echo "Final: 5 images processed, 2 hits (40.0%), 1 indexable '
+            '(20.0% of hits), 1 crystals, 2.0 images/sec."\n'
+            'if [ $SLURM_ARRAY_TASK_ID -eq 0 ]; then echo "LOG: finished"; fi\n'
+        )
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"))
+    job_id = scheduler.submit('job.sh', str(tmp_path), 2, '00:10:00')
+    retrier = rtr.TaskRetrier(
+        scheduler, str(tmp_path), 'job.sh', '00:10:00', max_retries=2,
+        backoff=0)
+    n_proc = mon.wait_or_cancel(
+        job_id, str(tmp_path), 10, '0.10.2', silent=True,
+        scheduler=scheduler, retrier=retrier)
+    # Only the frames of the last attempt of every task are counted
+    assert n_proc == 10
+    assert len(retrier.job_ids) == 3
+    history = retrier.attempt_history()
+    assert [att['state'] for att in history['0']] == [
+        'retried', sched.TASK_COMPLETED]
+    assert [att['state'] for att in history['1']] == [
+        'retried', 'retried', sched.TASK_FAILED]
+    assert history['1'][1]['node'] == 'node1'
+    assert os.path.exists(
+        tmp_path / f"{scheduler.log_name(job_id, 1)}.failed")
+
+
+def test_local_scheduler_pinned(tmp_path):
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write("nproc\n")
+    n_cpus = len(os.sched_getaffinity(0))
+    scheduler = sched.LocalScheduler(n_workers=2, pin_cpus=True)
+    assert scheduler.task_cores(4) == 4
+    assert scheduler.task_cores(-1) == -1
+    job_id = scheduler.submit('job.sh', str(tmp_path), 2, '00:10:00')
+    while scheduler.is_active(job_id):
+        time.sleep(0.05)
+    n_task_cpus = []
+    for log_file in scheduler.log_files(job_id, str(tmp_path)):
+        with open(log_file) as f_log:
+            n_task_cpus.append(int(f_log.read()))
+    assert sum(n_task_cpus) == max(n_cpus, 2)
+    assert scheduler.max_task_cores(-1) == max(n_task_cpus)
+
+    scheduler = sched.LocalScheduler(n_workers=2)
+    assert scheduler.task_cores(-1) == max(1, os.cpu_count() // 2)
+    assert scheduler.max_task_cores(-1) == max(1, os.cpu_count() // 2)
+
+
+def test_slurm_task_cores(tmp_path, monkeypatch):
+    # Partition with nodes of 40 and 72 CPUs, the latter 72 in use
+    (tmp_path / "sinfo").write_text('#!/bin/sh\necho "40\n72+"\n')
+    (tmp_path / "sinfo").chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    scheduler = sched.SlurmScheduler('upex')
+    assert scheduler.max_task_cores(16) == 16
+    assert scheduler.max_task_cores(-1) == 72
+
+
+def write_stream(stream_file, events, partial=False):
+    """Stream with a chunk for each event, optionally followed by a
+    partially written chunk."""
+    with open(stream_file, 'w') as f_st:
+        f_st.write("CrystFEL stream format 2.3\n" + "".join(
+            f"----- Begin chunk -----\nImage filename: vds.cxi\n"
+            f"Event: //{event}\n----- End chunk -----\n"
+            for event in events))
+        if partial:
+            f_st.write("----- Begin chunk -----\nImage filename: vds.cxi\n")
+
+
+def test_straggler_splitter(tmp_path):
+    for task in range(3):
+        with open(tmp_path / f"frames_{task}.lst", 'w') as f_lst:
+            f_lst.write(''.join(
+                f'vds.cxi //{task * 100 + i}\n' for i in range(100)))
+    # Frame 205 is held by a stalled indexamajig worker
+    write_stream(tmp_path / "frames_2.stream",
+                 [200 + i for i in range(30) if i != 5], partial=True)
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"), run_tasks=False)
+    job_id = scheduler.submit('job.sh', str(tmp_path), 3, '00:10:00')
+    stragglers = stg.StragglerSplitter(
+        scheduler, str(tmp_path), 'job.sh', 'frames', 3, '00:10:00',
+        n_slack=10)
+    log_counts = {
+        str(tmp_path / scheduler.log_name(job_id, task)): (n_proc, 0)
+        for task, n_proc in enumerate([100, 100, 30])
+    }
+    scheduler.set_task_state(job_id, 0, sched.TASK_COMPLETED)
+    assert stragglers.check([job_id], log_counts) == []
+
+    scheduler.set_task_state(job_id, 1, sched.TASK_COMPLETED)
+    scheduler.set_task_state(job_id, 2, sched.TASK_RUNNING)
+    new_jobs = stragglers.check([job_id], log_counts)
+    assert len(new_jobs) == 1
+    assert scheduler.task_states(job_id)[2] == sched.TASK_FAILED
+    assert scheduler.task_states(new_jobs[0]) == {
+        3: sched.TASK_PENDING, 4: sched.TASK_PENDING}
+    with open(tmp_path / "frames_3.lst") as f_lst:
+        assert f_lst.read().splitlines()[:2] == [
+            'vds.cxi //205', 'vds.cxi //230']
+    assert stragglers.task_frames[3] + stragglers.task_frames[4] == 71
+    assert stragglers.split_tasks[2] == 29
+
+    log_counts[str(tmp_path / scheduler.log_name(new_jobs[0], 3))] = (36, 0)
+    log_counts[str(tmp_path / scheduler.log_name(new_jobs[0], 4))] = (35, 0)
+    assert stragglers.n_processed(log_counts) == 300
+
+
+def test_chunk_manifest(tmp_path):
+    for task in range(3):
+        with open(tmp_path / f"frames_{task}.lst", 'w') as f_lst:
+            f_lst.write(''.join(
+                f'vds.cxi //{task * 10 + i}\n' for i in range(10)))
+    # Frame 12 is held by a stalled indexamajig worker
+    write_stream(tmp_path / "frames_1.stream", [10, 11, 13], partial=True)
+    scheduler = sched.FakeScheduler(str(tmp_path / "state"), run_tasks=False)
+    job_id = scheduler.submit('job.sh', str(tmp_path), 3, '00:10:00')
+    manifest = ckpt.ChunkManifest(
+        str(tmp_path), 'frames', 'job.sh', '00:10:00')
+    manifest.job_ids.append(job_id)
+    for task, n_proc in enumerate([10, 4]):
+        with open(tmp_path / scheduler.log_name(job_id, task), 'w') as f_log:
+            f_log.write(f"Final: {n_proc} images processed, 1 hits (1.0%), "
+                        f"1 indexable (1.0% of hits), 1 crystals, "
+                        f"2.0 images/sec.\n")
+    manifest.update(scheduler, '0.10.2')
+    manifest.save()
+    assert manifest.incomplete_tasks() == [1, 2]
+    assert manifest.n_processed() == 14
+
+    manifest = ckpt.ChunkManifest.load(str(tmp_path))
+    resume_job_id = manifest.resubmit(scheduler, n_slack=2)
+    assert scheduler.task_states(resume_job_id) == {
+        3: sched.TASK_PENDING, 4: sched.TASK_PENDING}
+    with open(tmp_path / "frames_1.stream") as f_st:
+        assert f_st.read().endswith("----- End chunk -----\n")
+    with open(tmp_path / "frames_3.lst") as f_lst:
+        assert f_lst.read().splitlines() == [
+            f'vds.cxi //{i}' for i in [12] + list(range(14, 20))]
+    with open(tmp_path / "frames_4.lst") as f_lst:
+        assert len(f_lst.read().splitlines()) == 10
+    assert manifest.incomplete_tasks() == [3, 4]
+    assert manifest.n_processed() == 13
+
+
+def test_work_queue(tmp_path):
+    for queue_dir in ['todo', 'claimed', 'done']:
+        (tmp_path / "queue" / queue_dir).mkdir(parents=True)
+    for i_batch in range(5):
+        with open(tmp_path / "queue" / "todo" / f"b{i_batch:06d}.lst",
+                  'w') as f_lst:
+            f_lst.write(f'vds.cxi //{i_batch}\n')
+    with open(tmp_path / "job.sh", 'w') as f_job:
+        f_job.write(
+            tmp.WORK_QUEUE_LOOP_BEGIN % {'PREFIX': 'frames'}
+            + 'cat $INPUT_LIST > $OUTPUT_STREAM\n'
+            + tmp.WORK_QUEUE_LOOP_END
+        )
+    scheduler = sched.LocalScheduler(n_workers=3)
+    job_id = scheduler.submit('job.sh', str(tmp_path), 3, '00:10:00')
+    while scheduler.is_active(job_id):
+        time.sleep(0.05)
+    assert len(list((tmp_path / "queue" / "todo").iterdir())) == 0
+    assert len(list((tmp_path / "queue" / "done").iterdir())) == 5
+    for i_batch in range(5):
+        stream = tmp_path / f"frames_b{i_batch:06d}.stream"
+        assert stream.read_text() == f'vds.cxi //{i_batch}\n'
@@ -0,0 +1,237 @@
+""" To be used with pytest
+"""
+
+import json
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from extra_xwiz import frame_selection as fsel
+from extra_xwiz import prehit
+from extra_xwiz import stage_cache as scache
+from extra_xwiz import utilities as utl
+from extra_xwiz import vds
+
+
+def test_log_progress(tmp_path):
+    log_file = str(tmp_path / "slurm-1_0.out")
+    log_progress = utl.LogProgress('0.10.2')
+    with open(log_file, 'w') as f_log:
+        f_log.write("10 images processed, 5 hits (50.0%), 4 indexable "
+                    "(40.0% of hits), 4 crystals, 2.0 images/sec.\n"
+                    "20 images processed, 10 hits (50.0%), 8 indexable ")
+    assert log_progress.update([log_file]) == (10, 4)
+    assert log_progress.offsets[log_file] > 0
+
+    with open(log_file, 'a') as f_log:
+        f_log.write("(40.0% of hits), 9 crystals, 2.0 images/sec.\n"
+                    "Waiting for the last patterns to be processed...\n")
+    assert log_progress.update([log_file]) == (20, 9)
+    # No new lines, cached counts
+    assert log_progress.update([log_file]) == (20, 9)
+
+    with open(log_file, 'a') as f_log:
+        f_log.write("Final: 25 images processed, 12 hits (48.0%), 10 "
+                    "indexable (40.0% of hits), 11 crystals, 2.0 images/sec.\n")
+    missing_log = str(tmp_path / "slurm-1_1.out")
+    assert log_progress.update([log_file, missing_log]) == (25, 11)
+
+
+def test_log_progress_runs(tmp_path):
+    # Several indexamajig runs in one log, as in the work-queue mode
+    log_file = str(tmp_path / "slurm-1_0.out")
+    with open(log_file, 'w') as f_log:
+        for n_images in [10, 20, 5]:
+            f_log.write(f"Final: {n_images} images processed, 2 hits (1.0%), "
+                        f"2 indexable (1.0% of hits), 3 crystals, "
+                        f"2.0 images/sec.\n")
+        f_log.write("4 images processed, 1 hits (25.0%), 1 indexable "
+                    "(100.0% of hits), 1 crystals, 2.0 images/sec.\n")
+    assert utl.LogProgress('0.10.2').update([log_file]) == (39, 10)
+
+
+def test_log_progress_instances(tmp_path):
+    # Interleaved lines of the instances packed on one node
+    log_file = str(tmp_path / "slurm-1_0.out")
+    with open(log_file, 'w') as f_log:
+        f_log.write("LOG: 2 instances with 8 cores each.\n")
+        for inst, n_images in [(0, 10), (1, 4), (0, 20), (1, 12)]:
+            f_log.write(f"[{inst}] {n_images} images processed, 2 hits "
+                        f"(1.0%), 2 indexable (1.0% of hits), {inst + 1} "
+                        f"crystals, 2.0 images/sec.\n")
+    log_progress = utl.LogProgress('0.10.2')
+    assert log_progress.update([log_file]) == (32, 3)
+
+    with open(log_file, 'a') as f_log:
+        f_log.write("[1] Final: 15 images processed, 2 hits (1.0%), 2 "
+                    "indexable (1.0% of hits), 4 crystals, 2.0 images/sec.\n")
+    assert log_progress.update([log_file]) == (35, 5)
+
+
+def test_partition_by_cost():
+    costs = utl.estimate_frame_costs(
+        [0, 500, 0, 0, 100, 0, 0, 0], [0, 2, 0, 0, 1, 0, 0, 0])
+    assert list(costs) == [1, 13, 1, 1, 4, 1, 1, 1]
+    bins = utl.partition_by_cost(costs, 2)
+    assert sorted(np.concatenate(bins).tolist()) == list(range(8))
+    assert [list(items) for items in bins] == [[1], [0, 2, 3, 4, 5, 6, 7]]
+    bins = utl.partition_by_cost(costs, 3)
+    assert [costs[items].sum() for items in bins] == [13, 5, 5]
+
+
+def test_frame_selection(tmp_path):
+    frames = fsel.FrameSelection.from_ranges(
+        ['r0030.cxi', 'r0031.cxi'], [range(0, 6, 2), range(1, 3)])
+    assert len(frames) == 5
+    list_file = str(tmp_path / "frames.lst")
+    frames.write_list(list_file)
+    with open(list_file) as f_lst:
+        assert f_lst.read() == (
+            "r0030.cxi //0\nr0030.cxi //2\nr0030.cxi //4\n"
+            "r0031.cxi //1\nr0031.cxi //2\n")
+
+    parts = fsel.FrameSelection.from_list_file(list_file).split(2)
+    assert [len(part) for part in parts] == [3, 2]
+    assert parts[1].ds_names == ['r0030.cxi', 'r0031.cxi']
+    assert list(parts[1].ds_index) == [1, 1]
+    assert list(parts[1].frame_index) == [1, 2]
+    assert parts[1].digest() != parts[0].digest()
+    assert parts[1].digest() == fsel.FrameSelection.from_ranges(
+        ['r0030.cxi', 'r0031.cxi'], [range(0), range(1, 3)]).digest()
+
+
+def test_scan_cheetah_proc_dir(tmp_path):
+    data_dir = tmp_path / "cheetah"
+    for i_dir, frames_dir in enumerate([[3, 5], [2]]):
+        (data_dir / f"d{i_dir}").mkdir(parents=True)
+        for i_file, n_frames in enumerate(frames_dir):
+            with h5py.File(data_dir / f"d{i_dir}" / f"f{i_file}.h5", 'w') as f:
+                f.create_dataset(
+                    'data/data', shape=(n_frames, 16, 4, 4), dtype=np.float32)
+    # Reading the frame identifiers leaves no files in the input tree
+    utl.get_copy_hdf5_fields(str(data_dir / "d0" / "f0.h5"))
+    assert sorted(os.listdir(data_dir / "d0")) == ['f0.h5', 'f1.h5']
+    # Other files in the tree are not scanned
+    (data_dir / "d1" / "notes.txt").write_text("not HDF5")
+
+    cache_file = str(tmp_path / "scan.json")
+    file_items, n_frames = utl.scan_cheetah_proc_dir(
+        str(data_dir), cache_file, n_threads=2)
+    assert [os.path.relpath(item, data_dir) for item in file_items] == [
+        'd0/f0.h5', 'd0/f1.h5', 'd1/f0.h5']
+    assert list(n_frames) == [3, 5, 2]
+    with open(cache_file) as f_cache:
+        assert json.load(f_cache)[file_items[1]][0] == 5
+
+    with open(cache_file, 'w') as f_cache:
+        json.dump({file_items[1]: [7, os.stat(file_items[1]).st_mtime_ns]},
+                  f_cache)
+    _, n_frames = utl.scan_cheetah_proc_dir(str(data_dir), cache_file)
+    assert list(n_frames) == [3, 7, 2]
+
+
+def test_stage_cache(tmp_path):
+    cell_file = tmp_path / "hewl.cell"
+    cell_file.write_text("a = 79.1 A\n")
+    cache = scache.StageCache(str(tmp_path / "cache"), max_size=100)
+    key = cache.key('merging', {'point_group': '422'}, [str(cell_file)])
+    assert key == cache.key('merging', {'point_group': '422'},
+                            [str(cell_file)])
+    assert key != cache.key('merging', {'point_group': '4'},
+                            [str(cell_file)])
+    cell_file.write_text("a = 79.2 A\n")
+    assert key != cache.key('merging', {'point_group': '422'},
+                            [str(cell_file)])
+
+    out_file = tmp_path / "out.lst"
+    out_dir = tmp_path / "part"
+    out_dir.mkdir()
+    (out_dir / "foms.txt").write_text("x" * 40)
+    outputs = [str(out_file), str(out_dir)]
+    assert cache.fetch(key, outputs) is None
+    out_file.write_text("y" * 40)
+    cache.store(key, outputs, {'n_frames': 5})
+    out_file.unlink()
+    (out_dir / "foms.txt").unlink()
+    assert cache.fetch(key, outputs) == {'n_frames': 5}
+    assert out_file.read_text() == "y" * 40
+    assert (out_dir / "foms.txt").read_text() == "x" * 40
+
+    # The least recently used entry is evicted above the size limit
+    other_key = cache.key('vds', {})
+    os.utime(cache.cache_dir + f"/{key}", (0, 0))
+    cache.store(other_key, [str(out_file)])
+    assert cache.fetch(key, outputs) is None
+    assert cache.fetch(other_key, [str(out_file)]) == {}
+
+
+def test_vds_metadata(tmp_path, monkeypatch):
+    cxi_file = str(tmp_path / "r0001_vds.h5")
+    with h5py.File(cxi_file, 'w') as h5file:
+        h5file.create_dataset('entry_1/data_1/data', shape=(6, 2, 4, 4),
+                              dtype=np.float32)
+        h5file['entry_1/trainId'] = np.repeat([10, 11], 3)
+        h5file['entry_1/pulseId'] = np.tile([0, 4, 8], 2)
+    link = tmp_path / "link.h5"
+    link.symlink_to(cxi_file)
+
+    metadata = vds.load_metadata(str(link))
+    assert not os.path.exists(f"{cxi_file}{vds.SIDECAR_SUFFIX}")
+    metadata = vds.load_metadata(str(link), store=True)
+    assert os.path.exists(f"{cxi_file}{vds.SIDECAR_SUFFIX}")
+    assert metadata.n_frames == 6
+    np.testing.assert_array_equal(metadata.frame_pulses, [0, 4, 8] * 2)
+    assert metadata.memory_cells is None
+    assert metadata.id_fields == ['/entry_1/trainId', '/entry_1/pulseId']
+    assert utl.get_copy_hdf5_fields(cxi_file) == (
+        "  --copy-hdf5-field=/entry_1/trainId \\\n"
+        "  --copy-hdf5-field=/entry_1/pulseId \\\n")
+
+    # Unchanged data file, read from the sidecar file
+    def no_read(cxi_file):
+        raise AssertionError("Data file read")
+    monkeypatch.setattr(vds.FrameMetadata, 'from_cxi', no_read)
+    metadata = vds.load_metadata(cxi_file)
+    np.testing.assert_array_equal(metadata.train_ids, [10] * 3 + [11] * 3)
+    monkeypatch.undo()
+
+    # Stale sidecar file of a modified data file
+    with h5py.File(cxi_file, 'a') as h5file:
+        del h5file['entry_1/data_1/data']
+        h5file.create_dataset('entry_1/data_1/data', shape=(2, 2, 4, 4),
+                              dtype=np.float32)
+        del h5file['entry_1/pulseId']
+        h5file['entry_1/memoryCell'] = [1, 2]
+    os.utime(cxi_file, ns=(0, 1))
+    metadata = vds.load_metadata(cxi_file, store=True)
+    assert metadata.n_frames == 2
+    np.testing.assert_array_equal(metadata.frame_pulses, [1, 2])
+
+
+def test_prehit_find_hits(tmp_path):
+    vds_file = str(tmp_path / "r0001_vds.h5")
+    data = np.zeros((100, 2, 4, 4), dtype=np.float32)
+    data[[3, 40, 41, 97]] = 200.
+    data[5, 1] = 200.
+    data[70] = np.nan
+    with h5py.File(vds_file, 'w') as h5file:
+        h5file['entry_1/data_1/data'] = data
+    good_pixels = np.ones((2, 4, 4), dtype=bool)
+    good_pixels[1] = False
+
+    np.testing.assert_array_equal(
+        prehit.count_lit_pixels(data[[3, 5, 70]], good_pixels, 100.),
+        [16, 0, 0])
+    frames = fsel.FrameSelection.from_ranges(
+        [vds_file, vds_file], [range(0, 100, 1), range(97, 2, -47)])
+    hits, counts = prehit.find_hits(
+        frames, good_pixels, 100., 10, batch_frames=8, task_frames=16,
+        n_workers=2)
+    np.testing.assert_array_equal(hits.frame_index, [3, 40, 41, 97, 97, 3])
+    np.testing.assert_array_equal(hits.ds_index, [0, 0, 0, 0, 1, 1])
+    assert counts[3] == 16 and counts[5] == 0 and counts[-2] == 0
+
+    with pytest.raises(ValueError):
+        prehit.scan_frames(vds_file, np.arange(4), good_pixels[0], 100., 8)
@@ -2,17 +2,16 @@
 
 from ast import Pass
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from functools import wraps
-from getpass import getuser
 from glob import glob
+import heapq
 import json
-import psutil
 import re
 import shutil
-import subprocess
 import os, re, time
-from typing import Any, Type, Tuple, Collection, Callable
+from typing import Any, Type, Tuple, Collection, Callable, Pattern
 import warnings
 
 import h5py
@@ -22,6 +21,8 @@ import toml
 
 # Local imports
 from . import crystfel_info as cri
+from . import vds
+from .crystfel_tools import stream_stats as sst
 
 
 DEFAULT_RANGE = {'start': 0, 'end': -1, 'step': 1}
@@ -113,138 +114,220 @@ def print_crystfel_bar(n_current, n_total, n_crystals, length=80, fill='#'):
     print('\r |%s| %s%%, ◆ %d, Indexing rate: %.1f%%' % (bar, progress,
           n_crystals, index_rate), end='\r')
 
-def calc_progress(out_logs, n_total, crystfel_version):
+# Tag of the log lines written by one of several indexamajig instances
+INSTANCE_TAG_RE = re.compile(r'^\[(\d+)\] ')
+
+
+class LogProgress:
+    """Incremental reader of the indexamajig progress from log files.
+
+    Only the bytes appended to a log since the previous update are parsed,
+    up to the last complete line, with the frames and crystals patterns.
+    The last counts found in every log are cached. Counts of the 'Final:'
+    lines are accumulated, as a log can contain several indexamajig runs.
+    Lines tagged with '[<instance>] ' by the instances packed on a node
+    are counted per instance and summed up for the log.
+    """
+
+    def __init__(self, crystfel_version: str):
+        self.frames_re = re.compile(
+            cri.crystfel_info[crystfel_version]['log_frames_pattern'], re.M)
+        self.crystals_re = re.compile(
+            cri.crystfel_info[crystfel_version]['log_crystals_pattern'], re.M)
+        self.offsets = {}
+        self.counts = {}
+        # Counts from the finished and the current runs of every instance
+        # by the log
+        self._finished = {}
+        self._current = {}
+
+    def update(self, out_logs: Collection[str]) -> Tuple[int, int]:
+        """Parse new lines of the log files.
+
+        Parameters
+        ----------
+        out_logs : Collection[str]
+            Paths to the log files of all processing tasks.
+
+        Returns
+        -------
+        Tuple[int, int]
+            Total numbers of processed frames and found crystals.
+        """
+        for log in out_logs:
+            self._read_new_lines(log)
+        n_frames_total = sum(self.counts[log][0] for log in out_logs
+                             if log in self.counts)
+        n_crystals_total = sum(self.counts[log][1] for log in out_logs
+                               if log in self.counts)
+        return n_frames_total, n_crystals_total
+
+    def forget(self, log: str) -> None:
+        """Drop the counts of a log, e.g. of a failed attempt of a task."""
+        for cache in (self.offsets, self.counts, self._finished,
+                      self._current):
+            cache.pop(log, None)
+
+    def _read_new_lines(self, log: str) -> None:
+        offset = self.offsets.get(log, 0)
+        try:
+            with open(log, 'rb') as f_log:
+                if os.fstat(f_log.fileno()).st_size < offset:
+                    # Log has been rewritten, start over
+                    offset = 0
+                    self.counts.pop(log, None)
+                    self._finished.pop(log, None)
+                    self._current.pop(log, None)
+                f_log.seek(offset)
+                new_bytes = f_log.read()
+        except FileNotFoundError:
+            return
+        last_eol = new_bytes.rfind(b'\n')
+        if last_eol < 0:
+            return
+        self.offsets[log] = offset + last_eol + 1
+        new_text = new_bytes[:last_eol + 1].decode('utf-8', errors='replace')
+
+        if b'] ' in new_bytes:
+            instance_texts = {}
+            for line in new_text.splitlines(keepends=True):
+                match = INSTANCE_TAG_RE.match(line)
+                if match is None:
+                    instance_texts.setdefault(None, []).append(line)
+                else:
+                    instance_texts.setdefault(match.group(1), []).append(
+                        line[match.end():])
+            instance_texts = {
+                instance: ''.join(lines)
+                for instance, lines in instance_texts.items()
+            }
+        else:
+            instance_texts = {None: new_text}
+
+        log_finished = self._finished.setdefault(log, {})
+        log_current = self._current.setdefault(log, {})
+        for instance, text in instance_texts.items():
+            finished = log_finished.setdefault(instance, [0, 0])
+            current = log_current.setdefault(instance, [0, 0])
+            for i_cnt, regex in enumerate([self.frames_re, self.crystals_re]):
+                n_final, n_current = self._parse_counts(regex, text)
+                finished[i_cnt] += n_final
+                if n_current is not None:
+                    current[i_cnt] = n_current
+        self.counts[log] = tuple(
+            sum(finished[i_cnt] + log_current[instance][i_cnt]
+                for instance, finished in log_finished.items())
+            for i_cnt in range(2)
+        )
+
+    @staticmethod
+    def _parse_counts(regex: Pattern, text: str) -> Tuple[int, int]:
+        """Sum of the counts on the 'Final:' lines and the last count after
+        them, None if there is no count in the text."""
+        n_final = 0
+        n_current = None
+        for match in regex.finditer(text):
+            line_start = text.rfind('\n', 0, match.start()) + 1
+            value = int(match.group(2))
+            if 'Final:' in text[line_start:match.end()]:
+                n_final += value
+                n_current = 0
+            else:
+                n_current = value
+        return n_final, n_current
+
+
+def calc_progress(out_logs, n_total, crystfel_version, log_progress=None):
     """ Compare total number of processed frames (from logs) at a given time
         to the overall total number of frames to process.
         In addition collect number of found crystals for display.
+        A 'LogProgress' instance kept between the calls can be provided
+        to parse only newly appended log lines.
     """
-    n_frames = []
-    n_crystals = []
-    for log in out_logs:
-        # extract numbers of frames processed
-        frames_pattern = cri.crystfel_info[crystfel_version] \
-                                          ['log_frames_pattern']
-        frame_info = re.findall(frames_pattern, open(log).read(), re.M)
-        if len(frame_info) == 0:
-            current_n_frames = 0
-        else:
-            current_n_frames = int(frame_info[-1][1])
-        n_frames.append(current_n_frames)
-        # extract numbers of crystals found
-        crystal_pattern = cri.crystfel_info[crystfel_version] \
-                                           ['log_crystals_pattern']
-        crystal_info = re.findall(crystal_pattern, open(log).read(), re.M)
-        if len(crystal_info) == 0:
-            current_n_crystals = 0
-        else:
-            current_n_crystals = int(crystal_info[-1][1])
-        n_crystals.append(current_n_crystals)
-
-    n_frames_total = 0
-    n_crystals_total = 0
-    if len(n_frames) > 0:
-        n_frames_total = sum(n_frames)
-        n_crystals_total = sum(n_crystals)
+    if log_progress is None:
+        log_progress = LogProgress(crystfel_version)
+    n_frames_total, n_crystals_total = log_progress.update(out_logs)
     # Update progress bar
     print_crystfel_bar(n_frames_total, n_total, n_crystals_total, length=50)
 
     return n_frames_total
 
 
-def wait_or_cancel(
-    job_id: str, job_dir: str, n_total: int, crystfel_version: str,
-    silent: bool, is_local:bool
-) -> int:
-    """Monitor slurm jobs and prepare progress bar.
+def read_reference_cell(reference_file):
+    """Read the expected cell constants from a CrystFEL unit-cell or
+    PDB/CRYST1 file.
 
     Parameters
     ----------
-    job_id : str
-        Id of the slurm job-array / local process.
-    job_dir : str
-        Slurm processing folder.
-    n_total : int
-        Total number of frames to be processed.
-    crystfel_version : str
-        Version of CrystFEL in use.
-    silent : bool
-        Whether to skip updating the progress bar.
-    is_local : bool
-        Whether indexamajig is running in local.
+    reference_file : str
+        Path to the reference '.cell' or '.pdb' file.
 
     Returns
     -------
-    int
-        Total number of processed frames.
-    """
-    if is_local:
-        job_type = 'local process'
-        logs_name = 'local_0.out'
-    else:
-        job_type = 'job-array'
-        logs_name = f'slurm-{job_id}_*.out'
-    print(f' Waiting for the {job_type} {job_id}')
-    while True:
-        if is_local:
-            if not psutil.pid_exists(int(job_id)):
-                break
-        else:
-            queue = subprocess.check_output(['squeue', '-u', getuser()])
-            tasks = [x for x in queue.decode('utf-8').split('\n') if job_id in x]
-            if len(tasks) == 0:
-                break
-
-        out_logs = glob(f'{job_dir}/{logs_name}')
-        if not silent:
-            n_proc = calc_progress(out_logs, n_total, crystfel_version)
-            if n_proc == n_total:
-                break
-
-        time.sleep(1)
-    # To ensure all frames have been processed
-    out_logs = glob(f'{job_dir}/{logs_name}')
-    n_proc = calc_progress(out_logs, n_total, crystfel_version)
-    print()
-    if n_proc < n_total:
-        warnings.warn(
-            f"Not all frames were processed by slurm: {n_proc}/{n_total}.")
-    return n_proc
-
-
-def cell_in_tolerance(probe_constants, reference_file, tolerance):
-    """Compare cell constants of one crystal from indexing with expectation
+    np.ndarray
+        Reference cell constants: a, b, c in Å and alpha, beta, gamma
+        in degrees.
     """
     const_names = ['a', 'b', 'c', 'al', 'be', 'ga']
     reference_value = []
     with open(reference_file, 'r') as f:
         if reference_file[-5:] == '.cell':
+            cell_dict = {}
             for ln in f:
                 if ' = ' not in ln:
                     continue
                 if ln.split()[0] in const_names:
-                    reference_value.append(float(ln.split()[2]))
+                    cell_dict[ln.split()[0]] = float(ln.split()[2])
+            reference_value = [cell_dict[name] for name in const_names
+                               if name in cell_dict]
         elif reference_file[-4:] == '.pdb':
             for ln in f:
                 if ln[:6] == 'CRYST1':
                     reference_value = [float(x) for x in ln.split()[1:7]]
         else:
             warnings.warn(' Cell file is of unknown type')
-    for i in range(6):
-        if probe_constants[i] < (1 - tolerance) * reference_value[i]:
-            return False
-        if probe_constants[i] > (1 + tolerance) * reference_value[i]:
-            return False
-    return True
+    return np.array(reference_value, dtype=float)
+
+
+def cells_in_tolerance(cell_constants, reference_value, tolerance):
+    """Compare cell constants of many crystals with expectation at once.
+
+    Parameters
+    ----------
+    cell_constants : np.ndarray
+        (N, 6) array with cell constants of the crystals.
+    reference_value : np.ndarray
+        Expected cell constants, as from 'read_reference_cell'.
+    tolerance : float
+        Allowed relative deviation from the expected constants.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean mask of the crystals with all constants in tolerance.
+    """
+    cell_constants = np.asarray(cell_constants, dtype=float).reshape(-1, 6)
+    lower = (1 - tolerance) * reference_value
+    upper = (1 + tolerance) * reference_value
+    return np.all(
+        (cell_constants >= lower) & (cell_constants <= upper), axis=1)
+
+
+def cell_in_tolerance(probe_constants, reference_file, tolerance):
+    """Compare cell constants of one crystal from indexing with expectation
+    """
+    reference_value = read_reference_cell(reference_file)
+    return bool(
+        cells_in_tolerance(probe_constants, reference_value, tolerance)[0])
 
 
-def get_crystal_frames(stream_file, cell_file, tolerance):
+def get_crystal_frames(stream_file, cell_file, tolerance, stream_stats=None):
     """ Parse stream file after indexamajig run.
         Check crystals of indexed frames; if they match a prior expectation,
-        add event number (frame) and cell constants to respective lists.
+        return events (frames) and cell constants as arrays.
+        Statistics already collected from the stream file can be provided
+        as 'stream_stats' to avoid reading it again.
     """
-    hit_list = []
-    cell_ensemble = []
-
     if cell_file[-5:] == '.cell':
         print(' check against CrystFEL unit-cell format:')
     elif cell_file[-4:] == '.pdb':
@@ -252,31 +335,76 @@ def get_crystal_frames(stream_file, cell_file, tolerance):
     else:
         warnings.warn(' Unit cell file not recognized by extension!')
 
-    with open(stream_file, 'r') as f:
-        for ln in f:
-            if 'Image filename:' in ln:
-                event_fn = ln.split()[-1]   # path to VDS or Cheetah.h5
-            if 'Event:' in ln:
-                event_id = ln.split()[-1]   # includes '//'
-                event = f'{event_fn} {event_id}'
-            if 'Cell parameters' in ln:
-                cell_edges = [(10 * float(x)) for x in ln.split()[2:5]]
-                cell_angles = [float(x) for x in ln.split()[6:9]]
-                cell_constants = cell_edges + cell_angles
-                if not cell_in_tolerance(cell_constants, cell_file, tolerance):
-                    continue
-                cell_ensemble.append(cell_constants)
-                hit_list.append(event)
+    if stream_stats is None:
+        stream_stats = sst.collect_stream_stats(stream_file)
+    reference_value = read_reference_cell(cell_file)
+    in_tolerance = cells_in_tolerance(
+        stream_stats.cell_constants, reference_value, tolerance)
+    hit_list = np.array(stream_stats.crystal_events, dtype=str)[in_tolerance]
+    cell_ensemble = stream_stats.cell_constants[in_tolerance]
     print(len(hit_list), 'frames with (reasonable) crystals found')
     return hit_list, cell_ensemble
 
 
+# Relative processing cost of a frame per peak and per crystal, as
+# compared to a frame without peaks
+FRAME_COST_PER_PEAK = 0.02
+FRAME_COST_PER_CRYSTAL = 1.0
+
+
+def estimate_frame_costs(num_peaks, n_crystals):
+    """Estimate relative indexamajig processing cost of frames from the
+    number of peaks and crystals found in them before.
+
+    Parameters
+    ----------
+    num_peaks : np.ndarray
+        Number of peaks in each frame.
+    n_crystals : np.ndarray
+        Number of crystals in each frame.
+
+    Returns
+    -------
+    np.ndarray
+        Estimated cost of each frame.
+    """
+    return (1.0 + FRAME_COST_PER_PEAK * np.asarray(num_peaks)
+            + FRAME_COST_PER_CRYSTAL * np.asarray(n_crystals))
+
+
+def partition_by_cost(costs, n_bins):
+    """Partition items into bins of similar total cost with the greedy
+    longest-processing-time assignment: the most expensive remaining item
+    goes to the bin with the lowest total cost so far.
+
+    Parameters
+    ----------
+    costs : np.ndarray
+        Cost of each item.
+    n_bins : int
+        Number of bins.
+
+    Returns
+    -------
+    List[np.ndarray]
+        Sorted item indices in each bin.
+    """
+    costs = np.asarray(costs, dtype=float)
+    bin_loads = [(0.0, i_bin) for i_bin in range(n_bins)]
+    bin_items = [[] for _ in range(n_bins)]
+    for item in np.argsort(-costs, kind='stable').tolist():
+        load, i_bin = heapq.heappop(bin_loads)
+        bin_items[i_bin].append(item)
+        heapq.heappush(bin_loads, (load + costs[item], i_bin))
+    return [np.sort(np.array(items, dtype=int)) for items in bin_items]
+
+
 def fit_unit_cell(ensemble):
     """ Loop over separate lists of six unit cell constants, fit each
         assuming a Gaussian distribution of values.
     """
     constant_name = ['a', 'b', 'c', 'alpha', 'beta', 'gamma']
-    distributed_parms = list(zip(*ensemble))
+    distributed_parms = np.asarray(ensemble, dtype=float).reshape(-1, 6).T
     fit_constants = []
     for i in range(6):
         print('Distribution for', constant_name[i])
@@ -354,34 +482,102 @@ def get_refined_cell_name(cell_file):
         return f"{f_name}_refined.{f_ext}"
 
 
-def scan_cheetah_proc_dir(path):
-    """Get all HDF5 file paths/names of a Cheetah-processed run folder by
-       recursion, sample 1% of them for the frame number contained
-       :param path:  HDF5 data path given by config
-       :return:      total number of files, average frame number as per sample
-    """
-    file_items = [os.path.join(dp, f) for dp, dn, fn in os.walk(path) for f in fn]
-    n_files = len(file_items)
-    samples = []
-    n_frames = 0
-    while len(samples) < (n_files // 100):
-        j = np.random.randint(n_files)
-        if j not in samples:
-            with h5py.File(file_items[j], 'r') as f:
-                try:
-                    data = f['data/data'][()]
-                except KeyError:
+CHEETAH_FILE_SUFFIXES = ('.h5', '.cxi')
+
+
+def cheetah_file_frames(file_path):
+    """Get the number of frames in a Cheetah HDF5 file from the shape of
+    its data set, without reading the data.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the Cheetah HDF5 file.
+
+    Returns
+    -------
+    int
+        Number of frames, None if the file content does not stem from
+        Cheetah based on EuXFEL/AGIPD-1M.
+    """
+    with h5py.File(file_path, 'r') as f:
+        try:
+            shape = f['data/data'].shape
+        except KeyError:
+            return None
+    if len(shape) != 4 or shape[1] != 16:
+        return None
+    return shape[0]
+
+
+def scan_cheetah_proc_dir(path, cache_file=None, n_threads=16):
+    """Get all HDF5 file paths ('*.h5' and '*.cxi') of a Cheetah-processed
+    run folder by recursion and the number of frames in each of them from
+    the HDF5 metadata. The files are inspected in a pool of threads and
+    the frame numbers are kept in an optional JSON cache, keyed by file
+    path and checked against the file modification time.
+
+    Parameters
+    ----------
+    path : str
+        HDF5 data path given by config.
+    cache_file : str, optional
+        Path to the JSON file caching {path: [n_frames, mtime]}.
+    n_threads : int, optional
+        Number of threads inspecting the files, by default 16.
+
+    Returns
+    -------
+    Tuple[List[str], np.ndarray]
+        Sorted file paths and the number of frames in each file.
+    """
+    file_items = sorted(
+        os.path.join(dp, f) for dp, dn, fn in os.walk(path) for f in fn
+        if f.endswith(CHEETAH_FILE_SUFFIXES))
+    file_mtimes = [os.stat(item).st_mtime_ns for item in file_items]
+
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f_cache:
+                cache = json.load(f_cache)
+        except (OSError, ValueError):
+            warnings.warn(f"Could not read Cheetah scan cache {cache_file}.")
+
+    n_frames = np.zeros(len(file_items), dtype=np.int64)
+    to_scan = []
+    for i, (item, mtime) in enumerate(zip(file_items, file_mtimes)):
+        cached = cache.get(item)
+        if cached is not None and cached[1] == mtime:
+            n_frames[i] = cached[0]
+        else:
+            to_scan.append(i)
+
+    if to_scan:
+        with ThreadPoolExecutor(n_threads) as executor:
+            scanned = executor.map(
+                cheetah_file_frames, [file_items[i] for i in to_scan])
+            for i, file_frames in zip(to_scan, scanned):
+                if file_frames is None:
                     warnings.warn('The content of your HDF5 data does not seem'
                                   ' to stem from Cheetah based on EuXFEL/'
                                   'AGIPD-1M')
                     exit(0)
-            if len(data.shape) != 4 or data.shape[1] != 16:
-                warnings.warn('The content of your HDF5 data does not seem to'
-                              ' stem from Cheetah based on EuXFEL/AGIPD-1M')
-                exit(0)
-            n_frames += data.shape[0]
-            samples.append(j)
-    return n_files, (n_frames / len(samples))
+                n_frames[i] = file_frames
+
+        if cache_file is not None:
+            cache = {
+                item: [int(file_frames), mtime] for item, file_frames, mtime
+                in zip(file_items, n_frames.tolist(), file_mtimes)
+            }
+            try:
+                with open(cache_file, 'w') as f_cache:
+                    json.dump(cache, f_cache)
+            except OSError:
+                warnings.warn(
+                    f"Could not store Cheetah scan cache {cache_file}.")
+
+    return file_items, n_frames
 
 
 def get_copy_hdf5_fields(cxi_file):
@@ -393,19 +589,12 @@ def get_copy_hdf5_fields(cxi_file):
     Returns:
         string: '--copy-hdf5-field' options for CrystFEL.
     """
-    str_options = ""
-    with h5py.File(cxi_file,'r') as h5file:
-        id_path = ""
-        for path in ['entry_1', 'instrument']:
-            if path in h5file.keys():
-                id_path = f"/{path}"
-        if not id_path:
-            warnings.warn(f"No suitable key in the input data: {cxi_file}.")
-            return ""
-        for id_key in ['trainId', 'pulseId', 'memoryCell']:
-            if id_key in h5file[id_path]:
-                str_options += f"  --copy-hdf5-field={id_path}/{id_key} \\\n"
-    return str_options
+    id_fields = vds.load_metadata(cxi_file).id_fields
+    if not id_fields:
+        warnings.warn(f"No suitable key in the input data: {cxi_file}.")
+        return ""
+    return "".join(
+        f"  --copy-hdf5-field={id_field} \\\n" for id_field in id_fields)
 
 def remove_path(path):
     """
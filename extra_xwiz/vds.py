@@ -0,0 +1,224 @@
+"""Write the virtual CXI files of the runs in-process and keep the frame
+metadata of the data files in compact sidecar files."""
+
+import os
+import time
+from typing import List, Optional
+import warnings
+
+import h5py
+import numpy as np
+
+DATA_PATH = '/entry_1/data_1/data'
+# Groups with the frame identifiers, the last present one is used
+ID_GROUPS = ['entry_1', 'instrument']
+ID_KEYS = ['trainId', 'pulseId', 'memoryCell']
+SIDECAR_SUFFIX = '.meta.npz'
+
+
+class FrameMetadata:
+    """Number of frames and per-frame identifiers of a CXI data file.
+
+    Attributes
+    ----------
+    n_frames : int
+        Number of frames in the CXI data set, None for other files (e.g.
+        Cheetah HDF5 files).
+    train_ids : np.ndarray
+        Train ID of each frame, None if not in the file.
+    pulse_ids : np.ndarray
+        Pulse ID of each frame, None if not in the file.
+    memory_cells : np.ndarray
+        Memory cell of each frame, None if not in the file.
+    id_fields : List[str]
+        HDF5 paths to the frame identifier data sets, to be copied into
+        the CrystFEL streams.
+    """
+
+    def __init__(
+        self, n_frames: Optional[int],
+        train_ids: Optional[np.ndarray] = None,
+        pulse_ids: Optional[np.ndarray] = None,
+        memory_cells: Optional[np.ndarray] = None,
+        id_fields: Optional[List[str]] = None
+    ):
+        self.n_frames = n_frames
+        self.train_ids = train_ids
+        self.pulse_ids = pulse_ids
+        self.memory_cells = memory_cells
+        self.id_fields = list(id_fields or [])
+
+    @property
+    def frame_pulses(self) -> Optional[np.ndarray]:
+        """Pulse IDs of the frames, memory cells for the detectors
+        without pulse IDs (JUNGFRAU)."""
+        if self.pulse_ids is not None:
+            return self.pulse_ids
+        return self.memory_cells
+
+    @classmethod
+    def from_cxi(cls, cxi_file: str) -> 'FrameMetadata':
+        """Read the frame metadata from the CXI data file.
+
+        Parameters
+        ----------
+        cxi_file : str
+            Path to the VDS or Cheetah-CXI file.
+
+        Returns
+        -------
+        FrameMetadata
+            Metadata of the frames in the file.
+        """
+        ids = {}
+        id_fields = []
+        with h5py.File(cxi_file, 'r') as h5file:
+            n_frames = None
+            if DATA_PATH in h5file:
+                n_frames = h5file[DATA_PATH].shape[0]
+            id_path = ''
+            for path in ID_GROUPS:
+                if path in h5file.keys():
+                    id_path = f'/{path}'
+            if id_path:
+                for id_key in ID_KEYS:
+                    if id_key in h5file[id_path]:
+                        ids[id_key] = np.array(h5file[f'{id_path}/{id_key}'])
+                        id_fields.append(f'{id_path}/{id_key}')
+        return cls(
+            n_frames, ids.get('trainId'), ids.get('pulseId'),
+            ids.get('memoryCell'), id_fields)
+
+    @classmethod
+    def load(cls, sidecar_file: str) -> 'FrameMetadata':
+        """Read the frame metadata from a sidecar file."""
+        with np.load(sidecar_file) as sidecar:
+            n_frames = int(sidecar['n_frames'])
+            return cls(
+                None if n_frames < 0 else n_frames,
+                sidecar['trainId'] if 'trainId' in sidecar else None,
+                sidecar['pulseId'] if 'pulseId' in sidecar else None,
+                sidecar['memoryCell'] if 'memoryCell' in sidecar else None,
+                sidecar['id_fields'].tolist()
+            )
+
+    def save(self, sidecar_file: str, identity: List[int]) -> None:
+        """Write the frame metadata to a sidecar file.
+
+        Parameters
+        ----------
+        sidecar_file : str
+            Path to the sidecar file.
+        identity : List[int]
+            Size and modification time of the data file, to detect stale
+            sidecar files.
+        """
+        arrays = {
+            'n_frames': np.int64(
+                -1 if self.n_frames is None else self.n_frames),
+            'identity': np.array(identity, dtype=np.int64),
+            'id_fields': np.array(self.id_fields, dtype=str),
+        }
+        for id_key, values in zip(
+                ID_KEYS,
+                [self.train_ids, self.pulse_ids, self.memory_cells]):
+            if values is not None:
+                arrays[id_key] = values
+        tmp_file = f'{sidecar_file}.tmp{os.getpid()}'
+        with open(tmp_file, 'wb') as f_out:
+            np.savez(f_out, **arrays)
+        os.replace(tmp_file, sidecar_file)
+
+
+def sidecar_path(data_file: str) -> str:
+    """Path to the metadata sidecar file, next to the data file (also if
+    the data file is referred to by a link)."""
+    return f'{os.path.realpath(data_file)}{SIDECAR_SUFFIX}'
+
+
+def _file_identity(data_file: str) -> List[int]:
+    stat = os.stat(data_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_metadata(data_file: str, store: bool = False) -> FrameMetadata:
+    """Get the frame metadata of a CXI data file from its sidecar file.
+    Without an up-to-date sidecar file the metadata are read from the data
+    file and, with 'store', stored in a new sidecar file.
+
+    Parameters
+    ----------
+    data_file : str
+        Path to the VDS or Cheetah-CXI file.
+    store : bool, optional
+        Write the sidecar file next to the data file, only for the data
+        files of the workflow (VDS), not for the input data trees, by
+        default False.
+
+    Returns
+    -------
+    FrameMetadata
+        Metadata of the frames in the data file.
+    """
+    sidecar_file = sidecar_path(data_file)
+    identity = _file_identity(data_file)
+    try:
+        with np.load(sidecar_file) as sidecar:
+            up_to_date = sidecar['identity'].tolist() == identity
+        if up_to_date:
+            return FrameMetadata.load(sidecar_file)
+    except (OSError, ValueError, KeyError):
+        pass
+    metadata = FrameMetadata.from_cxi(data_file)
+    if not store:
+        return metadata
+    try:
+        metadata.save(sidecar_file, identity)
+    except OSError as err:
+        warnings.warn(f"Could not store frame metadata of {data_file}: {err}")
+    return metadata
+
+
+def write_virtual_cxi(
+    run_path: str, vds_file: str, mask_bad: int
+) -> float:
+    """Write the virtual CXI file of the detector data in a run folder
+    together with its metadata sidecar file, like
+    'extra-data-make-virtual-cxi' does, but without starting a new
+    interpreter.
+
+    Parameters
+    ----------
+    run_path : str
+        Path to the run folder with the corrected detector data.
+    vds_file : str
+        Path to the VDS file to write.
+    mask_bad : int
+        Fill value of the mask for the missing data, the bad-pixel mask
+        value from the geometry file.
+
+    Returns
+    -------
+    float
+        Time in seconds it took to write the files.
+    """
+    from extra_data import RunDirectory
+    from extra_data.components import identify_multimod_detectors
+
+    start_time = time.monotonic()
+    run = RunDirectory(os.path.abspath(run_path))
+    _, det_class = identify_multimod_detectors(run, single=True)
+    kwargs = {}
+    n_modules = det_class.n_modules
+    if n_modules == 0:
+        # Number of JUNGFRAU modules is taken from the data
+        n_modules = None
+        kwargs['n_modules'] = n_modules
+    min_modules = 1 if n_modules is None else n_modules // 2 + 1
+    detector = det_class(run, min_modules=min_modules, **kwargs)
+    detector.write_virtual_cxi(vds_file, {'data': 0.0, 'mask': mask_bad})
+
+    # The identifiers are plain data sets in the file just written
+    metadata = FrameMetadata.from_cxi(vds_file)
+    metadata.save(sidecar_path(vds_file), _file_identity(vds_file))
+    return time.monotonic() - start_time
@@ -1,35 +1,54 @@
 from argparse import ArgumentParser
-import fileinput
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
-import h5py
+import json
 import numpy as np
 import os
 import re
 import shutil
 import subprocess
+import sys
+import time
 import warnings
 import xarray as xr
 
 import findxfel as fdx
 
+from . import checkpoint as ckpt
 from . import config
 from . import crystfel_info as cri
-from . import crystfel_utilities as cru
+from . import frame_selection as fsel
 from . import geometry as geo
 from . import json_log as jlog
+from . import monitor as mon
 from . import partialator_split as pspl
+from . import pipelined as ppl
+from . import prehit
+from . import retry as rtr
+from . import scheduler as sched
+from . import stage_cache as scache
+from . import straggler as stg
 from . import templates as tmp
 from . import utilities as utl
+from . import vds
 from . import summary as smr
 
 from .crystfel_tools import crystfel_stream as cstr
+from .crystfel_tools import stream_index as sidx
+from .crystfel_tools import stream_stats as sst
+
+
+# State shared by the stage jobs of the detached workflow
+DETACHED_STATE_FILE = 'xwiz_detached.json'
 
 
 class Workflow:
 
     def __init__(self, work_dir, self_dir, automatic=False,
                  diagnostic=False, silent=False, reprocess=False,
-                 use_peaks=False, use_cheetah=False):
+                 use_peaks=False, use_cheetah=False, resume=False,
+                 detached=False):
         """Construct a workflow instance from the pre-defined configuration.
            Initialize some class-global 'bookkeeping' variables
         """
@@ -39,6 +58,8 @@ class Workflow:
         self.diagnostic = diagnostic
         self.silent = silent
         self.reprocess = reprocess
+        self.resume = resume
+        self.detached = detached
         self.use_peaks = use_peaks
         self.use_cheetah = use_cheetah
         self.cheetah_data_path = ''                        # for special cheetah tree
@@ -71,6 +92,8 @@ class Workflow:
         else:
             self.data_runs = utl.into_list(conf['data']['runs'])
         self.n_runs = len(self.data_runs)
+        # Number of VDS files created at the same time
+        self.vds_workers = conf['data'].get('vds_workers', 4)
         self.set_data_runs_paths()
         self.n_frames_per_vds = [0] * len(self.data_runs)
 
@@ -164,13 +187,41 @@ class Workflow:
                 "config file and rerun."
             )
             exit()
+        # Re-split frames of the tasks slower than the mean by this factor
+        self.straggler_factor = conf['slurm'].get('straggler_factor')
+        # Resubmit failed tasks up to this many times with the backoff in
+        # seconds doubled on every retry, avoiding the failing nodes
+        self.max_retries = conf['slurm'].get('max_retries', 0)
+        self.retry_backoff = conf['slurm'].get('retry_backoff', 60)
+        self.retry_exclude_node = conf['slurm'].get(
+            'retry_exclude_node', False)
+        # Number of frames in the work-queue batches, no work queue if unset
+        self.work_queue_batch = conf['slurm'].get('work_queue_batch')
+        # Pinned indexamajig instances packed on every Slurm node
+        self.instances_per_node = conf['slurm'].get('instances_per_node', 1)
+        self.instance_pinning = conf['slurm'].get(
+            'instance_pinning', 'taskset')
+        if self.instance_pinning not in tmp.INSTANCE_PIN:
+            raise ValueError(
+                f"Unknown instance pinning '{self.instance_pinning}', "
+                f"expected one of {list(tmp.INSTANCE_PIN)}.")
 
         if self.partition == 'local':
-            self.n_nodes_all = 1
+            # Concurrent local indexamajig instances, one per split list
+            self.n_nodes_all = conf['slurm'].get('n_nodes_all', 1)
             self.duration_all = "72:00:00"
         else:
             self.n_nodes_all = conf['slurm']['n_nodes_all']
             self.duration_all = conf['slurm']['duration_all']
+        # Time limit of the filter and merging jobs in the detached mode
+        self.duration_stage = conf['slurm'].get(
+            'duration_stage', self.duration_all)
+        # Pin the concurrent local tasks to separate CPU sets
+        self.local_pin_cpus = conf['slurm'].get('local_pin_cpus', False)
+        self.scheduler = sched.get_scheduler(
+            self.partition, self.reservation, self.n_nodes_all,
+            self.local_pin_cpus
+        )
 
         if 'indexamajig_run' in conf:
             conf_indexamajig_0 = conf['indexamajig_run']
@@ -225,10 +276,12 @@ class Workflow:
             self.duration_hits = conf['slurm'].get('duration_hits')
             self.cell_tolerance = conf.get(
                 'frame_filter', {}).get('match_tolerance')
+            self.pipelined = False
         else:
             self.run_proc_fine = True
             if self.partition == 'local':
-                self.n_nodes_hits = 1
+                self.n_nodes_hits = conf['slurm'].get(
+                    'n_nodes_hits', self.n_nodes_all)
                 self.duration_hits = "72:00:00"
             else:
                 self.n_nodes_hits = conf['slurm'].get(
@@ -237,6 +290,12 @@ class Workflow:
                     'duration_hits', self.duration_all)
             self.cell_tolerance = conf['frame_filter']['match_tolerance']
             self.res_higher = conf['proc_fine']['resolution']
+            # Start the second pass on the chunks of the first pass as
+            # they complete, with the cell refined from a quorum of chunks
+            self.pipelined = conf['frame_filter'].get('pipelined', False)
+            self.pipeline_quorum = conf['frame_filter'].get('quorum', 0.25)
+            self.pipeline_wave_frames = conf['frame_filter'].get(
+                'wave_frames', 1000)
 
         if ('partialator_split' in conf
             and conf['partialator_split']['execute']
@@ -253,9 +312,28 @@ class Workflow:
             self.scale_model = conf['merging']['scaling_model']
             self.scale_iter = conf['merging']['scaling_iterations']
             self.max_adu = conf['merging']['max_adu']
+
+        # Pre-select candidate hits by the number of lit pixels
+        conf_prehit = conf.get('prehit', {})
+        self.run_prehit = conf_prehit.get('execute', False)
+        self.prehit_threshold = conf_prehit.get('adu_threshold', 100.0)
+        self.prehit_min_pixels = conf_prehit.get('min_pixels', 20)
+        self.prehit_batch_frames = conf_prehit.get('batch_frames', 32)
+        self.prehit_workers = conf_prehit.get('n_workers', 8)
+
+        # Outputs of the stages are reused for the same inputs
+        cache_dir = conf.get('cache', {}).get('dir', 'none')
+        if cache_dir == 'none':
+            self.stage_cache = None
+        else:
+            max_size_gb = conf['cache'].get('max_size_gb', 100)
+            self.stage_cache = scache.StageCache(
+                cache_dir, int(max_size_gb * 1e9))
+        # cache keys of the completed stages, feeding the following ones
+        self.stage_keys = {}
         self.config = conf      # store the config dictionary to report later
         self.overrides = {}     # collect optional config overrides
-        self.frames_list = []
+        self.frames_list = fsel.FrameSelection([], [], [])
         self.hits_list = []
         self.cell_ensemble = []
         self.cell_info = []
@@ -263,6 +341,12 @@ class Workflow:
         # store total number of processed frames in the slurm jobs
         self.n_proc_frames_all = 0
         self.n_proc_frames_hits = 0
+        # filter of the first-pass chunks feeding the pipelined second pass
+        self.use_pipeline = False
+        self.pipeline = None
+        # statistics of the last stream files from both indexamajig runs
+        self.stream_stats_all = None
+        self.stream_stats_hits = None
 
         self.json_log = jlog.WorkflowJsonLog(self)
 
@@ -284,15 +368,19 @@ class Workflow:
         return cell_keyword
 
     def process_slurm_multi(self, job_dir, high_res, cell_keyword,
-                            n_nodes, job_duration, filtered=False):
+                            n_nodes, job_duration, filtered=False, step=None,
+                            after=()):
         """ Write a batch-script wrapper for indexamajig from the relevant
-            configuration parameters and start a process by sbatch submission
+            configuration parameters and submit it to the scheduler backend
         """
+        if step is None:
+            step = self.step
         crystfel_import = cri.crystfel_info[self.crystfel_version]['import']
         prefix = f'{self.list_prefix}_hits' if filtered else self.list_prefix
 
-        # Move list files to the slurm directory
-        for input_list in glob(f'{prefix}_*.lst'):
+        # Move the task list files to the slurm directory, not the frames
+        # plan of a detached workflow with the same prefix
+        for input_list in glob(f'{prefix}_[0-9]*.lst'):
             shutil.move(input_list, job_dir)
 
         # Make links to the data, geometry and cell files
@@ -319,13 +407,17 @@ class Workflow:
             cell_keyword = " ".join(cell_key_split[:-1] + [cell_name])
 
         # Prepare '--copy-hdf5-field' option parameters
-        with open(f"{job_dir}/{prefix}_0.lst") as lst_f:
-            data_file_0 = lst_f.readline().split(' ')[0]
-            if os.path.isabs(data_file_0):
-                data_file_path = data_file_0
-            else:
-                data_file_path = f"{job_dir}/{data_file_0}"
-            copy_fields = utl.get_copy_hdf5_fields(data_file_path)
+        if os.path.exists(f"{job_dir}/{prefix}_0.lst"):
+            with open(f"{job_dir}/{prefix}_0.lst") as lst_f:
+                data_file_0 = lst_f.readline().split(' ')[0]
+        else:
+            # List files of a detached step are written by an earlier job
+            data_file_0 = self.frames_list.ds_names[0]
+        if os.path.isabs(data_file_0):
+            data_file_path = data_file_0
+        else:
+            data_file_path = f"{job_dir}/{data_file_0}"
+        copy_fields = utl.get_copy_hdf5_fields(data_file_path)
 
         # Prepare extra options
         if cri.crystfel_info[self.crystfel_version]['contain_harvest']:
@@ -333,35 +425,70 @@ class Workflow:
         else:
             harvest_option = ""
 
-        with open(f'{job_dir}/{prefix}_proc-{self.step}.sh', 'w') as f:
+        # Local instances share the cores of the machine
+        n_cores = self.scheduler.task_cores(self.indexamajig_n_cores)
+
+        if self.work_queue_batch:
+            self.fill_work_queue(job_dir, prefix)
+            queue_loop_begin = tmp.WORK_QUEUE_LOOP_BEGIN % {'PREFIX': prefix}
+            queue_loop_end = tmp.WORK_QUEUE_LOOP_END
+        else:
+            queue_loop_begin = queue_loop_end = ""
+
+        if self.instances_per_node > 1 and self.scheduler.is_slurm:
+            if self.work_queue_batch:
+                # Instances claim the queue batches themselves
+                split_list = instance_files = ""
+            else:
+                split_list = tmp.INSTANCE_SPLIT_LIST
+                instance_files = tmp.INSTANCE_FILES % {'PREFIX': prefix}
+            instances_begin = tmp.INSTANCES_BEGIN % {
+                'N_INSTANCES': self.instances_per_node,
+                'CORES': n_cores,
+                'SPLIT_LIST': split_list,
+                'INSTANCE_FILES': instance_files
+            }
+            instances_end = tmp.INSTANCES_END
+            instance_pin = tmp.INSTANCE_PIN[self.instance_pinning]
+        else:
+            instances_begin = instances_end = instance_pin = ""
+
+        with open(f'{job_dir}/{prefix}_proc-{step}.sh', 'w') as f:
             if self.use_peaks:
-                if self.partition == 'local':
-                    raise NotImplementedError
-                f.write(tmp.PROC_CXI_BASH_SLURM % {
+                if self.scheduler.is_slurm:
+                    proc_template = tmp.PROC_CXI_BASH_SLURM
+                else:
+                    proc_template = tmp.PROC_CXI_BASH_LOCAL
+                f.write(proc_template % {
                     'IMPORT_CRYSTFEL': crystfel_import,
                     'PREFIX': prefix,
                     'GEOM': geom_keyword,
                     'CRYSTAL': cell_keyword,
-                    'CORES': self.indexamajig_n_cores,
+                    'CORES': n_cores,
                     'RESOLUTION': high_res,
                     'PEAKS_HDF5_PATH': self.peaks_path,
                     'INDEX_METHOD': self.index_method,
                     'INT_RADII': self.integration_radii,
                     'COPY_FIELDS': copy_fields,
                     'EXTRA_OPTIONS': self.indexamajig_extra_options,
-                    'HARVEST_OPTION': harvest_option
+                    'HARVEST_OPTION': harvest_option,
+                    'QUEUE_LOOP_BEGIN': queue_loop_begin,
+                    'QUEUE_LOOP_END': queue_loop_end,
+                    'INSTANCES_BEGIN': instances_begin,
+                    'INSTANCES_END': instances_end,
+                    'INSTANCE_PIN': instance_pin
                 })
             else:
-                if self.partition == 'local':
-                    proc_template = tmp.PROC_VDS_BASH_LOCAL
-                else:
+                if self.scheduler.is_slurm:
                     proc_template = tmp.PROC_VDS_BASH_SLURM
+                else:
+                    proc_template = tmp.PROC_VDS_BASH_LOCAL
                 f.write( proc_template % {
                     'IMPORT_CRYSTFEL': crystfel_import,
                     'PREFIX': prefix,
                     'GEOM': geom_keyword,
                     'CRYSTAL': cell_keyword,
-                    'CORES': self.indexamajig_n_cores,
+                    'CORES': n_cores,
                     'RESOLUTION': high_res,
                     'PEAK_METHOD': self.peak_method,
                     'PEAK_THRESHOLD': self.peak_threshold,
@@ -375,30 +502,37 @@ class Workflow:
                     'MIN_PEAKS': self.min_peaks,
                     'COPY_FIELDS': copy_fields,
                     'EXTRA_OPTIONS': self.indexamajig_extra_options,
-                    'HARVEST_OPTION': harvest_option
+                    'HARVEST_OPTION': harvest_option,
+                    'QUEUE_LOOP_BEGIN': queue_loop_begin,
+                    'QUEUE_LOOP_END': queue_loop_end,
+                    'INSTANCES_BEGIN': instances_begin,
+                    'INSTANCES_END': instances_end,
+                    'INSTANCE_PIN': instance_pin
                 })
-        if self.partition == 'local':
-            with open(f'{job_dir}/local_0.out', 'w') as flog:
-                p = subprocess.Popen(
-                    ['sh', f'{prefix}_proc-{self.step}.sh'],
-                    stdin=subprocess.DEVNULL,
-                    stdout=flog, stderr=flog,
-                    cwd=job_dir, start_new_session=True
-                )
-                proc_out = str(p.pid)
-        else:
-            if self.reservation != "none":
-                partition_string = f"--reservation={self.reservation}"
-            else:
-                partition_string = f"--partition={self.partition}"
-            slurm_args = ['sbatch',
-                            f'{partition_string}',
-                            f'--time={job_duration}',
-                            f'--array=0-{n_nodes-1}',
-                            f'./{prefix}_proc-{self.step}.sh']
-            proc_obj = subprocess.check_output(slurm_args, cwd=job_dir)
-            proc_out = proc_obj.decode('utf-8').split()[-1]    # job id
-        return proc_out
+        return self.scheduler.submit(
+            f'{prefix}_proc-{step}.sh', job_dir, n_nodes, job_duration,
+            after=after)
+
+    def fill_work_queue(self, job_dir, prefix):
+        """ Re-split the frames of all task lists into small batches in the
+            work-queue folder, to be claimed by the tasks one after another
+        """
+        task_lists = sorted(
+            glob(f'{job_dir}/{prefix}_[0-9]*.lst'),
+            key=lambda lst: int(lst[:-4].rsplit('_', 1)[1])
+        )
+        frames = []
+        for task_list in task_lists:
+            with open(task_list, 'r') as f_lst:
+                frames.extend(f_lst.read().splitlines())
+        for queue_dir in ['todo', 'claimed', 'done']:
+            os.makedirs(f'{job_dir}/queue/{queue_dir}', exist_ok=True)
+        n_batches = -(-len(frames) // self.work_queue_batch)
+        for i_batch in range(n_batches):
+            batch = frames[i_batch * self.work_queue_batch:
+                           (i_batch + 1) * self.work_queue_batch]
+            with open(f'{job_dir}/queue/todo/b{i_batch:06d}.lst', 'w') as f:
+                f.write(''.join(f'{frame}\n' for frame in batch))
 
     def wrap_process(self, res_limit, cell_keyword, filtered=False):
         """ Perform the processing as distributed computation job;
@@ -408,42 +542,282 @@ class Workflow:
 
         # Prepare a directory to store indexamajig input and output
         job_dir = f"./indexamajig_{self.step}"
-        utl.make_new_dir(job_dir)
-
-        n_nodes = self.n_nodes_hits if filtered else self.n_nodes_all
-        job_duration = self.duration_hits if filtered else self.duration_all
-
-        n_frames = len(self.hits_list) if filtered else len(self.frames_list)
-
-        job_id = self.process_slurm_multi(
-            job_dir, res_limit, cell_keyword, n_nodes, job_duration,
-            filtered=filtered
-        )
-        jlog.save_slurm_info(job_id, n_nodes, job_duration, job_dir)
-        is_local = self.partition == 'local'
-        n_proc_frames = utl.wait_or_cancel(
-            job_id, job_dir, n_frames, self.crystfel_version, self.silent,
-            is_local=is_local
-        )
-        self.concat(job_dir, filtered)
+        prefix = f'{self.list_prefix}_hits' if filtered else self.list_prefix
+        stream_file = f'{prefix}.stream'
+
+        stage = 'indexamajig_hits' if filtered else 'indexamajig_all'
+        # The job folder is removed after the step, so the harvested
+        # parameters are cached with the results instead of as a file
+        cache_outputs = [stream_file]
+        harvest_file = f"{job_dir}/crystfel_harvest.json"
+        cache_key = self.indexing_cache_key(
+            stage, res_limit, cell_keyword, filtered)
+        cached = None
+        # Jobs of the pipelined second pass are running already
+        if cache_key is not None and not (
+                filtered and self.pipeline is not None):
+            cached = self.stage_cache.fetch(cache_key, cache_outputs)
+            if cached is not None:
+                print(f' Reusing cached results of the same inputs for '
+                      f'{stream_file}')
+        if cached is None and self.resume and not os.path.exists(job_dir):
+            # Step completed by the interrupted run, its folder is removed
+            cached = ckpt.load_step_record(stream_file)
+            if cached is not None:
+                print(f' Keeping the complete {stream_file} of the '
+                      f'interrupted run')
+        if cached is not None:
+            n_proc_frames = cached['n_frames']
+            harvest = cached.get('harvest')
+            incomplete = []
+            for input_list in glob(f'{prefix}_[0-9]*.lst'):
+                os.remove(input_list)
+            sidx.get_chunk_index(stream_file)
+        else:
+            n_proc_frames, incomplete = self.run_indexamajig_jobs(
+                job_dir, res_limit, cell_keyword, filtered)
+            self.concat(job_dir, filtered)
+            harvest = None
+            if os.path.exists(harvest_file):
+                with open(harvest_file, 'r') as j_harv:
+                    harvest = json.load(j_harv)
+            if not incomplete:
+                ckpt.save_step_record(stream_file, n_proc_frames, harvest)
+            # Partial results are not cached
+            if cache_key is not None and not incomplete:
+                self.stage_cache.store(
+                    cache_key, cache_outputs,
+                    {'n_frames': n_proc_frames, 'harvest': harvest})
+        self.stage_keys[stage] = cache_key
+
+        self.report_step(job_dir, res_limit, n_proc_frames, filtered,
+                         keep_job_dir=bool(incomplete), harvest=harvest)
+        return n_proc_frames
 
-        stream_file = f'{self.list_prefix}_hits.stream' if filtered \
-            else f'{self.list_prefix}.stream'
+    def report_step(self, job_dir, res_limit, n_proc_frames, filtered,
+                    keep_job_dir=False, harvest=None):
+        """ Collect the statistics of the concatenated stream of a step,
+            report them with the harvested indexamajig parameters (read
+            from the job folder if not given) and remove the job folder
+        """
+        prefix = f'{self.list_prefix}_hits' if filtered else self.list_prefix
+        # One pass over the stream for all statistics of this step
+        stream_stats = sst.collect_stream_stats(f'{prefix}.stream')
+        if filtered:
+            self.stream_stats_hits = stream_stats
+        else:
+            self.stream_stats_all = stream_stats
         cryst_results = {}
         cryst_results['n_frames'] = n_proc_frames
-        cryst_results['n_hits'] = cru.get_n_hits(stream_file, self.min_peaks)
-        cryst_results['n_crystals'] = cru.get_n_crystals(stream_file)
+        cryst_results['n_hits'] = stream_stats.n_hits(self.min_peaks)
+        cryst_results['n_crystals'] = stream_stats.n_crystals
 
         self.json_log.save_crystfel_job(
-            f"indexamajig_{self.step}", job_dir, cryst_results)
+            f"indexamajig_{self.step}", job_dir, cryst_results, harvest)
 
         smr.report_step_rate(
             self.list_prefix, self.step, res_limit, cryst_results)
 
-        if not self.diagnostic:
+        # Keep the job folder of incomplete chunks for resuming
+        if not self.diagnostic and not keep_job_dir:
             utl.remove_path(job_dir)
+
+    def run_indexamajig_jobs(self, job_dir, res_limit, cell_keyword,
+                             filtered=False):
+        """ Submit the indexamajig jobs of a step, or resume them, and wait
+            for them to finish; return the number of processed frames and
+            the incomplete chunks
+        """
+        prefix = f'{self.list_prefix}_hits' if filtered else self.list_prefix
+        script = f'{prefix}_proc-{self.step}.sh'
+
+        n_nodes = self.n_nodes_hits if filtered else self.n_nodes_all
+        job_duration = self.duration_hits if filtered else self.duration_all
+
+        n_frames = len(self.hits_list) if filtered else len(self.frames_list)
+
+        # Frames in flight in the parallel indexamajig workers of a task
+        n_slack = self.scheduler.max_task_cores(self.indexamajig_n_cores)
+        if self.instances_per_node > 1:
+            # Instances of a task do not process its list in order
+            n_slack = n_frames
+
+        if filtered and self.pipeline is not None:
+            return self.wait_pipelined_hits(job_dir), []
+
+        manifest = None
+        if self.resume:
+            manifest = ckpt.ChunkManifest.load(job_dir)
+        if manifest is not None:
+            print(f' Resuming the chunks of {job_dir}')
+            for input_list in glob(f'{prefix}_[0-9]*.lst'):
+                os.remove(input_list)
+            for job_id in manifest.job_ids:
+                if self.scheduler.is_active(job_id):
+                    mon.wait_or_cancel(
+                        job_id, job_dir, n_frames, self.crystfel_version,
+                        self.silent, scheduler=self.scheduler
+                    )
+            manifest.update(self.scheduler, self.crystfel_version)
+            n_proc_frames = manifest.n_processed()
+        else:
+            utl.make_new_dir(job_dir)
+            job_id = self.process_slurm_multi(
+                job_dir, res_limit, cell_keyword, n_nodes, job_duration,
+                filtered=filtered
+            )
+            jlog.save_slurm_info(job_id, n_nodes, job_duration, job_dir)
+            # Task lists do not match the processed frames in the work queue
+            if not self.work_queue_batch:
+                manifest = ckpt.ChunkManifest(
+                    job_dir, prefix, script, job_duration)
+                manifest.job_ids.append(job_id)
+                manifest.save()
+            if self.use_pipeline and not filtered:
+                self.pipeline = self.make_pipeline(job_dir, prefix, n_nodes)
+            stragglers = None
+            # Batches of the work queue are balanced between the tasks
+            # already, instances of a task do not process its list in order,
+            # re-split tasks would be missed by the pipelined filter
+            if (self.straggler_factor and not self.work_queue_batch
+                    and self.instances_per_node == 1
+                    and self.pipeline is None):
+                stragglers = stg.StragglerSplitter(
+                    self.scheduler, job_dir, script, prefix, n_nodes,
+                    job_duration, n_slack, factor=self.straggler_factor
+                )
+            retrier = None
+            # Batches claimed by a failed task are not returned to the queue
+            if self.max_retries and not self.work_queue_batch:
+                retrier = rtr.TaskRetrier(
+                    self.scheduler, job_dir, script, job_duration,
+                    max_retries=self.max_retries, backoff=self.retry_backoff,
+                    exclude_nodes=self.retry_exclude_node
+                )
+            n_proc_frames = mon.wait_or_cancel(
+                job_id, job_dir, n_frames, self.crystfel_version, self.silent,
+                scheduler=self.scheduler, stragglers=stragglers,
+                pipeline=self.pipeline, retrier=retrier
+            )
+            if retrier is not None:
+                jlog.save_task_attempts(retrier.attempt_history(), job_dir)
+            if self.pipeline is not None:
+                self.pipeline.finish()
+            if manifest is not None:
+                split_tasks = None
+                if stragglers is not None:
+                    manifest.job_ids += stragglers.job_ids
+                    split_tasks = stragglers.split_tasks
+                if retrier is not None:
+                    manifest.job_ids += retrier.job_ids
+                manifest.update(
+                    self.scheduler, self.crystfel_version, split_tasks)
+                manifest.save()
+
+        if manifest is not None and self.resume:
+            # Resubmit only the frames of the missing or incomplete chunks
+            resume_job_id = manifest.resubmit(self.scheduler, n_slack)
+            if resume_job_id is not None:
+                n_resumed = sum(
+                    manifest.tasks[task]['n_frames']
+                    for task in manifest.incomplete_tasks()
+                )
+                print(f' Resubmitted {n_resumed} frames of incomplete chunks'
+                      f' as job {resume_job_id}')
+                mon.wait_or_cancel(
+                    resume_job_id, job_dir, n_resumed,
+                    self.crystfel_version, self.silent,
+                    scheduler=self.scheduler
+                )
+                manifest.update(self.scheduler, self.crystfel_version)
+                manifest.save()
+                n_proc_frames = manifest.n_processed()
+        incomplete = [] if manifest is None else manifest.incomplete_tasks()
+        if incomplete:
+            warnings.warn(
+                f"Chunks {incomplete} in {job_dir} are incomplete, rerun "
+                f"with --resume to process their remaining frames.")
+
+        return n_proc_frames, incomplete
+
+    def make_pipeline(self, job_dir, prefix, n_chunks):
+        """ Prepare the filter of the first-pass chunks and the job folder
+            of the pipelined second pass
+        """
+        hits_dir = f"./indexamajig_{self.step + 1}"
+        utl.make_new_dir(hits_dir)
+        return ppl.PipelinedFilter(
+            self.scheduler, job_dir, prefix, n_chunks, self.cell_file,
+            self.cell_tolerance, self.cell_run_refine, hits_dir,
+            f'{self.list_prefix}_hits', self.n_nodes_hits,
+            self.submit_hits_wave, wave_frames=self.pipeline_wave_frames,
+            quorum=self.pipeline_quorum
+        )
+
+    def submit_hits_wave(self, first_task, n_tasks):
+        """ Submit the tasks of a wave of the pipelined second pass, their
+            list files are in the job folder already
+        """
+        step = self.step + 1
+        job_dir = f"./indexamajig_{step}"
+        if first_task == 0:
+            self.cell_file = self.pipeline.cell_file
+            job_id = self.process_slurm_multi(
+                job_dir, self.res_higher, self.get_cell_keyword(), n_tasks,
+                self.duration_hits, filtered=True, step=step
+            )
+            jlog.save_slurm_info(
+                job_id, self.n_nodes_hits, self.duration_hits, job_dir)
+            return job_id
+        return self.scheduler.submit(
+            f'{self.list_prefix}_hits_proc-{step}.sh', job_dir, n_tasks,
+            self.duration_hits, first_task=first_task
+        )
+
+    def wait_pipelined_hits(self, job_dir):
+        """ Wait for all waves of the pipelined second pass to finish;
+            return the number of processed frames
+        """
+        n_proc_frames = 0
+        for job_id, n_frames in zip(
+                self.pipeline.job_ids, self.pipeline.job_frames):
+            n_proc_frames += mon.wait_or_cancel(
+                job_id, job_dir, n_frames, self.crystfel_version,
+                self.silent, scheduler=self.scheduler
+            )
         return n_proc_frames
 
+    def indexing_cache_key(self, stage, res_limit, cell_keyword, filtered):
+        """ Hash of the inputs of an indexamajig step for the stage cache,
+            None if the cache is disabled
+        """
+        if self.stage_cache is None:
+            return None
+        if filtered:
+            frames_digest = scache.lines_digest(self.hits_list)
+        else:
+            frames_digest = self.frames_list.digest()
+        if self.use_cheetah:
+            data_files = [self.cheetah_data_path]
+        else:
+            data_files = self.cxi_names if self.use_peaks else self.vds_names
+        cell_files = cell_keyword.split()[-1:]
+        return self.stage_cache.key(stage, {
+            'crystfel_version': self.crystfel_version,
+            'resolution': res_limit,
+            'cell_keyword': cell_keyword,
+            'indexamajig': [
+                self.peak_method, self.peak_threshold, self.peak_snr,
+                self.peak_min_px, self.peak_max_px, self.peaks_path,
+                self.index_method, self.local_bg_radius,
+                self.integration_radii, self.max_res, self.min_peaks,
+                self.indexamajig_extra_options, self.use_peaks
+            ],
+            'frames': frames_digest,
+            'data': [scache.file_identity(ds) for ds in data_files],
+            'frame_filter': self.stage_keys.get('frame_filter'),
+        }, files=[self.geometry] + cell_files)
+
     def check_cxi(self):
         """ Optional name-by-name confirmation or override of CXI file names;
             storage of experiment identifiers.
@@ -455,8 +829,7 @@ class Workflow:
             if not os.path.exists(cxi_name):
                 warnings.warn(f' File {cxi_name} not found!')
                 exit(0)
-            with h5py.File(cxi_name, 'r') as f:
-                self.n_frames_per_vds[i] = f['/entry_1/data_1/data'].shape[0]
+            self.n_frames_per_vds[i] = vds.load_metadata(cxi_name).n_frames
             print(f'Data set {i:02d}: {cxi_name} '
                   f'contains {self.n_frames_per_vds[i]} frames in total.')
 
@@ -471,24 +844,75 @@ class Workflow:
         if self.interactive:
             self.verify_data_config_vds()
 
+        missing = []
         for i, vds_name in enumerate(self.vds_names):
-            if not (os.path.exists(f'{self.work_dir}/{vds_name}')
+            if (os.path.exists(f'{self.work_dir}/{vds_name}')
                     or os.path.exists(f'{vds_name}')):
-                print('Creating a VDS file in CXI format ...')
-                with open(f'_tmp_{self.list_prefix}_make_vds.sh', 'w') as f:
-                    f.write(tmp.MAKE_VDS % {'DATA_PATH': self.data_runs_paths[i],
-                                        'VDS_NAME': vds_name,
-                                        'MASK_BAD': vds_mask_int
-                                        })
-                subprocess.check_output(['sh', f'_tmp_{self.list_prefix}_make_vds.sh'])
-            else:
                 print(f'Requested VDS {vds_name} is present already.')
+            elif not self.restore_vds(i):
+                missing.append(i)
+        if missing:
+            # The VDS files are written in-process by a pool of workers
+            n_workers = min(self.vds_workers, len(missing))
+            print(f'Creating {len(missing)} VDS file(s) in CXI format with '
+                  f'{n_workers} concurrent worker(s) ...')
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                elapsed_times = executor.map(
+                    vds.write_virtual_cxi,
+                    [self.data_runs_paths[i] for i in missing],
+                    [self.vds_names[i] for i in missing],
+                    [vds_mask_int] * len(missing))
+                for i, elapsed in zip(missing, elapsed_times):
+                    print(f' {self.vds_names[i]}: created in {elapsed:.1f} s')
+                    self.store_vds(i)
 
-            with h5py.File(vds_name, 'r') as f:
-                self.n_frames_per_vds[i] = f['/entry_1/data_1/data'].shape[0]
+        for i, vds_name in enumerate(self.vds_names):
+            self.n_frames_per_vds[i] = vds.load_metadata(
+                vds_name, store=True).n_frames
             print(f'Data set {i:02d}: {vds_name} '
                   f'contains {self.n_frames_per_vds[i]} frames in total.')
 
+    def vds_cache_key(self, i_run):
+        """ Key of the VDS file of a run in the stage cache, None without
+            the cache
+        """
+        if self.stage_cache is None:
+            return None
+        data_path = self.data_runs_paths[i_run]
+        return self.stage_cache.key('vds', {
+            'data_path': data_path,
+            'mask_bad': int(self.vds_mask, 16),
+            # New or corrected data files of the run invalidate the VDS
+            'data_files': [scache.file_identity(data_file) for data_file
+                           in sorted(glob(f'{data_path}/*.h5'))],
+        })
+
+    def restore_vds(self, i_run):
+        """ Restore the VDS file of a run and its metadata sidecar from the
+            stage cache; return whether it was found
+        """
+        cache_key = self.vds_cache_key(i_run)
+        if cache_key is None:
+            return False
+        vds_name = self.vds_names[i_run]
+        start_time = time.monotonic()
+        if self.stage_cache.fetch(
+                cache_key, [vds_name, vds.sidecar_path(vds_name)]) is None:
+            return False
+        print(f' {vds_name}: restored from the cache in '
+              f'{time.monotonic() - start_time:.1f} s')
+        return True
+
+    def store_vds(self, i_run):
+        """ Store the VDS file of a run and its metadata sidecar in the
+            stage cache
+        """
+        cache_key = self.vds_cache_key(i_run)
+        if cache_key is not None:
+            vds_name = self.vds_names[i_run]
+            self.stage_cache.store(
+                cache_key, [vds_name, vds.sidecar_path(vds_name)])
+
     def transfer_geometry(self):
         """ Transfer corner x/y positions and fs/ss vectors onto a geometry
             file template in suited format (user ensures correct template)  
@@ -678,6 +1102,11 @@ class Workflow:
             utl.set_dotdict_val(
                 self.overrides, "slurm.duration_all", self.duration_all)
 
+        self.scheduler = sched.get_scheduler(
+            self.partition, self.reservation, self.n_nodes_all,
+            self.local_pin_cpus
+        )
+
 
     def verify_indexamajig_config_all(self):
         """Verify CrystFEL parameters in the interactive mode for the
@@ -889,8 +1318,8 @@ class Workflow:
         ds_names = self.cxi_names if self.use_peaks else self.vds_names
 
         if self.frames_list_file is None:
-            # Make a list of datasets and frame indices
-            self.frames_list = []
+            # Make a selection of datasets and frame indices
+            frame_ranges = []
             for ids in range(self.n_runs):
                 n_frames_raw = self.n_frames_per_vds[ids]
                 n_start = self.frames_range[ids]['start']
@@ -904,57 +1333,124 @@ class Workflow:
                     n_end = n_frames_raw
                 elif n_end < 0:
                     n_end = n_frames_raw + n_end + 1
-                for ifr in range(n_start, n_end, n_step):
-                    self.frames_list.append(f'{ds_names[ids]} //{ifr}\n')
+                frame_ranges.append(range(n_start, n_end, n_step))
+            self.frames_list = fsel.FrameSelection.from_ranges(
+                ds_names, frame_ranges)
         else:
             print(f'Reading frames list from: {self.frames_list_file}')
-            with open(self.frames_list_file, 'r') as flst:
-                self.frames_list = flst.readlines()
+            self.frames_list = fsel.FrameSelection.from_list_file(
+                self.frames_list_file)
+
+        if self.run_prehit:
+            if self.use_peaks:
+                warnings.warn("Hit pre-selection is only available for the"
+                              " VDS data, processing all frames.")
+            else:
+                self.select_candidate_hits()
 
         print("Total number of frames to process:", len(self.frames_list))
 
         # Split frames list per slurm node and write to files
-        frames_lst_split = np.array_split(self.frames_list, self.n_nodes_all)
         print("Split into:", end='')
-        for ich, sub_frames_lst in enumerate(frames_lst_split):
-            print(f" {len(sub_frames_lst)}", end='')
-            with open(f'{self.list_prefix}_{ich}.lst', 'w') as flst:
-                for line in sub_frames_lst:
-                    flst.write(line)
+        for ich, sub_frames in enumerate(
+                self.frames_list.split(self.n_nodes_all)):
+            print(f" {len(sub_frames)}", end='')
+            sub_frames.write_list(f'{self.list_prefix}_{ich}.lst')
         print()
 
 
+    def select_candidate_hits(self):
+        """ Replace the frames list by the candidate hits with at least the
+            minimum number of lit pixels outside the bad regions of the
+            geometry, so the blank frames are not sent to indexamajig
+        """
+        print('Pre-selecting candidate hits by counting lit pixels above '
+              f'{self.prehit_threshold} ...')
+        good_pixels = None
+        if geo.check_geom_format(self.geometry, self.use_peaks):
+            good_pixels = ~geo.get_bad_regions_mask(self.geometry)
+        else:
+            warnings.warn("Bad regions of the geometry are not applied in"
+                          " the hit pre-selection.")
+        n_frames = len(self.frames_list)
+        start_time = time.monotonic()
+        self.frames_list, lit_pixels = prehit.find_hits(
+            self.frames_list, good_pixels, self.prehit_threshold,
+            self.prehit_min_pixels, batch_frames=self.prehit_batch_frames,
+            n_workers=self.prehit_workers)
+        n_hits = len(self.frames_list)
+        print(f'{n_hits} candidate hits of {n_frames} frames '
+              f'({100 * n_hits / max(n_frames, 1):.1f}%) found in '
+              f'{time.monotonic() - start_time:.1f} s, median lit pixels: '
+              f'{np.median(lit_pixels) if n_frames else 0:.0f}')
+
     def distribute_cheetah(self):
-        """ Distribute the number of Cheetah HDF5 files, accounting for the
-            amount of frames to be processed, onto N chunks, and write the
-            file paths into N temporary .lst files
+        """ Distribute the frames to be processed from the Cheetah HDF5
+            files evenly onto N chunks, using the exact numbers of frames
+            in the files, and write the 'file //event' entries into N
+            temporary .lst files
         """
         print('\n-----   TASK: analyse and distribute Cheetah input   -----\n')
-        n_files, average_n_frames = utl.scan_cheetah_proc_dir(self.cheetah_data_path)
+        file_items, n_frames = utl.scan_cheetah_proc_dir(
+            self.cheetah_data_path, f'{self.list_prefix}_cheetah_scan.json')
+        n_files = len(file_items)
+        n_frames_total = int(n_frames.sum())
         print('total number of processed files:   {:5d}'.format(n_files))
-        print('average number of frames per file: {:.1f}'.format(average_n_frames))
-        print('estimated total number of frames:',
-              int(average_n_frames * n_files))
-        n_used_files = int(round(len(self.frames_list) / average_n_frames))
-        if n_used_files > n_files:
-            warnings.warn('Number of used files from requested number of'
-                          f' frames exceeds total, reset to {n_files}.')
-            n_used_files = n_files
-        file_indices = np.array_split(np.arange(n_used_files), self.n_nodes_all)
-        file_items = sorted([os.path.join(dp, f) for dp, dn, fn in os.walk(self.cheetah_data_path) for f in fn])
-        for chunk, indices in enumerate(file_indices):
-            print(len(indices), end=' ')
-            with open(f'{self.list_prefix}_{chunk}.lst', 'w') as f:
-                for index in indices:
-                    f.write(f'{file_items[index]}\n')
+        print('total number of frames:', n_frames_total)
+        n_frames_req = len(self.frames_list)
+        if n_frames_req > n_frames_total:
+            warnings.warn('Number of requested frames exceeds total, reset'
+                          f' to {n_frames_total}.')
+        if n_frames_req == 0 or n_frames_req > n_frames_total:
+            n_frames_req = n_frames_total
+
+        # take the requested number of frames from the files in order
+        n_frames_used = np.minimum(
+            n_frames, np.maximum(n_frames_req - np.cumsum(n_frames)
+                                 + n_frames, 0))
+        self.frames_list = fsel.FrameSelection.from_ranges(
+            file_items, [range(n_used) for n_used in n_frames_used.tolist()])
+        print("Total number of frames to process:", len(self.frames_list))
+
+        print("Split into:", end='')
+        for chunk, sub_frames in enumerate(
+                self.frames_list.split(self.n_nodes_all)):
+            print(f" {len(sub_frames)}", end='')
+            sub_frames.write_list(f'{self.list_prefix}_{chunk}.lst')
         print()
 
+    def hit_costs(self):
+        """ Estimate processing cost of the indexed frames from the numbers
+            of peaks and crystals in the first-pass stream
+        """
+        stream_stats = self.stream_stats_all
+        stream_file = f'{self.list_prefix}.stream'
+        if stream_stats is None:
+            if not os.path.exists(stream_file):
+                return None
+            stream_stats = sst.collect_stream_stats(stream_file)
+        frame_peaks = dict(
+            zip(stream_stats.crystal_events,
+                stream_stats.crystal_num_peaks.tolist())
+        )
+        frame_crystals = Counter(stream_stats.crystal_events)
+        num_peaks = [frame_peaks.get(hit, 0) for hit in self.hits_list]
+        n_crystals = [frame_crystals.get(hit, 0) for hit in self.hits_list]
+        return utl.estimate_frame_costs(num_peaks, n_crystals)
+
     def distribute_hits(self):
         """ Split up the list of indexed frames (also stored to one file) onto
-            N chunks and write N temporary .lst files
+            N chunks of similar estimated processing cost and write N
+            temporary .lst files
         """
         n_filtered = len(self.hits_list)
-        split_indices = np.array_split(np.arange(n_filtered), self.n_nodes_hits)
+        hit_costs = self.hit_costs()
+        if hit_costs is None:
+            split_indices = np.array_split(
+                np.arange(n_filtered), self.n_nodes_hits)
+        else:
+            split_indices = utl.partition_by_cost(
+                hit_costs, self.n_nodes_hits)
         for chunk, sub_indices in enumerate(split_indices):
             print(len(sub_indices), end=' ')
             with open(f'{self.list_prefix}_hits_{chunk}.lst', 'w') as f:
@@ -968,9 +1464,11 @@ class Workflow:
         # in case account for the fact the prefix_* covers prefix_hits_*
         prefix = f'{self.list_prefix}_hits' if filtered else self.list_prefix
         chunks = sorted(glob(f'{job_dir}/{prefix}_*.stream'))
-        with open(f'{prefix}.stream', 'w') as f_out, fileinput.input(chunks) as f_in:
-            for ln in f_in:
-                f_out.write(ln)
+        # Drop incomplete chunks of cancelled tasks and frames repeated
+        # by re-split tasks
+        cstr.concat_streams(chunks, f'{prefix}.stream')
+        # Persistent index for the random access to the stream chunks
+        sidx.get_chunk_index(f'{prefix}.stream')
 
     def write_hit_list(self):
         """Write the total set of indexed frames into one 'hit list' file
@@ -999,10 +1497,46 @@ class Workflow:
     def fit_filtered_crystals(self):
         """Select diffraction frames from match vs. good cell
         """
+        if self.pipeline is not None:
+            # Filtered chunk by chunk during the first pass
+            self.hits_list = self.pipeline.hits_list
+            self.cell_file = self.pipeline.cell_file
+            smr.report_cell_check(
+                self.list_prefix, len(self.hits_list), self.n_proc_frames_all
+            )
+            self.write_hit_list()
+            return
+
+        list_file = self.list_prefix + '_hits.lst'
+        cache_outputs = [list_file]
+        if self.cell_run_refine:
+            cache_outputs.append(utl.get_refined_cell_name(self.cell_file))
+        cache_key = None
+        cached = None
+        if (self.stage_cache is not None
+                and self.stage_keys.get('indexamajig_all') is not None):
+            cache_key = self.stage_cache.key('frame_filter', {
+                'indexamajig_all': self.stage_keys.get('indexamajig_all'),
+                'match_tolerance': self.cell_tolerance,
+                'run_refine': self.cell_run_refine,
+            }, files=[self.cell_file])
+            cached = self.stage_cache.fetch(cache_key, cache_outputs)
+        self.stage_keys['frame_filter'] = cache_key
+        if cached is not None:
+            print(f' Reusing cached results of the same inputs for '
+                  f'{list_file}')
+            with open(list_file, 'r') as f:
+                self.hits_list = f.read().splitlines()
+            smr.report_cell_check(
+                self.list_prefix, len(self.hits_list), self.n_proc_frames_all
+            )
+            self.cell_file = cached['cell_file']
+            return
+
         self.hits_list, self.cell_ensemble = \
             utl.get_crystal_frames(
                 f'{self.list_prefix}.stream', self.cell_file,
-                self.cell_tolerance
+                self.cell_tolerance, self.stream_stats_all
             )
         n_cryst = len(self.hits_list)
         index_rate = 100.0 * n_cryst / self.n_proc_frames_all
@@ -1015,6 +1549,9 @@ class Workflow:
             print('\n-----   TASK: refine unit cell parameters   -----\n')
             refined_cell = utl.fit_unit_cell(self.cell_ensemble)
             self.cell_file = utl.replace_cell(self.cell_file, refined_cell)
+        if cache_key is not None:
+            self.stage_cache.store(
+                cache_key, cache_outputs, {'cell_file': self.cell_file})
 
 
     def get_frame_counts(
@@ -1023,18 +1560,13 @@ class Workflow:
         """Generate DataArray table with overall frame rates for all
         data and dataset in frame_datasets.
         """
-        frames_lst = self.frames_list
+        frames = self.frames_list
         part_lst = frame_datasets
         stream_file_1 = f'{self.list_prefix}.stream'
         stream_file_2 = None
         if self.run_proc_fine:
             stream_file_2 = f"{self.list_prefix}_hits.stream"
 
-        frame_ids = []
-        for line in frames_lst:
-            frame_id_data = line.strip().split(' //')
-            frame_ids.append((frame_id_data[0], int(frame_id_data[1])))
-    
         frame_dsets = {}
         for line in part_lst:
             frame_dsets_data = line.strip().split()
@@ -1042,51 +1574,53 @@ class Workflow:
             frame_dset = frame_dsets_data[2]
             frame_dsets[frame_id] = frame_dset
 
-        with open(stream_file_1, 'r') as st_in:
-            stream_data_1 = cstr.read_crystfel_stream(st_in)
+        # Only 'hit' and number of crystals are needed from the streams
+        stream_data_1 = cstr.read_crystfel_stream_parallel(
+            stream_file_1, fields=cstr.FIELDS_CHUNKS)
         if stream_file_2 is not None:
-            with open(stream_file_2, 'r') as st_in:
-                stream_data_2 = cstr.read_crystfel_stream(st_in)
+            stream_data_2 = cstr.read_crystfel_stream_parallel(
+                stream_file_2, fields=cstr.FIELDS_CHUNKS)
         else:
             stream_data_2 = stream_data_1
 
+        n_frames_all = len(frames)
+        chunk_ids_1 = stream_data_1.find_frames(frames)
+        chunk_ids_2 = stream_data_2.find_frames(frames)
+        frame_hit = np.zeros(n_frames_all, dtype=bool)
+        found_1 = chunk_ids_1 >= 0
+        frame_hit[found_1] = (
+            stream_data_1.chunks['hit'][chunk_ids_1[found_1]] == 1)
+        frame_indexed = np.zeros(n_frames_all, dtype=bool)
+        found_2 = chunk_ids_2 >= 0
+        frame_indexed[found_2] = (
+            stream_data_2.chunks['n_crystals'][chunk_ids_2[found_2]] > 0)
+
+        # Each frame belongs to ALL_DATASET and some dataset
+        frame_dset_names = np.array([
+            frame_dsets.get((frames.ds_names[fr_ds], fr_event), '')
+            for fr_ds, fr_event in zip(
+                frames.ds_index.tolist(), frames.frame_index.tolist())
+        ], dtype=str)
+        dset_masks = {}
+        if n_frames_all > 0:
+            dset_masks[pspl.ALL_DATASET] = np.ones(n_frames_all, dtype=bool)
+        dset_names, dset_first = np.unique(
+            frame_dset_names, return_index=True)
+        for dset in dset_names[np.argsort(dset_first)]:
+            if dset != '':
+                dset_masks[dset] = frame_dset_names == dset
+
         frame_counts = [
             'N_frames', 'N_hits', 'N_indexed', 'hit_rate', 'index_rate']
         dset_frame_counts = {}
-        for fr_id in frame_ids:
-            # Each frame belongs to ALL_DATASET and some dataset
-            dsets_list = [pspl.ALL_DATASET]
-            if fr_id in frame_dsets:
-                curr_dset = frame_dsets[fr_id]
-                dsets_list.append(curr_dset)
-
-            for dset in dsets_list:
-                if dset not in dset_frame_counts:
-                    dset_frame_counts[dset] = np.zeros((5))
-                dset_frame_counts[dset][0] += 1
-
-            if (fr_id in stream_data_1
-                and stream_data_1[fr_id]['hit'] == 1
-                ):
-                for dset in dsets_list:
-                    dset_frame_counts[dset][1] += 1
-
-            if (fr_id in stream_data_2
-                and stream_data_2[fr_id]['crystals'] is not None
-                ):
-                for dset in dsets_list:
-                    dset_frame_counts[dset][2] += 1
-
-            for dset in dsets_list:
-                n_frames = dset_frame_counts[dset][0]
-                n_hits = dset_frame_counts[dset][1]
-                n_indexed = dset_frame_counts[dset][2]
-                if n_frames > 0:
-                    dset_frame_counts[dset][3] = n_hits / n_frames
-                    dset_frame_counts[dset][4] = n_indexed / n_frames
-                else:
-                    dset_frame_counts[dset][3] = 0.
-                    dset_frame_counts[dset][4] = 0.
+        for dset, dset_mask in dset_masks.items():
+            n_frames = np.count_nonzero(dset_mask)
+            n_hits = np.count_nonzero(dset_mask & frame_hit)
+            n_indexed = np.count_nonzero(dset_mask & frame_indexed)
+            dset_frame_counts[dset] = np.array([
+                n_frames, n_hits, n_indexed,
+                n_hits / n_frames, n_indexed / n_frames
+            ])
 
         dset_frame_counts_arr = np.array(list(dset_frame_counts.values()))
         frame_counts = xr.DataArray(
@@ -1186,10 +1720,27 @@ class Workflow:
     def merge_bragg_obs(self):
         """ Interface to the CrystFEL utilities for the 'merging' steps
         """
+        if self.interactive:
+            self.verify_merging_config()
+
         # Prepare a folder to store partialator input and output
         part_dir = f"./partialator"
         utl.make_new_dir(part_dir)
 
+        cache_outputs = ["frame_counts.nc", part_dir]
+        cache_key = self.merging_cache_key()
+        if (cache_key is not None
+                and self.stage_cache.fetch(cache_key, cache_outputs)
+                is not None):
+            print(' Reusing cached results of the same inputs for merging')
+            frame_counts = xr.load_dataarray("frame_counts.nc")
+            self.json_log.save_frame_counts(frame_counts)
+            smr.report_frame_counts(frame_counts, self.list_prefix)
+            part_foms = xr.load_dataarray(f"{part_dir}/datasets_foms.nc")
+            self.json_log.save_partialator_foms(part_foms)
+            smr.report_merging_metrics(part_foms, self.list_prefix)
+            return
+
         # Prepare partialator list file(s) for splitting frames into datasets
         frame_datasets = []
         part_split_arg = ""
@@ -1223,8 +1774,6 @@ class Workflow:
         self.json_log.save_frame_counts(frame_counts)
         smr.report_frame_counts(frame_counts, self.list_prefix)
 
-        if self.interactive:
-            self.verify_merging_config()
         # Make links to the refined cell and output stream files
         utl.make_link(self.cell_file, part_dir)
         if self.run_proc_fine:
@@ -1256,6 +1805,33 @@ class Workflow:
 
         self.json_log.save_partialator_foms(part_foms)
         smr.report_merging_metrics(part_foms, self.list_prefix)
+        if cache_key is not None:
+            self.stage_cache.store(cache_key, cache_outputs)
+
+    def merging_cache_key(self):
+        """ Hash of the inputs of the merging step for the stage cache,
+            None if the cache is disabled or the streams are not from this
+            workflow run
+        """
+        if self.stage_cache is None:
+            return None
+        stream_keys = [self.stage_keys.get('indexamajig_all')]
+        if self.run_proc_fine:
+            stream_keys.append(self.stage_keys.get('indexamajig_hits'))
+        if None in stream_keys:
+            return None
+        return self.stage_cache.key('merging', {
+            'crystfel_version': self.crystfel_version,
+            'streams': stream_keys,
+            'frames': self.frames_list.digest(),
+            'merging': [
+                self.point_group, self.scale_model, self.scale_iter,
+                self.max_adu
+            ],
+            'partialator_split': (
+                self.partialator_split_config
+                if self.run_partialator_split else None),
+        }, files=[self.cell_file])
 
 
     def process_late(self):
@@ -1268,15 +1844,20 @@ class Workflow:
             print('\n-----   TASK: run CrystFEL with refined cell and filtered frames   ------\n')
 
             # Verify SLURM nodes config for the second CrystFEL run:
-            if self.interactive:
+            if self.interactive and not self.use_pipeline:
                 self.verify_indexamajig_config_hits()
 
-            self.distribute_hits()
+            if self.pipeline is None:
+                self.distribute_hits()
             cell_keyword = self.get_cell_keyword()
 
             self.n_proc_frames_hits = self.wrap_process(
                 self.res_higher, cell_keyword, filtered=True)
-            smr.report_total_rate(self.list_prefix, self.n_proc_frames_all)
+            n_cryst = None
+            if self.stream_stats_hits is not None:
+                n_cryst = self.stream_stats_hits.n_crystals
+            smr.report_total_rate(
+                self.list_prefix, self.n_proc_frames_all, n_cryst)
             smr.report_cells(self.list_prefix, self.cell_info)
 
         if self.run_partialator:
@@ -1291,6 +1872,152 @@ class Workflow:
         smr.report_reconfig(self.list_prefix, self.overrides)
 
 
+    def submit_detached(self, cell_keyword):
+        """ Submit all steps of the workflow at once as jobs depending on
+            each other; the filter and merging steps run as xwiz stages
+            in their own jobs, which may start as soon as they are
+            submitted, so their shared state is stored beforehand
+        """
+        if not os.path.exists(self.cell_file):
+            warnings.warn(
+                "The detached mode requires a unit cell file, please "
+                "provide one or run the workflow without '--detached'.")
+            exit()
+        # Plan the job folders of the indexamajig steps
+        steps = {}
+        step_names = ['indexamajig_all']
+        if self.run_proc_fine:
+            step_names.append('indexamajig_hits')
+        for step_name in step_names:
+            self.step += 1
+            job_dir = f"./indexamajig_{self.step}"
+            utl.make_new_dir(job_dir)
+            steps[step_name] = [self.step, job_dir]
+        self.save_detached_state({'steps': steps})
+        # Frame selection for the frame counts of the merging stage
+        self.frames_list.write_list(f'{self.list_prefix}_frames.lst')
+
+        with self.scheduler.detach():
+            step, job_dir = steps['indexamajig_all']
+            job_id = self.process_slurm_multi(
+                job_dir, self.res_lower, cell_keyword, self.n_nodes_all,
+                self.duration_all, step=step
+            )
+            jlog.save_slurm_info(
+                job_id, self.n_nodes_all, self.duration_all, job_dir)
+            print(f' Submitted indexamajig (I) as job {job_id}')
+
+            if self.run_proc_fine:
+                job_id = self.submit_stage('filter', [job_id])
+                step, job_dir = steps['indexamajig_hits']
+                # Refined cell and list files are written by the filter stage
+                cell_file = self.cell_file
+                if self.cell_run_refine:
+                    cell_file = utl.get_refined_cell_name(self.cell_file)
+                job_id = self.process_slurm_multi(
+                    job_dir, self.res_higher, f'-p {cell_file}',
+                    self.n_nodes_hits, self.duration_hits, filtered=True,
+                    step=step, after=[job_id]
+                )
+                jlog.save_slurm_info(
+                    job_id, self.n_nodes_hits, self.duration_hits, job_dir)
+                print(f' Submitted indexamajig (II) as job {job_id}')
+
+            job_id = self.submit_stage('merge', [job_id])
+        print(f'\n All steps have been submitted, the workflow is complete'
+              f' when job {job_id} has finished.')
+
+    def submit_stage(self, stage, after):
+        """ Submit a stage of the detached workflow as a job running after
+            the given jobs have completed successfully
+        """
+        options = ''.join([
+            ' --diagnostic' if self.diagnostic else '',
+            ' --peak-input' if self.use_peaks else '',
+            ' --cheetah-input' if self.use_cheetah else '',
+        ])
+        script = f'_tmp_{self.list_prefix}_stage_{stage}.sh'
+        with open(script, 'w') as f:
+            f.write(tmp.DETACHED_STAGE_BASH % {
+                'STAGE': stage,
+                'PYTHON': sys.executable,
+                'OPTIONS': options
+            })
+        job_id = self.scheduler.submit(
+            script, '.', 1, self.duration_stage, after=after)
+        print(f' Submitted stage {stage} as job {job_id}')
+        return job_id
+
+    def save_detached_state(self, state):
+        """ Store the state shared by the stages of the detached workflow
+        """
+        with open(DETACHED_STATE_FILE, 'w') as f_state:
+            json.dump(state, f_state, indent=4)
+
+    def load_detached_state(self):
+        """ Load the state shared by the stages of the detached workflow
+        """
+        with open(DETACHED_STATE_FILE, 'r') as f_state:
+            return json.load(f_state)
+
+    def finish_detached_step(self, state, filtered):
+        """ Concatenate and report the output of an indexamajig step of
+            the detached workflow; return the number of processed frames
+        """
+        stage = 'indexamajig_hits' if filtered else 'indexamajig_all'
+        self.step, job_dir = state['steps'][stage]
+        log_progress = utl.LogProgress(self.crystfel_version)
+        # The job folder holds the logs of this step's job only
+        n_proc_frames, _ = log_progress.update(
+            self.scheduler.log_files('*', job_dir))
+        self.concat(job_dir, filtered)
+        res_limit = self.res_higher if filtered else self.res_lower
+        self.report_step(job_dir, res_limit, n_proc_frames, filtered)
+        return n_proc_frames
+
+    def run_stage(self, stage):
+        """ Run a stage of the detached workflow in its own job: filter
+            the frames of the first indexamajig step for the second one,
+            or merge the output of the last step
+        """
+        state = self.load_detached_state()
+        self.json_log.load_json()
+        self.frames_list = fsel.FrameSelection.from_list_file(
+            f'{self.list_prefix}_frames.lst')
+        if stage == 'filter':
+            print('\n-----   TASK: filter crystal frames according to the'
+                  ' unit cell parameters   -----\n')
+            self.n_proc_frames_all = self.finish_detached_step(
+                state, filtered=False)
+            self.fit_filtered_crystals()
+            self.distribute_hits()
+            hits_dir = state['steps']['indexamajig_hits'][1]
+            for input_list in glob(f'{self.list_prefix}_hits_[0-9]*.lst'):
+                shutil.move(input_list, hits_dir)
+            state['n_proc_frames_all'] = self.n_proc_frames_all
+            state['cell_file'] = self.cell_file
+            self.save_detached_state(state)
+            return
+
+        if self.run_proc_fine:
+            self.n_proc_frames_all = state['n_proc_frames_all']
+            self.cell_file = state['cell_file']
+            self.n_proc_frames_hits = self.finish_detached_step(
+                state, filtered=True)
+            smr.report_total_rate(
+                self.list_prefix, self.n_proc_frames_all,
+                self.stream_stats_hits.n_crystals)
+            self.cell_info.append(utl.cell_as_string(self.cell_file))
+            smr.report_cells(self.list_prefix, self.cell_info)
+        else:
+            self.n_proc_frames_all = self.finish_detached_step(
+                state, filtered=False)
+        if self.run_partialator:
+            print('\n-----   TASK: scale/merge data and create statistics -----\n')
+            self.merge_bragg_obs()
+            self.json_log.save_partialator()
+        smr.report_reconfig(self.list_prefix, self.overrides)
+
     def check_late_entrance(self):
         """ Verify the presence of mandatory files from a previous session
         """
@@ -1370,8 +2097,23 @@ class Workflow:
         if self.interactive:
             self.verify_indexamajig_config_all()
 
+        if self.pipelined and os.path.exists(self.cell_file):
+            # The second pass is configured before it starts during the first
+            if self.interactive:
+                self.verify_run_proc_fine()
+                if self.run_proc_fine:
+                    self.verify_frame_filter_config()
+                    self.verify_indexamajig_config_hits()
+            self.use_pipeline = (
+                self.run_proc_fine and not self.work_queue_batch
+                and not self.resume)
+
         self.json_log.save_crystfel_ver()
 
+        if self.detached:
+            self.submit_detached(cell_keyword)
+            return
+
         self.n_proc_frames_all = self.wrap_process(
             self.res_lower, cell_keyword, filtered=False)
 
@@ -1393,13 +2135,13 @@ class Workflow:
             self.n_proc_frames_all = self.wrap_process(
                 self.res_lower, cell_keyword, filtered=False)
 
-        if self.interactive:
+        if self.interactive and not self.use_pipeline:
             self.verify_run_proc_fine()
         if self.run_proc_fine:
             print(
                 '\n-----   TASK: filter crystal frames according to the'
                 ' unit cell parameters   -----\n')
-            if self.interactive:
+            if self.interactive and not self.use_pipeline:
                 self.verify_frame_filter_config()
             # filter indexed frames and update cell parameters
             self.fit_filtered_crystals()
@@ -1442,6 +2184,23 @@ def main(argv=None):
         help="skip VDS generation and assemble input from Cheetah folder "
              "contents"
     )
+    ap.add_argument(
+        "--resume",
+        action='store_true',
+        help="resume indexamajig steps from their job folders and resubmit "
+             "only the missing or incomplete chunks"
+    )
+    ap.add_argument(
+        "--detached",
+        action='store_true',
+        help="submit all steps at once as Slurm jobs depending on each "
+             "other and exit, requires '--automatic'"
+    )
+    ap.add_argument(
+        "--stage",
+        choices=['filter', 'merge'],
+        help="run a stage of a detached workflow (in its Slurm job)"
+    )
     ap.add_argument(
         "-adv", "--advance-config",
         action='store_true',
@@ -1461,18 +2220,28 @@ def main(argv=None):
     elif args.advance_config:
         warnings.warn(
             "Ignore --advance-config option since config file already exists.")
+    if args.detached and not args.automatic:
+        warnings.warn(
+            "Steps of the detached mode run unattended, please rerun with "
+            "'--automatic'.")
+        exit()
     print(48 * '~')
     print(' xWiz - EXtra tool for pipelined SFX workflows')
     print(48 * '~')
     workflow = Workflow(work_dir, self_dir,
                         automatic=args.automatic,
                         diagnostic=args.diagnostic,
-                        silent=args.silent,
+                        silent=args.silent or args.stage is not None,
                         reprocess=args.reprocess,
                         use_peaks=args.peak_input,
-                        use_cheetah=args.cheetah_input)
+                        use_cheetah=args.cheetah_input,
+                        resume=args.resume,
+                        detached=args.detached)
     try:
-        workflow.manage()
+        if args.stage is not None:
+            workflow.run_stage(args.stage)
+        else:
+            workflow.manage()
     except:
         workflow.json_log.write_json()
         raise
@@ -1481,3 +2250,6 @@ def main(argv=None):
     print(48 * '~')
     print(f' Workflow complete.\n See: {workflow.list_prefix}.summary')
 
+
+if __name__ == '__main__':
+    main()